@@ -0,0 +1,102 @@
+"""
+Accuracy vs. compute of confidence-gated TTA on the validation split.
+
+Evaluates a checkpoint without TTA, with AdaptiveTTA at several budgets
+(fraction of the image, context included, that gets the extra passes) and
+with full-image TTA over the same transforms, and reports passes per image
+(in full-image forwards), Overall Acc, Mean F1, Mean IoU and seconds per
+image.
+
+    python -m benchmarks.adaptive_tta --config configs/mv3_1_true_2_res50_data17.yml \
+        --model_path runs/.../mv3_res50_my_best_model.pkl --budgets 0.1 0.25 0.5
+"""
+import time
+import argparse
+
+import torch
+from torch.utils import data
+
+from ptsemseg.loader import get_loader
+from ptsemseg.metrics import torchRunningScore
+from ptsemseg.inference import AdaptiveTTA, Predictor, TTA, load_model
+
+from benchmarks.utils import load_config, synchronize, write_json
+
+
+def evaluate(predictor, valloader, n_classes, device, max_batches=None):
+    running_metrics = torchRunningScore(n_classes, device)
+    n_images = 0
+    synchronize(device)
+    start_ts = time.perf_counter()
+    for i, (images, labels) in enumerate(valloader):
+        if max_batches is not None and i >= max_batches:
+            break
+        outputs = predictor(images.to(device))
+        running_metrics.update(labels.to(device), outputs.argmax(1))
+        n_images += images.size(0)
+    synchronize(device)
+    score, _ = running_metrics.get_scores()
+    return {'overall_acc': score["Overall Acc: \t"],
+            'mean_f1': score["Mean F1 : \t"],
+            'mean_iou': score["Mean IoU : \t"],
+            's_per_image': (time.perf_counter() - start_ts) / max(n_images, 1),
+            'images': n_images}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adaptive TTA report")
+    parser.add_argument("--config", type=str,
+                        default="configs/mv3_1_true_2_res50_data17.yml")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--transforms", nargs="+",
+                        default=["hflip", "vflip", "rot90", "rot270"])
+    parser.add_argument("--budgets", nargs="+", type=float, default=[0.1, 0.25, 0.5])
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="Only refine tiles more uncertain than this")
+    parser.add_argument("--measure", type=str, default="entropy",
+                        choices=["entropy", "margin"])
+    parser.add_argument("--tile_size", nargs=2, type=int, default=[128, 128])
+    parser.add_argument("--context", type=int, default=64)
+    parser.add_argument("--max_batches", type=int, default=None)
+    parser.add_argument("--json", type=str, default=None)
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    data_loader = get_loader(cfg['data']['dataset'])
+    v_loader = data_loader(cfg['data']['path'], split=cfg['data']['val_split'],
+                           is_transform=True,
+                           img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']))
+    n_classes = v_loader.n_classes
+    valloader = data.DataLoader(v_loader, batch_size=cfg['training']['batch_size'],
+                                num_workers=cfg['training']['n_workers'])
+    model = load_model(cfg, args.model_path, n_classes, device)
+
+    settings = [('none', model, 1.0)]
+    for budget in args.budgets:
+        adaptive = AdaptiveTTA(model, args.transforms, tile_size=args.tile_size,
+                               context=args.context, measure=args.measure,
+                               threshold=args.threshold, budget=budget)
+        settings.append(('adaptive {:.2f}'.format(budget), adaptive, None))
+    settings.append(('full', TTA(model, ['identity'] + args.transforms),
+                     1.0 + len(args.transforms)))
+
+    results = []
+    fmt = "{:<16} {:>12} {:>10} {:>10} {:>10} {:>10}"
+    print(fmt.format('setting', 'passes/img', 'OA', 'mean F1', 'mean IoU', 's/img'))
+    for name, fn, passes in settings:
+        rlt = evaluate(Predictor(model, fn), valloader, n_classes, device,
+                       args.max_batches)
+        if passes is None:
+            passes = fn.stats['passes'] / max(fn.stats['images'], 1)
+        rlt.update({'setting': name, 'passes_per_image': passes})
+        results.append(rlt)
+        print(fmt.format(name, '{:.2f}'.format(passes),
+                         '{:.4f}'.format(rlt['overall_acc']),
+                         '{:.4f}'.format(rlt['mean_f1']),
+                         '{:.4f}'.format(rlt['mean_iou']),
+                         '{:.4f}'.format(rlt['s_per_image'])))
+
+    if args.json is not None:
+        write_json(results, args.json)
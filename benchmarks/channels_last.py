@@ -0,0 +1,89 @@
+"""
+Compares NCHW and channels-last training speed per architecture and lists
+the ops that force layout conversions.
+
+    python -m benchmarks.channels_last --archs mv3_res50 deeplabv3_os16_MG \
+        --device cuda --batch_size 4 --img_size 512 512
+"""
+import time
+import argparse
+
+import torch
+
+from ptsemseg.models import get_model
+from ptsemseg.loss import cross_entropy2d
+from ptsemseg.memory_format import to_channels_last, audit_layout
+
+from benchmarks.utils import synchronize, random_batch, write_json
+
+
+def time_train_iters(model, images, labels, iters, warmup):
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0e-3, momentum=0.9)
+
+    def step():
+        optimizer.zero_grad()
+        loss = cross_entropy2d(input=model(images), target=labels)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup):
+        step()
+    synchronize(images.device)
+    start_ts = time.perf_counter()
+    for _ in range(iters):
+        step()
+    synchronize(images.device)
+    return (time.perf_counter() - start_ts) / iters
+
+
+def bench_arch(arch, args):
+    device = torch.device(args.device)
+    rows, cols = args.img_size
+    images, labels = random_batch(args.batch_size, args.n_classes, rows, cols, device)
+
+    rlt = {'arch': arch}
+    for layout in ['nchw', 'channels_last']:
+        channels_last = layout == 'channels_last'
+        torch.manual_seed(1337)
+        model = get_model({'arch': arch}, args.n_classes).to(device)
+        model = to_channels_last(model, channels_last)
+        model.train()
+        rlt[layout + '_s'] = time_train_iters(
+            model, to_channels_last(images, channels_last), labels,
+            args.iters, args.warmup)
+
+    model.eval()
+    conversions = audit_layout(model, images)
+    rlt['speedup'] = rlt['nchw_s'] / rlt['channels_last_s']
+    rlt['conversions'] = conversions
+    return rlt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Channels-last benchmark")
+    parser.add_argument("--archs", nargs="+",
+                        default=["mv3_res50", "mv3_res101", "deeplabv3_os16_MG",
+                                 "refinenet50"])
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--img_size", nargs=2, type=int, default=[512, 512])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print("{:<26} {:>10} {:>10} {:>8}".format("arch", "NCHW s/it", "NHWC s/it", "speedup"))
+    for arch in args.archs:
+        rlt = bench_arch(arch, args)
+        results.append(rlt)
+        print("{:<26} {:>10.4f} {:>10.4f} {:>7.2f}x".format(
+            arch, rlt['nchw_s'], rlt['channels_last_s'], rlt['speedup']))
+        for op, count in rlt['conversions'].items():
+            print("    layout conversion x{:<3d} {}".format(count, op))
+
+    if args.json is not None:
+        write_json(results, args.json)
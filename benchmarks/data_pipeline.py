@@ -0,0 +1,141 @@
+"""
+Input-pipeline-only benchmark: iterates the training DataLoader built from a
+config (loader, augmentations, n_workers, batch size) without a model.
+
+Reports samples/s, the time per sample spent in each stage (read, decode,
+augment, transform), collate time per batch, how long the main process
+waited for batches, and how busy each worker was.
+
+    python -m benchmarks.data_pipeline --config configs/mv3_1_true_2_res50_data17.yml \
+        --batches 200
+"""
+import os
+import time
+import logging
+import argparse
+from collections import defaultdict
+
+from torch.utils import data
+from torch.utils.data import get_worker_info
+try:
+    from torch.utils.data import default_collate
+except ImportError:
+    from torch.utils.data.dataloader import default_collate
+
+from train import get_dataloaders
+from benchmarks.utils import load_config, write_json
+
+
+class timedDataset(data.Dataset):
+    """Wraps a loader so every sample carries its stage timings"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        if hasattr(self.dataset, 'get_item_timed'):
+            img, lbl, times = self.dataset.get_item_timed(index)
+        else:
+            t0 = time.perf_counter()
+            img, lbl = self.dataset[index]
+            times = {'getitem': time.perf_counter() - t0}
+        return img, lbl, times
+
+
+def timed_collate(batch):
+    t0 = time.perf_counter()
+    images, labels = default_collate([(img, lbl) for img, lbl, _ in batch])
+    collate_s = time.perf_counter() - t0
+
+    stage_s = defaultdict(float)
+    for _, _, times in batch:
+        for k, v in times.items():
+            stage_s[k] += v
+    worker = get_worker_info()
+    info = {'stages': dict(stage_s),
+            'collate': collate_s,
+            'busy': sum(stage_s.values()) + collate_s,
+            'worker': worker.id if worker is not None else 'main',
+            'n': len(batch)}
+    return images, labels, info
+
+
+def bench_pipeline(cfg, args):
+    logger = logging.getLogger('ptsemseg')
+    trainloader, _ = get_dataloaders(cfg, logger)
+    loader = data.DataLoader(timedDataset(trainloader.dataset),
+                             batch_size=trainloader.batch_size,
+                             num_workers=trainloader.num_workers,
+                             shuffle=True,
+                             drop_last=trainloader.drop_last,
+                             collate_fn=timed_collate)
+
+    stage_s = defaultdict(float)
+    worker_busy = defaultdict(float)
+    collate_s = 0.0
+    wait_s = 0.0
+    n_samples = 0
+    n_batches = 0
+
+    start_ts = time.perf_counter()
+    wait_ts = start_ts
+    while n_batches < args.batches:
+        for images, labels, info in loader:
+            wait_s += time.perf_counter() - wait_ts
+            n_batches += 1
+            n_samples += info['n']
+            collate_s += info['collate']
+            worker_busy[info['worker']] += info['busy']
+            for k, v in info['stages'].items():
+                stage_s[k] += v
+            if n_batches >= args.batches:
+                break
+            wait_ts = time.perf_counter()
+    elapsed = time.perf_counter() - start_ts
+
+    return {
+        'config': args.config,
+        'batch_size': trainloader.batch_size,
+        'n_workers': trainloader.num_workers,
+        'batches': n_batches,
+        'samples_per_s': n_samples / elapsed,
+        'batches_per_s': n_batches / elapsed,
+        'stage_ms_per_sample': {k: v / n_samples * 1000 for k, v in stage_s.items()},
+        'collate_ms_per_batch': collate_s / n_batches * 1000,
+        'main_wait_fraction': wait_s / elapsed,
+        'worker_utilization': {str(k): v / elapsed for k, v in worker_busy.items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data pipeline benchmark")
+    parser.add_argument("--config", type=str,
+                        default="configs/mv3_1_true_2_res50_data17.yml",
+                        help="Configuration file to use")
+    parser.add_argument("--batches", type=int, default=100,
+                        help="Number of batches to draw")
+    parser.add_argument("--n_workers", type=int, default=None,
+                        help="Override training: n_workers")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    if args.n_workers is not None:
+        cfg['training']['n_workers'] = args.n_workers
+
+    rlt = bench_pipeline(cfg, args)
+    print("samples/s: {:.1f}  batches/s: {:.2f}  (batch {}, {} workers, {} CPUs)".format(
+        rlt['samples_per_s'], rlt['batches_per_s'], rlt['batch_size'],
+        rlt['n_workers'], os.cpu_count()))
+    for k, v in sorted(rlt['stage_ms_per_sample'].items()):
+        print("  {:<10} {:8.2f} ms/sample".format(k, v))
+    print("  {:<10} {:8.2f} ms/batch".format('collate', rlt['collate_ms_per_batch']))
+    print("main process waiting: {:.1%}".format(rlt['main_wait_fraction']))
+    for k, v in sorted(rlt['worker_utilization'].items()):
+        print("  worker {:<4} busy {:.1%}".format(k, v))
+
+    if args.json is not None:
+        write_json(rlt, args.json)
@@ -0,0 +1,142 @@
+"""
+Inference latency and throughput of every architecture over batch size x
+resolution x precision.
+
+Each configuration is warmed up, then timed per iteration (CUDA events, or
+perf_counter on the CPU) with the device synchronized before results are
+read. Reports mean / p50 / p95 / p99 latency per batch and images/s.
+
+    python -m benchmarks.inference --archs mv3_res50 mv3_res101 \
+        --batch_sizes 1 4 8 --img_sizes 512x512 1024x1024 \
+        --precisions fp32 fp16 --csv inference.csv --json inference.json
+
+Precisions: fp32, fp16 / bf16 (autocast). Configurations that do not fit in
+memory or are not supported on the device are recorded with an error.
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.metrics import stepTimer
+from ptsemseg.memory_format import to_channels_last
+
+from benchmarks.utils import synchronize, write_csv, write_json
+
+key2dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def parse_size(s):
+    rows, cols = s.lower().split('x')
+    return int(rows), int(cols)
+
+
+def _autocast(device, precision):
+    if precision == 'fp32':
+        return torch.autocast(device.type, enabled=False)
+    return torch.autocast(device.type, dtype=key2dtype[precision])
+
+
+def time_inference(model, device, batch_size, img_size, precision, args):
+    rows, cols = img_size
+    images = torch.rand(batch_size, 3, rows, cols, device=device)
+    images = to_channels_last(images, args.channels_last)
+    timer = stepTimer(device)
+
+    with torch.no_grad(), _autocast(device, precision):
+        for _ in range(args.warmup):
+            outputs = model(images)
+        synchronize(device)
+        for _ in range(args.iters):
+            timer.start()
+            outputs = model(images)
+            if args.argmax:
+                outputs = outputs.argmax(1)
+            timer.stop()
+    times = np.array(timer.flush())
+
+    return {'latency_mean_ms': times.mean() * 1000,
+            'latency_p50_ms': np.percentile(times, 50) * 1000,
+            'latency_p95_ms': np.percentile(times, 95) * 1000,
+            'latency_p99_ms': np.percentile(times, 99) * 1000,
+            'images_per_s': batch_size * len(times) / times.sum()}
+
+
+def bench_arch(arch, args):
+    device = torch.device(args.device)
+    if device.type == 'cuda' and device.index is not None:
+        # timing events are recorded on the current device
+        torch.cuda.set_device(device)
+    model = get_model({'arch': arch}, args.n_classes).to(device)
+    model = to_channels_last(model, args.channels_last)
+    model.eval()
+    torch.backends.cudnn.benchmark = True
+
+    results = []
+    for img_size in args.img_sizes:
+        for batch_size in args.batch_sizes:
+            for precision in args.precisions:
+                rlt = {'arch': arch, 'device': str(device), 'precision': precision,
+                       'batch_size': batch_size,
+                       'img_rows': img_size[0], 'img_cols': img_size[1]}
+                try:
+                    rlt.update(time_inference(model, device, batch_size,
+                                              img_size, precision, args))
+                except RuntimeError as e:
+                    rlt['error'] = str(e).split('\n')[0]
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                results.append(rlt)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference benchmark")
+    parser.add_argument("--archs", nargs="+", default=sorted(key2model.keys()))
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--img_sizes", nargs="+", type=parse_size,
+                        default=[(512, 512)], help="ROWSxCOLS, e.g. 512x512")
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "fp16"],
+                        choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument("--argmax", action="store_true",
+                        help="Include the on-device argmax in the timing")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--csv", type=str, default=None,
+                        help="Write results to this CSV file")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    fmt = "{:<24} {:>5} {:>9} {:>5} {:>9} {:>9} {:>9} {:>10}"
+    print(fmt.format('arch', 'prec', 'size', 'batch', 'p50 ms', 'p95 ms',
+                     'p99 ms', 'images/s'))
+    for arch in args.archs:
+        try:
+            rlts = bench_arch(arch, args)
+        except Exception as e:
+            print("{:<24} skipped: {}".format(arch, e))
+            continue
+        results += rlts
+        for r in rlts:
+            size = '{}x{}'.format(r['img_rows'], r['img_cols'])
+            if 'error' in r:
+                print("{:<24} {:>5} {:>9} {:>5}  failed: {}".format(
+                    arch, r['precision'], size, r['batch_size'], r['error']))
+                continue
+            print(fmt.format(arch, r['precision'], size, r['batch_size'],
+                             '{:.2f}'.format(r['latency_p50_ms']),
+                             '{:.2f}'.format(r['latency_p95_ms']),
+                             '{:.2f}'.format(r['latency_p99_ms']),
+                             '{:.1f}'.format(r['images_per_s'])))
+
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    if args.json is not None:
+        write_json(results, args.json)
@@ -0,0 +1,110 @@
+"""
+Peak device memory and latency of one inference forward with autograd on
+(how the test scripts used to call the model), under no_grad, and through
+ptsemseg.inference.Predictor (inference_mode).
+
+    python -m benchmarks.inference_memory --archs mv3_res50 --batch_sizes 1 4 \
+        --img_sizes 512x512 1024x1024
+
+Peak memory is only reported on CUDA.
+"""
+import time
+import argparse
+import contextlib
+
+import torch
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.inference import Predictor, prepare_model
+
+from benchmarks.utils import (synchronize, reset_peak_memory, peak_memory_bytes,
+                              write_csv, write_json)
+from benchmarks.inference import parse_size
+
+MB = 2.0 ** 20
+
+
+def run_mode(model, images, mode, iters):
+    if mode == 'predictor':
+        fn = Predictor(model)
+        ctx = contextlib.nullcontext
+    else:
+        fn = model
+        ctx = torch.no_grad if mode == 'no_grad' else torch.enable_grad
+
+    synchronize(images.device)
+    reset_peak_memory(images.device)
+    start_ts = time.perf_counter()
+    for _ in range(iters):
+        with ctx():
+            outputs = fn(images)
+        del outputs
+    synchronize(images.device)
+    peak_bytes = peak_memory_bytes(images.device)
+    return {'latency_ms': (time.perf_counter() - start_ts) / iters * 1000,
+            'peak_mb': peak_bytes / MB if peak_bytes is not None else None}
+
+
+def bench_arch(arch, args):
+    device = torch.device(args.device)
+    model = get_model({'arch': arch}, args.n_classes)
+    model = prepare_model(model, device)
+    # The old scripts ran with parameters that require grad
+    for p in model.parameters():
+        p.requires_grad_(True)
+
+    results = []
+    for rows, cols in args.img_sizes:
+        for batch_size in args.batch_sizes:
+            images = torch.rand(batch_size, 3, rows, cols, device=device)
+            for mode in args.modes:
+                rlt = {'arch': arch, 'mode': mode, 'batch_size': batch_size,
+                       'img_rows': rows, 'img_cols': cols}
+                try:
+                    run_mode(model, images, mode, 1)
+                    rlt.update(run_mode(model, images, mode, args.iters))
+                except RuntimeError as e:
+                    rlt['error'] = str(e).split('\n')[0]
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                results.append(rlt)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference memory benchmark")
+    parser.add_argument("--archs", nargs="+", default=["mv3_res50"],
+                        choices=sorted(key2model.keys()))
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--img_sizes", nargs="+", type=parse_size,
+                        default=[(512, 512)], help="ROWSxCOLS, e.g. 512x512")
+    parser.add_argument("--modes", nargs="+", default=["grad", "no_grad", "predictor"],
+                        choices=["grad", "no_grad", "predictor"])
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--csv", type=str, default=None)
+    parser.add_argument("--json", type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    fmt = "{:<20} {:>10} {:>5} {:>10} {:>12} {:>12}"
+    print(fmt.format('arch', 'size', 'batch', 'mode', 'latency ms', 'peak MB'))
+    for arch in args.archs:
+        rlts = bench_arch(arch, args)
+        results += rlts
+        for r in rlts:
+            size = '{}x{}'.format(r['img_rows'], r['img_cols'])
+            if 'error' in r:
+                print(fmt.format(arch, size, r['batch_size'], r['mode'], 'failed', '-'))
+                continue
+            print(fmt.format(arch, size, r['batch_size'], r['mode'],
+                             '{:.2f}'.format(r['latency_ms']),
+                             '{:.1f}'.format(r['peak_mb'])
+                             if r['peak_mb'] is not None else '-'))
+
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    if args.json is not None:
+        write_json(results, args.json)
@@ -0,0 +1,69 @@
+"""
+Static cost table of every architecture at a given input size: GMACs,
+parameters, weight size, summed layer outputs and peak live activations
+of one inference pass. Shapes are propagated on the meta device, so no
+GPU is needed.
+
+    python -m benchmarks.model_costs --img_size 512 512 --csv model_costs.csv
+
+Architectures that cannot be built (e.g. fcn/segnet without access to the
+pretrained VGG weights) are reported and skipped.
+"""
+import argparse
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.profiling import analyze_model
+
+from benchmarks.utils import write_csv, write_json
+
+MB = 2.0 ** 20
+
+
+def cost_arch(arch, args):
+    model = get_model({'arch': arch}, args.n_classes)
+    rlt = analyze_model(model, args.img_size, batch_size=args.batch_size)
+    rlt['arch'] = arch
+    rlt['img_rows'], rlt['img_cols'] = args.img_size
+    rlt['batch_size'] = args.batch_size
+    return rlt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Architecture cost table")
+    parser.add_argument("--archs", nargs="+", default=sorted(key2model.keys()))
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--img_size", nargs=2, type=int, default=[512, 512])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--sort", type=str, default="macs",
+                        choices=["macs", "params", "peak_activation_bytes"])
+    parser.add_argument("--csv", type=str, default=None,
+                        help="Write the table to this CSV file")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write the table to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for arch in args.archs:
+        try:
+            results.append(cost_arch(arch, args))
+        except Exception as e:
+            print("{:<24} skipped: {}".format(arch, e))
+    results.sort(key=lambda r: r[args.sort] or 0)
+
+    fmt = "{:<24} {:>9} {:>10} {:>10} {:>12} {:>12}  {}"
+    print(fmt.format('arch', 'GMACs', 'params(M)', 'weights MB',
+                     'layer out MB', 'peak act MB', 'device'))
+    for r in results:
+        peak = r['peak_activation_bytes']
+        print(fmt.format(r['arch'],
+                         '{:.2f}'.format(r['macs'] / 1e9),
+                         '{:.2f}'.format(r['params'] / 1e6),
+                         '{:.1f}'.format(r['param_bytes'] / MB),
+                         '{:.1f}'.format(r['activation_bytes'] / MB),
+                         '{:.1f}'.format(peak / MB) if peak is not None else 'n/a',
+                         r['device']))
+
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    if args.json is not None:
+        write_json(results, args.json)
@@ -0,0 +1,111 @@
+"""
+Measures optimizer.step() time per architecture for the per-tensor loop,
+foreach and fused implementations, and its share of a full train step.
+
+    python -m benchmarks.optimizer_step --device cuda --optimizer sgd \
+        --archs mv3_res50 mv3_res101
+"""
+import time
+import argparse
+
+import torch
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.loss import cross_entropy2d
+from ptsemseg.optimizers import build_optimizer
+
+from benchmarks.utils import synchronize, random_batch, write_json
+
+impl2params = {'loop': {'foreach': False},
+               'foreach': {'foreach': True},
+               'fused': {'fused': True},}
+
+
+def time_optimizer_step(model, cfg, iters, warmup, device):
+    optimizer = build_optimizer(cfg, model)
+    for _ in range(warmup):
+        optimizer.step()
+    synchronize(device)
+    start_ts = time.perf_counter()
+    for _ in range(iters):
+        optimizer.step()
+    synchronize(device)
+    return (time.perf_counter() - start_ts) / iters
+
+
+def time_forward_backward(model, args, device):
+    rows, cols = args.img_size
+    images, labels = random_batch(args.batch_size, args.n_classes, rows, cols, device)
+    for _ in range(args.warmup):
+        cross_entropy2d(input=model(images), target=labels).backward()
+    synchronize(device)
+    start_ts = time.perf_counter()
+    for _ in range(args.iters):
+        cross_entropy2d(input=model(images), target=labels).backward()
+    synchronize(device)
+    return (time.perf_counter() - start_ts) / args.iters
+
+
+def bench_arch(arch, args):
+    device = torch.device(args.device)
+    model = get_model({'arch': arch}, args.n_classes).to(device)
+    model.train()
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        p.grad = torch.randn_like(p) * 1.0e-3
+
+    rlt = {'arch': arch, 'n_tensors': len(params),
+           'n_params': sum(p.numel() for p in params)}
+    if args.img_size is not None:
+        rlt['fwd_bwd_s'] = time_forward_backward(model, args, device)
+
+    for impl in args.impls:
+        opt_dict = {'name': args.optimizer, 'lr': 1.0e-3,
+                    'momentum': 0.9, 'weight_decay': 5.0e-4}
+        if args.optimizer != 'sgd':
+            opt_dict.pop('momentum')
+        opt_dict.update(impl2params[impl])
+        cfg = {'training': {'optimizer': opt_dict}}
+        step_s = time_optimizer_step(model, cfg, args.iters, args.warmup, device)
+        rlt[impl + '_s'] = step_s
+        if 'fwd_bwd_s' in rlt:
+            rlt[impl + '_fraction'] = step_s / (step_s + rlt['fwd_bwd_s'])
+    return rlt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimizer step benchmark")
+    parser.add_argument("--archs", nargs="+", default=sorted(key2model.keys()))
+    parser.add_argument("--optimizer", type=str, default="sgd")
+    parser.add_argument("--impls", nargs="+", default=["loop", "foreach", "fused"])
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--img_size", nargs=2, type=int, default=None,
+                        help="Also time forward+backward at this size to report "
+                             "the optimizer share of a train step")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for arch in args.archs:
+        try:
+            rlt = bench_arch(arch, args)
+        except Exception as e:
+            print("{:<24} skipped: {}".format(arch, e))
+            continue
+        results.append(rlt)
+        timings = "  ".join("{}: {:8.3f} ms".format(impl, rlt[impl + '_s'] * 1000)
+                            for impl in args.impls)
+        print("{:<24} {:4d} tensors  {}".format(arch, rlt['n_tensors'], timings))
+        if 'fwd_bwd_s' in rlt:
+            print("{:<24} share of step: {}".format("", "  ".join(
+                "{}: {:5.1%}".format(impl, rlt[impl + '_fraction'])
+                for impl in args.impls)))
+
+    if args.json is not None:
+        write_json(results, args.json)
@@ -0,0 +1,77 @@
+"""
+Per-layer profile of one architecture: forward/backward time, GFLOPs,
+parameters, activation size and output shape of every submodule.
+
+    python -m benchmarks.profile_layers --arch mv3_res50 --img_size 512 512 \
+        --depth 2 --sort forward_s --trace mv3_res50_trace.json
+
+Open the trace in chrome://tracing or https://ui.perfetto.dev. Times are
+inclusive: a block's row covers its children and any functional ops
+(upsampling, concatenation, additions) it calls directly.
+"""
+import argparse
+
+import torch
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.loss import cross_entropy2d
+from ptsemseg.profiling import layerProfiler
+
+from benchmarks.utils import random_batch, write_json
+
+sort_keys = ['forward_s', 'backward_s', 'macs', 'params', 'activation_bytes']
+
+
+def profile_arch(args):
+    device = torch.device(args.device)
+    model = get_model({'arch': args.arch}, args.n_classes).to(device)
+    model.train(not args.eval)
+    rows, cols = args.img_size
+    images, labels = random_batch(args.batch_size, args.n_classes, rows, cols, device)
+
+    # Warm up so cudnn autotuning and allocations stay out of the profile
+    for _ in range(args.warmup):
+        with torch.set_grad_enabled(not args.eval):
+            outputs = model(images)
+            if not args.eval:
+                cross_entropy2d(input=outputs, target=labels).backward()
+    model.zero_grad()
+
+    with torch.set_grad_enabled(not args.eval):
+        with layerProfiler(model, backward=not args.eval) as prof:
+            outputs = model(images)
+            if not args.eval:
+                cross_entropy2d(input=outputs, target=labels).backward()
+    return prof
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-layer profiler")
+    parser.add_argument("--arch", type=str, default="mv3_res50",
+                        choices=sorted(key2model.keys()))
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--img_size", nargs=2, type=int, default=[512, 512])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--eval", action="store_true",
+                        help="Profile inference only (eval mode, no backward)")
+    parser.add_argument("--sort", type=str, default="forward_s", choices=sort_keys)
+    parser.add_argument("--depth", type=int, default=None,
+                        help="Only show modules up to this nesting depth")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Only show the first N rows")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace to this file")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write the per-module records to this JSON file")
+    args = parser.parse_args()
+
+    prof = profile_arch(args)
+    prof.print_table(sort_by=args.sort, max_depth=args.depth, limit=args.limit)
+
+    if args.trace is not None:
+        prof.export_chrome_trace(args.trace)
+    if args.json is not None:
+        write_json(prof.table(args.sort, args.depth), args.json)
@@ -0,0 +1,96 @@
+"""
+Benchmarks the eager, torch.compile and CUDA graph train steps.
+
+    python -m benchmarks.train_step --config configs/mv3_1_true_2_res50_data17.yml \
+        --device cuda --modes eager compile cudagraph
+"""
+import time
+import argparse
+
+import torch
+
+from ptsemseg.models import get_model
+from ptsemseg.loss import get_loss_function
+from ptsemseg.train_step import get_train_step
+
+from benchmarks.utils import (load_config, synchronize, random_batch,
+                              build_optimizer, write_json)
+
+
+def bench_mode(cfg, mode, args):
+    device = torch.device(args.device)
+    rows = args.img_rows or cfg['data']['img_rows']
+    cols = args.img_cols or cfg['data']['img_cols']
+    batch_size = args.batch_size or cfg['training']['batch_size']
+
+    torch.manual_seed(cfg.get('seed', 1337))
+    model = get_model(cfg['model'], args.n_classes).to(device)
+    model.train()
+    optimizer = build_optimizer(cfg, model)
+    loss_fn = get_loss_function(cfg)
+    compile_dict = None if mode == 'eager' else {'mode': mode}
+    step = get_train_step(model, loss_fn, optimizer, compile_dict)
+
+    images, labels = random_batch(batch_size, args.n_classes, rows, cols, device)
+
+    # First step includes compilation / graph capture
+    synchronize(device)
+    start_ts = time.perf_counter()
+    step(images, labels)
+    synchronize(device)
+    first_step = time.perf_counter() - start_ts
+
+    for _ in range(args.warmup):
+        step(images, labels)
+    synchronize(device)
+
+    start_ts = time.perf_counter()
+    for _ in range(args.iters):
+        step(images, labels)
+    synchronize(device)
+    elapsed = time.perf_counter() - start_ts
+
+    return {
+        'arch': cfg['model']['arch'],
+        'mode': mode,
+        'step_class': type(step).__name__,
+        'device': str(device),
+        'batch_size': batch_size,
+        'img_size': [rows, cols],
+        'first_step_s': first_step,
+        'compile_s': getattr(step, 'compile_time', None),
+        'steps_per_s': args.iters / elapsed,
+        'images_per_s': args.iters * batch_size / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train step benchmark")
+    parser.add_argument("--config", type=str,
+                        default="configs/mv3_1_true_2_res50_data17.yml",
+                        help="Configuration file to use")
+    parser.add_argument("--modes", nargs="+", default=["eager", "compile", "cudagraph"],
+                        help="Train step modes to compare")
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument("--img_rows", type=int, default=None)
+    parser.add_argument("--img_cols", type=int, default=None)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    results = []
+    for mode in args.modes:
+        rlt = bench_mode(cfg, mode, args)
+        results.append(rlt)
+        print("{:<10} {:<14} steps/s: {:8.3f}  img/s: {:8.2f}  first step: {:7.2f}s".format(
+            rlt['mode'], rlt['step_class'], rlt['steps_per_s'],
+            rlt['images_per_s'], rlt['first_step_s']))
+
+    if args.json is not None:
+        write_json(results, args.json)
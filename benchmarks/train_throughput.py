@@ -0,0 +1,130 @@
+"""
+Synthetic-data training throughput for every registered architecture.
+
+Builds each model with get_model, feeds random batches and times forward,
+backward and optimizer step separately (synchronizing between phases),
+along with images/s and peak memory (CUDA only). Runs on CPU or GPU and writes JSON
+that can be compared against an earlier run to catch regressions.
+
+    python -m benchmarks.train_throughput --device cpu --batch_size 2 \
+        --img_size 256 256 --json bench.json --baseline bench_old.json
+"""
+import time
+import argparse
+
+import torch
+
+from ptsemseg.models import get_model, key2model
+from ptsemseg.loss import cross_entropy2d
+
+from benchmarks.utils import (synchronize, random_batch, build_optimizer,
+                              reset_peak_memory, peak_memory_bytes,
+                              write_json, load_json)
+
+
+def bench_arch(arch, args):
+    device = torch.device(args.device)
+    rows, cols = args.img_size
+    torch.manual_seed(1337)
+    model = get_model({'arch': arch}, args.n_classes).to(device)
+    model.train()
+    cfg = {'training': {'optimizer': {'name': 'sgd', 'lr': 1.0e-3,
+                                      'momentum': 0.99, 'weight_decay': 5.0e-4}}}
+    optimizer = build_optimizer(cfg, model)
+    images, labels = random_batch(args.batch_size, args.n_classes, rows, cols, device)
+
+    times = {'forward': 0.0, 'backward': 0.0, 'optimizer': 0.0}
+    reset_peak_memory(device)
+    for it in range(args.warmup + args.iters):
+        optimizer.zero_grad()
+        synchronize(device)
+        t0 = time.perf_counter()
+        loss = cross_entropy2d(input=model(images), target=labels)
+        synchronize(device)
+        t1 = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        t2 = time.perf_counter()
+        optimizer.step()
+        synchronize(device)
+        t3 = time.perf_counter()
+        if it >= args.warmup:
+            times['forward'] += t1 - t0
+            times['backward'] += t2 - t1
+            times['optimizer'] += t3 - t2
+
+    step_s = sum(times.values()) / args.iters
+    peak_bytes = peak_memory_bytes(device)
+    return {
+        'arch': arch,
+        'device': str(device),
+        'batch_size': args.batch_size,
+        'img_size': [rows, cols],
+        'forward_s': times['forward'] / args.iters,
+        'backward_s': times['backward'] / args.iters,
+        'optimizer_s': times['optimizer'] / args.iters,
+        'step_s': step_s,
+        'images_per_s': args.batch_size / step_s,
+        'peak_memory_mb': peak_bytes / 2.0 ** 20 if peak_bytes is not None else None,
+        'n_params': sum(p.numel() for p in model.parameters()),
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """Archs whose images/s dropped by more than `tolerance` vs `baseline`"""
+    old = {(r['arch'], r['device'], r['batch_size'], tuple(r['img_size'])): r
+           for r in baseline}
+    regressions = []
+    for rlt in results:
+        key = (rlt['arch'], rlt['device'], rlt['batch_size'], tuple(rlt['img_size']))
+        if key not in old:
+            continue
+        ratio = rlt['images_per_s'] / old[key]['images_per_s']
+        if ratio < 1.0 - tolerance:
+            regressions.append((rlt['arch'], ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic training throughput")
+    parser.add_argument("--archs", nargs="+", default=sorted(key2model.keys()))
+    parser.add_argument("--device", type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--n_classes", type=int, default=6)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--img_size", nargs=2, type=int, default=[512, 512])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--json", type=str, default=None,
+                        help="Write results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Earlier JSON results to compare images/s against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative images/s drop vs the baseline")
+    args = parser.parse_args()
+
+    results = []
+    print("{:<24} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+        "arch", "fwd ms", "bwd ms", "opt ms", "img/s", "peak MB"))
+    for arch in args.archs:
+        try:
+            rlt = bench_arch(arch, args)
+        except Exception as e:
+            print("{:<24} skipped: {}".format(arch, e))
+            continue
+        results.append(rlt)
+        peak_mb = rlt['peak_memory_mb']
+        print("{:<24} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.2f} {:>10}".format(
+            arch, rlt['forward_s'] * 1000, rlt['backward_s'] * 1000,
+            rlt['optimizer_s'] * 1000, rlt['images_per_s'],
+            '{:.1f}'.format(peak_mb) if peak_mb is not None else '-'))
+
+    if args.json is not None:
+        write_json(results, args.json)
+
+    if args.baseline is not None:
+        regressions = find_regressions(results, load_json(args.baseline), args.tolerance)
+        for arch, ratio in regressions:
+            print("REGRESSION {}: {:.1%} of baseline images/s".format(arch, ratio))
+        if regressions:
+            raise SystemExit(1)
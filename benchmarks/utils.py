@@ -0,0 +1,70 @@
+"""
+Shared helpers for the benchmark scripts
+"""
+import csv
+import json
+import yaml
+import torch
+
+from ptsemseg.optimizers import build_optimizer as _build_optimizer
+
+
+def load_config(path):
+    with open(path) as fp:
+        return yaml.safe_load(fp)
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_bytes(device):
+    """Peak allocated device memory on CUDA since reset_peak_memory, None on
+    CPU: the process peak RSS never goes down, so it cannot be attributed to
+    one measurement"""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return None
+
+
+def random_batch(batch_size, n_classes, rows, cols, device):
+    """Random images in [0, 1] and labels in [0, n_classes)"""
+    images = torch.rand(batch_size, 3, rows, cols, device=device)
+    labels = torch.randint(0, n_classes, (batch_size, rows, cols),
+                           dtype=torch.long, device=device)
+    return images, labels
+
+
+def build_optimizer(cfg, model):
+    cfg = dict(cfg, training=dict(cfg['training']))
+    optimizer_dict = dict(cfg['training'].get('optimizer') or {'name': 'sgd'})
+    optimizer_dict.setdefault('lr', 1.0e-3)
+    cfg['training']['optimizer'] = optimizer_dict
+    return _build_optimizer(cfg, model)
+
+
+def write_json(results, path):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+
+def load_json(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def write_csv(rows, path):
+    """Writes a list of flat dicts, columns in first-seen order"""
+    fields = []
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    with open(path, 'w') as fp:
+        csv_writer = csv.DictWriter(fp, fieldnames=fields)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
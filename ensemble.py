@@ -0,0 +1,173 @@
+import os
+import torch
+import argparse
+import numpy as np
+
+from tqdm import tqdm
+
+from ptsemseg.loader import get_loader, get_data_path
+from ptsemseg.inference import (InferencePipeline, Predictor, TTA, SlidingWindow,
+                                load_ensemble)
+
+import yaml
+from pathlib import Path
+import natsort
+import cv2 as cv
+
+
+def parse_members(member_args):
+    members = []
+    for m in member_args:
+        if len(m) not in (2, 3):
+            raise ValueError("--member takes CONFIG MODEL_PATH [WEIGHT], got {}".format(m))
+        with open(m[0]) as fp:
+            cfg = yaml.load(fp)
+        members.append({'cfg': cfg, 'model_path': m[1],
+                        'weight': float(m[2]) if len(m) == 3 else 1.0})
+    return members
+
+
+def test(args):
+
+    members = parse_members(args.member)
+    cfg = members[0]['cfg']
+
+    IMG_Path=Path(args.img_path)
+    IMG_File=natsort.natsorted(list(IMG_Path.glob("*.png")),alg=natsort.PATH)
+    IMG_Str=[]
+    for i in IMG_File:
+        IMG_Str.append(str(i))
+    # Setup image
+    print("Read Input Image from : {}".format(args.img_path))
+
+    data_loader = get_loader(args.dataset)
+    data_path = get_data_path(args.dataset,config_file=cfg)
+    loader = data_loader(data_path, is_transform=True, img_norm=args.img_norm)
+    n_classes = loader.n_classes
+
+    # Setup Models, round-robin over the devices
+    ensemble = load_ensemble(members, n_classes, devices=args.devices, fuse=args.fuse,
+                             cudnn_benchmark=args.cudnn_benchmark)
+    device = ensemble.output_device
+
+    # TTA and tiling wrap the whole ensemble: every member sees the same
+    # transformed batch / tiles, prepared once
+    fn = ensemble
+    if args.tta is not None:
+        fn = TTA(fn, args.tta)
+    if args.tile_size is not None:
+        fn = SlidingWindow(fn, tile_size=args.tile_size, overlap=args.overlap,
+                           batch_tiles=args.batch_tiles)
+    predictor = Predictor(ensemble, fn)
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = os.path.join("test_out", "ensemble")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    print("Write Segmaps to : {}".format(out_dir))
+
+    def read(img_path):
+        img = cv.imread(img_path, cv.IMREAD_COLOR)
+        return cv.cvtColor(img, cv.COLOR_BGR2RGB)
+
+    def predict(imgs):
+        img = torch.from_numpy(np.stack(imgs))
+        if device.type == "cuda":
+            img = img.pin_memory()
+        images = img.to(device, non_blocking=True).permute(0, 3, 1, 2).float()
+        if args.img_norm:
+            images = images / 255.0
+        # Fused on the device; only the label maps leave it
+        pred = predictor(images).argmax(1).to(torch.uint8).cpu().numpy()
+        return list(pred)
+
+    def write(img_path, pred):
+        decoded = loader.decode_segmap(pred)
+        out_path = os.path.join(out_dir, Path(img_path).name)
+        decoded_bgr = cv.cvtColor(decoded.astype(np.uint8), cv.COLOR_RGB2BGR)
+        cv.imwrite(out_path, decoded_bgr)
+
+    pipeline = InferencePipeline(read, predict, write,
+                                 batch_size=args.batch_size,
+                                 n_readers=args.n_readers,
+                                 n_writers=args.n_writers,
+                                 queue_size=args.queue_size)
+    with tqdm(total=len(IMG_Str)) as pbar:
+        pipeline.run(IMG_Str, progress=pbar.update)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Params")
+    parser.add_argument(
+        "--member",
+        nargs="+",
+        action="append",
+        required=True,
+        metavar="CONFIG MODEL_PATH [WEIGHT]",
+        help="One ensemble member, repeat for each model | weight 1 by default",
+    )
+    parser.add_argument(
+        "--dataset",
+        nargs="?",
+        type=str,
+        default="my",
+        help="Dataset to use ['pascal, camvid, ade20k etc']",
+    )
+
+    parser.add_argument(
+        "--img_norm",
+        dest="img_norm",
+        action="store_true",
+        help="Enable input image scales normalization [0, 1] \
+                              | True by default",
+    )
+    parser.add_argument(
+        "--no-img_norm",
+        dest="img_norm",
+        action="store_false",
+        help="Disable input image scales normalization [0, 1] |\
+                              True by default",
+    )
+    parser.set_defaults(img_norm=True)
+
+    parser.add_argument(
+        "--img_path", nargs="?", type=str,
+        default="dataset/17-15scale-aug/val", help="Path of the input image"
+    )
+    parser.add_argument(
+        "--out_dir",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Directory for the output segmaps | test_out/ensemble by default",
+    )
+    parser.add_argument("--devices", nargs="+", type=str, default=None,
+                        help="Devices to spread the members over | all GPUs by default")
+    parser.add_argument("--fuse", type=str, default="probs", choices=["probs", "logits"],
+                        help="Average softmax probabilities or raw logits")
+    parser.add_argument("--tta", nargs="+", type=str, default=None,
+                        help="TTA variants shared by all members, e.g. identity hflip")
+    parser.add_argument("--tile_size", nargs=2, type=int, default=None,
+                        help="Predict tile by tile (rows cols), shared by all members")
+    parser.add_argument("--overlap", type=float, default=0.25,
+                        help="Tile overlap fraction")
+    parser.add_argument("--batch_tiles", type=int, default=8,
+                        help="Tiles per forward pass")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Images per forward pass")
+    parser.add_argument("--n_readers", type=int, default=4,
+                        help="Image reading threads")
+    parser.add_argument("--n_writers", type=int, default=4,
+                        help="Segmap encoding / writing threads")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="Bound of the read and write queues")
+    parser.add_argument(
+        "--cudnn_benchmark",
+        dest="cudnn_benchmark",
+        action="store_true",
+        help="Enable cuDNN autotuning, pays off when image sizes repeat | \
+                              False by default",
+    )
+    args = parser.parse_args()
+    test(args)
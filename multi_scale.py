@@ -2,7 +2,6 @@ import sys, os
 import torch
 import argparse
 import timeit
-import numpy as np
 import scipy.misc as misc
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,10 +13,9 @@ from tqdm import tqdm
 from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
 from ptsemseg.utils import convert_state_dict
+from ptsemseg.inference import LogitStore
 
 import yaml
-from pathlib import Path
-import natsort
 
 
 def test(args,cfg):
@@ -48,69 +46,29 @@ def test(args,cfg):
     # model.eval()
     # model.to(device)
 
-    S2_Path=Path(args.img_path)
-    S2_File=natsort.natsorted(list(S2_Path.glob("*S2.pt")),alg=natsort.PATH)
-    S2_Str=[]
-    for i in S2_File:
-        S2_Str.append(str(i))
-
-    S175_Path = Path(args.img_path)
-    S175_File = natsort.natsorted(list(S175_Path.glob("*S175.pt")), alg=natsort.PATH)
-    S175_Str = []
-    for i in S175_File:
-        S175_Str.append(str(i))
-
-    S5_Path = Path(args.img_path)
-    S5_File = natsort.natsorted(list(S5_Path.glob("*S5_ave.pt")), alg=natsort.PATH)
-    S5_Str = []
-    for i in S5_File:
-        S5_Str.append(str(i))
-
-    S4_Path = Path(args.img_path)
-    S4_File = natsort.natsorted(list(S4_Path.glob("*S4d.pt")), alg=natsort.PATH)
-    S4_Str = []
-    for i in S4_File:
-        S4_Str.append(str(i))
-
-    S4_not_1_Path = Path(args.img_path)
-    S4_not_1_File = natsort.natsorted(list(S4_not_1_Path.glob("*S4_not_1.pt")), alg=natsort.PATH)
-    S4_not_1_Str = []
-    for i in S4_not_1_File:
-        S4_not_1_Str.append(str(i))
-
-    F_Path = Path(args.img_path)
-    F_File = natsort.natsorted(list(F_Path.glob("*F.pt")), alg=natsort.PATH)
-    F_Str = []
-    for i in F_File:
-        F_Str.append(str(i))
-
-    F_sum_Path = Path(args.img_path)
-    F_sum_File = natsort.natsorted(list(F_sum_Path.glob("*F_sum.pt")), alg=natsort.PATH)
-    F_sum_Str = []
-    for i in F_sum_File:
-        F_sum_Str.append(str(i))
-
-    R4_sum_Path = Path(args.img_path)
-    R4_sum_File = natsort.natsorted(list(R4_sum_Path.glob("*R4.pt")), alg=natsort.PATH)
-    R4_sum_Str = []
-    for i in R4_sum_File:
-        R4_sum_Str.append(str(i))
-
-    for j in tqdm(range(len(R4_sum_Str))):
-        parts=Path(R4_sum_Str[j]).stem.split('_')
-        parts.pop(-1)
-        icon='_'
-        img_name=icon.join(parts)
-        # multi_avg = torch.zeros((1, 6, 512, 512), dtype=torch.float32).to(device)
-        # sum=torch.load(S2_Str[j]).to(device)+torch.load(S175_Str[j]).to(device)+torch.load(S5_Str[j]).to(device)
-        # sum=torch.load(S4_not_1_Str[j]).to(device)+torch.load(F_sum_Str[j]).to(device)
-        # sum=torch.load(F_sum_Str[j]).to(device)+torch.load(S5_Str[j]).to(device)
-        sum=torch.load(R4_sum_Str[j]).to(device)
-        outputs=sum/4
-        pred = np.squeeze(outputs.data.max(1)[1].cpu().numpy(), axis=0)
+    store_path = args.store
+    if store_path is None:
+        store_path = os.path.join("test_out", os.path.basename(args.config)[:-4], "logits")
+    store = LogitStore(store_path)
+    variants = args.variants if args.variants is not None else store.variants()
+    print("Combining {} from : {}".format(variants, store_path))
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = os.path.join(store_path, "_".join(v.replace(":", "") for v in variants))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # One image and one variant in memory at a time; test_ms.py --early_exit
+    # leaves out the larger scales of confident images
+    images = store.images()
+    for img_name, outputs in tqdm(store.combine(variants, args.weights, device=device,
+                                                skip_missing=True),
+                                  total=len(images)):
+        pred = outputs.argmax(0).cpu().numpy()
 
         decoded = loader.decode_segmap(pred)
-        out_path="test_out/mv3_1_true_2_res50_data10_MS/R4_images/"+img_name+".png"
+        out_path = os.path.join(out_dir, img_name + ".png")
         misc.imsave(out_path, decoded)
 
     # print("Classes found: ", np.unique(pred))
@@ -167,15 +125,24 @@ if __name__ == "__main__":
     parser.set_defaults(dcrf=False)
 
     parser.add_argument(
-        "--img_path", nargs="?", type=str,
-        default="test_out/mv3_1_true_2_res50_data10_MS/rotate_tensors", help="Path of the input image"
+        "--store", nargs="?", type=str,
+        default=None, help="Logit store written by the test scripts | \
+                              test_out/<config name>/logits by default"
     )
     parser.add_argument(
-        "--out_path",
+        "--variants", nargs="+", type=str, default=None,
+        help="Variants to fuse, e.g. identity rot90 scale:0.75 | all by default"
+    )
+    parser.add_argument(
+        "--weights", nargs="+", type=float, default=None,
+        help="Weight of each variant | equal by default"
+    )
+    parser.add_argument(
+        "--out_dir",
         nargs="?",
         type=str,
-        default="tk.png",
-        help="Path of the output segmap",
+        default=None,
+        help="Directory of the output segmaps | <store>/<variants> by default",
     )
     parser.add_argument(
         "--config",
@@ -5,19 +5,26 @@ import shutil
 import natsort
 from glob import glob
 
+from ptsemseg.telemetry import locked_append
+
 def csv_out(id,dataset, model, epoch,rlt,val_scale):
-    ori = copy.copy(rlt)
-    rlt.sort(reverse=True)
+    ranked = sorted(rlt, reverse=True)
     rlt_csv = []
     idx_csv = []
     for i in range(0, 5):
-        rlt_csv.append("%.7f" % (rlt[i]))
-        idx_csv.append((ori.index(rlt[i])+1)*val_scale)
+        # Fewer than 5 validations: pad so the columns stay aligned
+        if i >= len(ranked):
+            rlt_csv.append("")
+            idx_csv.append("")
+            continue
+        rlt_csv.append("%.7f" % (ranked[i]))
+        idx_csv.append((rlt.index(ranked[i])+1)*val_scale)
 
     out_str = [id,dataset, model, epoch]
     out_str.extend(rlt_csv)
     out_str.extend(idx_csv)
-    with open("out.csv", 'a', newline='') as csvfile:
+    # Concurrent runs append to the same file
+    with locked_append("out.csv", newline='') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(out_str)
 
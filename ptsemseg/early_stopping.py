@@ -0,0 +1,83 @@
+import logging
+
+logger = logging.getLogger('ptsemseg')
+
+# Short names for the keys returned by runningScore.get_scores()
+key2metric = {'oa': "Overall Acc: \t",
+              'acc': "Overall Acc: \t",
+              'mean_acc': "Mean Acc : \t",
+              'fwavacc': "FreqW Acc : \t",
+              'miou': "Mean IoU : \t",
+              'iou': "Mean IoU : \t",
+              'f1': "Mean F1 : \t",}
+
+
+def _get_metric(score, name):
+    if name in score:
+        return score[name]
+    if name.lower() in key2metric:
+        return score[key2metric[name.lower()]]
+    for k, v in score.items():
+        if k.split(':')[0].strip().lower() == name.strip().lower():
+            return v
+    raise KeyError('Metric {} not in {}'.format(name, list(score.keys())))
+
+
+class EarlyStopping(object):
+    """Stops training once a validation metric stops improving.
+
+    :param metric: key (or short name, e.g. 'f1', 'oa', 'miou') of a metric
+        returned by runningScore.get_scores(); defaults to Overall Acc, the
+        metric the best checkpoint is chosen by
+    :param patience: number of validation rounds without improvement to wait
+    :param min_delta: minimum change that counts as an improvement
+    :param mode: 'max' if higher is better, 'min' otherwise
+    :param warmup_iters: never stop before this iteration
+    """
+    def __init__(self, metric='oa', patience=10, min_delta=0.0, mode='max',
+                 warmup_iters=0):
+        if mode not in ['max', 'min']:
+            raise ValueError('Early stopping mode {} not in [max, min]'.format(mode))
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode
+        self.warmup_iters = warmup_iters
+        self.best = None
+        self.best_iter = None
+        self.num_bad_rounds = 0
+
+    def _improved(self, value):
+        if self.best is None:
+            return True
+        if self.mode == 'max':
+            return value > self.best + self.min_delta
+        return value < self.best - self.min_delta
+
+    def step(self, score, it):
+        """Records one validation round, returns True if training should stop"""
+        value = _get_metric(score, self.metric)
+        if self._improved(value):
+            self.best = value
+            self.best_iter = it
+            self.num_bad_rounds = 0
+        else:
+            self.num_bad_rounds += 1
+
+        return it >= self.warmup_iters and self.num_bad_rounds >= self.patience
+
+    def state_dict(self):
+        return {k: v for k, v in self.__dict__.items()}
+
+    def load_state_dict(self, state_dict):
+        self.__dict__.update(state_dict)
+
+
+def get_early_stopping(cfg):
+    early_stop_dict = cfg['training'].get('early_stop', None)
+    if early_stop_dict is None:
+        logger.info('Using No Early Stopping')
+        return None
+
+    logger.info('Using Early Stopping with {} params'.format(early_stop_dict))
+    return EarlyStopping(**early_stop_dict)
@@ -0,0 +1,96 @@
+import logging
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('ptsemseg')
+
+
+class ModelEMA(object):
+    """Exponential moving average of a model's floating point weights.
+
+    The average covers parameters and float buffers (BN running stats) and
+    is updated in place with multi-tensor (foreach) ops when available.
+    swap() exchanges the storage of the model tensors and the averages,
+    which is O(1) per tensor, so the EMA weights can be evaluated or saved
+    through the model itself without copying it.
+
+    :param decay: EMA decay
+    :param warmup: ramp the decay up as min(decay, (1 + n) / (10 + n)) so
+        that early averages are not dominated by the initial weights
+    """
+    def __init__(self, model, decay=0.9998, warmup=True):
+        if isinstance(model, nn.DataParallel):
+            model = model.module
+        self.decay = decay
+        self.warmup = warmup
+        self.num_updates = 0
+        self.swapped_in = False
+        state = model.state_dict(keep_vars=True)
+        self.names = [k for k, t in state.items() if t.dtype.is_floating_point]
+        self.model_tensors = [state[k] for k in self.names]
+        self.shadow = [t.detach().clone() for t in self.model_tensors]
+
+    def get_decay(self):
+        if self.warmup:
+            return min(self.decay, (1.0 + self.num_updates) / (10.0 + self.num_updates))
+        return self.decay
+
+    def update(self):
+        if self.swapped_in:
+            raise RuntimeError('ModelEMA.update() called while EMA weights are swapped in')
+        self.num_updates += 1
+        decay = self.get_decay()
+        with torch.no_grad():
+            current = [t.detach() for t in self.model_tensors]
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(self.shadow, current, 1.0 - decay)
+            elif hasattr(torch, '_foreach_mul_'):
+                torch._foreach_mul_(self.shadow, decay)
+                torch._foreach_add_(self.shadow, current, alpha=1.0 - decay)
+            else:
+                for s, t in zip(self.shadow, current):
+                    s.mul_(decay).add_(t * (1.0 - decay))
+
+    def swap(self):
+        """Exchanges model weights and EMA weights in place"""
+        with torch.no_grad():
+            for idx, t in enumerate(self.model_tensors):
+                data = t.data
+                t.data = self.shadow[idx]
+                self.shadow[idx] = data
+        self.swapped_in = not self.swapped_in
+
+    def state_dict(self):
+        """EMA weights by state_dict key, whether or not they are swapped in,
+        and the update count the decay warmup depends on"""
+        ema = self.model_tensors if self.swapped_in else self.shadow
+        return {'num_updates': self.num_updates,
+                'shadow': {k: t.detach() for k, t in zip(self.names, ema)}}
+
+    def load_state_dict(self, state_dict):
+        self.num_updates = state_dict['num_updates']
+        ema = self.model_tensors if self.swapped_in else self.shadow
+        with torch.no_grad():
+            for k, t in zip(self.names, ema):
+                t.copy_(state_dict['shadow'][k])
+
+    @contextmanager
+    def swapped(self):
+        self.swap()
+        try:
+            yield
+        finally:
+            self.swap()
+
+
+def get_ema(cfg, model):
+    ema_dict = cfg['training'].get('ema', None)
+    if ema_dict is None:
+        return None
+
+    ema_dict = dict(ema_dict)
+    ema_dict.pop('eval', None)
+    logger.info('Using EMA of weights with {} params'.format(ema_dict))
+    return ModelEMA(model, **ema_dict)
@@ -0,0 +1,10 @@
+from ptsemseg.inference.tta import TTA, get_transform, key2transform
+from ptsemseg.inference.sliding_window import SlidingWindow, gaussian_window
+from ptsemseg.inference.pipeline import InferencePipeline
+from ptsemseg.inference.engine import (Predictor, inference_context, load_model,
+                                       prepare_model)
+from ptsemseg.inference.logit_store import LogitStore
+from ptsemseg.inference.multi_scale import MultiScale
+from ptsemseg.inference.adaptive import AdaptiveTTA, pixel_uncertainty
+from ptsemseg.inference.ensemble import Ensemble, load_ensemble
+from ptsemseg.inference.evaluator import Evaluator
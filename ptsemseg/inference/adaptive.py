@@ -0,0 +1,149 @@
+"""
+Confidence-gated test-time augmentation: extra passes only where needed
+"""
+import math
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.inference.tta import TTA, _resize
+
+logger = logging.getLogger('ptsemseg')
+
+
+def pixel_uncertainty(logits, measure='entropy'):
+    """Per-pixel uncertainty in [0, 1] from NCHW logits: normalized entropy
+    of the softmax, or 1 - (top-1 minus top-2 probability) for 'margin'"""
+    probs = F.softmax(logits.float(), dim=1)
+    if measure == 'entropy':
+        entropy = -(probs * probs.clamp(min=1e-12).log()).sum(1)
+        return entropy / math.log(probs.size(1))
+    if measure == 'margin':
+        top2 = probs.topk(2, dim=1)[0]
+        return 1.0 - (top2[:, 0] - top2[:, 1])
+    raise NotImplementedError('Uncertainty measure {} not implemented'.format(measure))
+
+
+def _overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+
+
+def _add_window(boxes, box):
+    """Disjoint (y0, y1, x0, x1) `boxes` plus `box`, merged with every box
+    it overlaps into their bounding box"""
+    boxes = list(boxes)
+    grown = True
+    while grown:
+        grown = False
+        for b in boxes:
+            if _overlap(b, box):
+                box = (min(b[0], box[0]), max(b[1], box[1]),
+                       min(b[2], box[2]), max(b[3], box[3]))
+                boxes.remove(b)
+                grown = True
+                break
+    return boxes + [box]
+
+
+class AdaptiveTTA(object):
+    """Runs the model once, then augments only the most uncertain tiles.
+
+    The first pass, resized to the input size, gives a per-pixel
+    uncertainty averaged over `tile_size` tiles. Tiles above `threshold`
+    (all tiles if None) are taken most uncertain first. Each one needs a
+    window of itself plus `context` pixels; overlapping windows are merged
+    into their bounding box, so adjacent tiles share one window and no
+    pixel is run twice. A tile is kept only while the windows' total area
+    stays within `budget` of the image area: the augmented passes cost at
+    most `budget` times those of full-image TTA over the same `transforms`,
+    1 + budget * len(transforms) forwards per image in total. A lone tile
+    costs (tile + 2 * context) pixels per side, so smaller budgets refine
+    nothing.
+
+    Windows run through the `transforms` in one batch per shape, and the
+    logits of the selected tiles are replaced by the mean of the first pass
+    and the augmented passes. `stats['passes']` counts model work in
+    full-image forwards.
+    """
+    def __init__(self, model, transforms=('hflip', 'vflip', 'rot90', 'rot270'),
+                 tile_size=(128, 128), context=64, measure='entropy',
+                 threshold=None, budget=0.25, max_batch=None):
+        self.model = model
+        self.tta = TTA(model, transforms, merge='sum', max_batch=max_batch)
+        self.tile_size = tuple(tile_size)
+        self.context = context
+        self.measure = measure
+        self.threshold = threshold
+        self.budget = budget
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'images': 0, 'tiles': 0, 'refined': 0, 'windows': 0, 'passes': 0.0}
+
+    def _tile_window(self, r, c, h, w):
+        th, tw = self.tile_size
+        return (max(r * th - self.context, 0), min((r + 1) * th + self.context, h),
+                max(c * tw - self.context, 0), min((c + 1) * tw + self.context, w))
+
+    def _select(self, uncertainty):
+        """Per image, the (row, col) of the tiles to refine and the windows
+        covering them"""
+        _, h, w = uncertainty.shape
+        th, tw = self.tile_size
+        tiles = F.avg_pool2d(uncertainty.unsqueeze(1), (th, tw), ceil_mode=True)[:, 0]
+        n, rows, cols = tiles.shape
+        self.stats['tiles'] += n * rows * cols
+        max_area = self.budget * h * w
+
+        selected = []
+        for i in range(n):
+            values, order = tiles[i].flatten().sort(descending=True)
+            if self.threshold is not None:
+                order = order[values > self.threshold]
+            chosen, boxes = [], []
+            for k in order.tolist():
+                r, c = k // cols, k % cols
+                grown = _add_window(boxes, self._tile_window(r, c, h, w))
+                if sum((y1 - y0) * (x1 - x0) for y0, y1, x0, x1 in grown) <= max_area:
+                    chosen.append((r, c))
+                    boxes = grown
+            selected.append((chosen, boxes))
+        return selected
+
+    def __call__(self, images):
+        n, _, h, w = images.shape
+        logits = _resize(self.model(images).float(), (h, w))
+        self.stats['images'] += n
+        self.stats['passes'] += n
+        if self.budget <= 0 or not self.tta.transforms:
+            return logits
+
+        selected = self._select(pixel_uncertainty(logits, self.measure))
+
+        # Windows of the same size share one batched TTA call
+        groups = {}
+        for i, (_, boxes) in enumerate(selected):
+            for y0, y1, x0, x1 in boxes:
+                groups.setdefault((y1 - y0, x1 - x0), []).append((i, y0, x0))
+        if not groups:
+            return logits
+
+        # Windows are disjoint, so their outputs fit in one image-sized buffer
+        summed = torch.zeros_like(logits)
+        n_variants = len(self.tta.transforms)
+        for (wh, ww), members in groups.items():
+            crops = torch.stack([images[i, :, y0:y0 + wh, x0:x0 + ww]
+                                 for i, y0, x0 in members])
+            for (i, y0, x0), out in zip(members, self.tta(crops).float()):
+                summed[i, :, y0:y0 + wh, x0:x0 + ww] = out
+            self.stats['passes'] += len(members) * n_variants * wh * ww / float(h * w)
+
+        th, tw = self.tile_size
+        mask = torch.zeros(n, 1, h, w, dtype=torch.bool, device=logits.device)
+        for i, (chosen, boxes) in enumerate(selected):
+            for r, c in chosen:
+                mask[i, :, r * th:(r + 1) * th, c * tw:(c + 1) * tw] = True
+            self.stats['refined'] += len(chosen)
+            self.stats['windows'] += len(boxes)
+        return torch.where(mask, (logits + summed) / (n_variants + 1), logits)
@@ -0,0 +1,64 @@
+"""
+Shared entry point for running models at inference time
+"""
+import logging
+
+import torch
+
+from ptsemseg.models import get_model
+from ptsemseg.utils import convert_state_dict
+from ptsemseg.memory_format import get_channels_last, to_channels_last
+
+logger = logging.getLogger('ptsemseg')
+
+
+def inference_context():
+    """torch.inference_mode where available, no_grad on older builds"""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def prepare_model(model, device, channels_last=False, cudnn_benchmark=False):
+    """Moves a model to `device` for inference: eval mode (BatchNorm uses its
+    running statistics, dropout is off), no parameter gradients and the
+    requested memory format. cuDNN autotuning pays off when input shapes
+    repeat, e.g. fixed-size tiles."""
+    model = model.to(device)
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    model = to_channels_last(model, channels_last)
+    if torch.device(device).type == 'cuda':
+        torch.backends.cudnn.benchmark = cudnn_benchmark
+    return model
+
+
+def load_model(cfg, model_path, n_classes, device, cudnn_benchmark=False):
+    """Builds cfg['model'] with get_model and loads a training checkpoint
+    (DataParallel prefixes are stripped), ready for inference"""
+    model = get_model(cfg['model'], n_classes)
+    checkpoint = torch.load(model_path, map_location='cpu')
+    state = convert_state_dict(checkpoint["model_state"])
+    model.load_state_dict(state)
+    logger.info('Loaded {} from {}'.format(cfg['model']['arch'], model_path))
+    return prepare_model(model, device, get_channels_last(cfg), cudnn_benchmark)
+
+
+class Predictor(object):
+    """Calls `fn` (the model, or e.g. a TTA / SlidingWindow around it) with
+    autograd off and `model` in eval mode on every call.
+
+    Outputs are inference tensors: read, copy or save them, but do not
+    modify them in place outside of a Predictor call.
+    """
+    def __init__(self, model, fn=None, channels_last=False):
+        self.model = model
+        self.fn = fn if fn is not None else model
+        self.channels_last = channels_last
+
+    def __call__(self, images):
+        if self.model.training:
+            self.model.eval()
+        with inference_context():
+            return self.fn(to_channels_last(images, self.channels_last))
@@ -0,0 +1,88 @@
+"""
+Ensembles of trained checkpoints with on-device, weighted fusion
+"""
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.inference.engine import load_model
+from ptsemseg.memory_format import get_channels_last, to_channels_last
+
+logger = logging.getLogger('ptsemseg')
+
+
+class Ensemble(object):
+    """Runs N models on the same batch and fuses their outputs.
+
+    Members are spread round-robin over `devices`. Forwards are issued to
+    every device before any output is read, so members on different GPUs
+    run concurrently; outputs are then moved to `output_device` and summed
+    with their weights. Wrap the ensemble in a TTA / SlidingWindow to share
+    augmentation and tiling between all members.
+
+    :param fuse: 'probs' averages softmax probabilities (models trained
+        separately are not calibrated alike), 'logits' averages raw logits
+    """
+    def __init__(self, models, weights=None, devices=None, fuse='probs',
+                 output_device=None, channels_last=None):
+        if fuse not in ['probs', 'logits']:
+            raise ValueError('Ensemble fuse {} not in [probs, logits]'.format(fuse))
+        self.weights = list(weights) if weights is not None else [1.0] * len(models)
+        if len(self.weights) != len(models):
+            raise ValueError('{} weights for {} models'.format(len(self.weights), len(models)))
+        if devices is None:
+            devices = [next(m.parameters()).device for m in models]
+        self.devices = [torch.device(devices[i % len(devices)]) for i in range(len(models))]
+        self.models = [m.to(d) for m, d in zip(models, self.devices)]
+        self.channels_last = channels_last or [False] * len(models)
+        self.fuse = fuse
+        self.output_device = torch.device(output_device) if output_device else self.devices[0]
+
+    def eval(self):
+        for m in self.models:
+            m.eval()
+        return self
+
+    @property
+    def training(self):
+        return any(m.training for m in self.models)
+
+    def __call__(self, images):
+        # Copy inputs once per device, then launch every member
+        inputs = {}
+        for d in set(self.devices):
+            inputs[d] = images.to(d, non_blocking=True)
+        outputs = []
+        for model, device, cl in zip(self.models, self.devices, self.channels_last):
+            outputs.append(model(to_channels_last(inputs[device], cl)))
+
+        fused = None
+        for y, w in zip(outputs, self.weights):
+            y = y.to(self.output_device, non_blocking=True).float()
+            if self.fuse == 'probs':
+                y = F.softmax(y, dim=1)
+            if fused is None:
+                fused = y * w
+            else:
+                fused.add_(y, alpha=w)
+        return fused / float(sum(self.weights))
+
+
+def load_ensemble(members, n_classes, devices=None, fuse='probs', cudnn_benchmark=False):
+    """Builds an Ensemble from a list of dicts with `cfg` (a parsed config),
+    `model_path` and optional `weight`; each checkpoint is loaded with
+    get_model / convert_state_dict onto its scheduled device."""
+    if not devices:
+        devices = ['cuda:{}'.format(i) for i in range(torch.cuda.device_count())] or ['cpu']
+    models, weights, placed, channels_last = [], [], [], []
+    for i, member in enumerate(members):
+        device = torch.device(devices[i % len(devices)])
+        models.append(load_model(member['cfg'], member['model_path'], n_classes, device,
+                                 cudnn_benchmark=cudnn_benchmark))
+        weights.append(member.get('weight', 1.0))
+        placed.append(device)
+        channels_last.append(get_channels_last(member['cfg']))
+        logger.info('Ensemble member {} ({}) on {} with weight {}'.format(
+            i, member['cfg']['model']['arch'], device, weights[-1]))
+    return Ensemble(models, weights, placed, fuse=fuse, channels_last=channels_last)
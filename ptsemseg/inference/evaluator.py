@@ -0,0 +1,68 @@
+"""
+Validation-split evaluation with predictions and scoring kept on the device
+"""
+import time
+import logging
+
+import torch
+
+from ptsemseg.metrics import torchRunningScore, stepTimer
+from ptsemseg.inference.engine import Predictor
+
+logger = logging.getLogger('ptsemseg')
+
+
+class Evaluator(object):
+    """Scores `fn` (the model, or a TTA / SlidingWindow around it) over a
+    DataLoader of (images, labels) batches.
+
+    Batches are copied to the device non-blocking, predicted under a
+    Predictor and accumulated into a torchRunningScore, so only the
+    confusion matrix reaches the host. run() also reports the time spent
+    in each phase: waiting on the loader ('data'), host to device copies
+    ('h2d'), inference ('forward', including argmax) and the confusion
+    matrix update ('metric').
+    """
+    phases = ('data', 'h2d', 'forward', 'metric')
+
+    def __init__(self, model, n_classes, device, fn=None, channels_last=False):
+        self.device = torch.device(device)
+        self.predictor = Predictor(model, fn, channels_last=channels_last)
+        self.metrics = torchRunningScore(n_classes, self.device)
+
+    def run(self, loader, progress=None):
+        """Returns (score, class_iou, timings); timings holds the seconds
+        spent per phase, 'total' and 'images'"""
+        self.metrics.reset()
+        timers = {phase: stepTimer(self.device) for phase in self.phases[1:]}
+        data_time, n_images = 0.0, 0
+
+        start = time.perf_counter()
+        ts = start
+        for images, labels in loader:
+            data_time += time.perf_counter() - ts
+
+            timers['h2d'].start()
+            images = images.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            timers['h2d'].stop()
+
+            timers['forward'].start()
+            pred = self.predictor(images).argmax(1)
+            timers['forward'].stop()
+
+            timers['metric'].start()
+            self.metrics.update(labels, pred)
+            timers['metric'].stop()
+
+            n_images += images.size(0)
+            if progress is not None:
+                progress(images.size(0))
+            ts = time.perf_counter()
+
+        score, class_iou = self.metrics.get_scores()
+        timings = {phase: sum(timer.flush()) for phase, timer in timers.items()}
+        timings['data'] = data_time
+        timings['total'] = time.perf_counter() - start
+        timings['images'] = n_images
+        return score, class_iou, timings
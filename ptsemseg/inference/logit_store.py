@@ -0,0 +1,198 @@
+"""
+Compact on-disk store of per-image, per-variant segmentation outputs
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ptsemseg.telemetry import locked_append
+
+logger = logging.getLogger('ptsemseg')
+
+# fp16: logits at half precision; uint8: softmax probabilities quantized to 1/255
+key2dtype = {'fp16': np.float16, 'uint8': np.uint8}
+
+
+def encode(logits, encoding):
+    """(K, H, W) logits -> numpy array in the store encoding"""
+    if encoding == 'fp16':
+        return logits.float().half().cpu().numpy()
+    probs = F.softmax(logits.float(), dim=0)
+    return (probs * 255).round_().to(torch.uint8).cpu().numpy()
+
+
+def decode(arr, encoding, device='cpu'):
+    """Stored array -> float32 tensor (logits for fp16, probabilities for uint8)"""
+    x = torch.from_numpy(np.ascontiguousarray(arr)).to(device)
+    if encoding == 'fp16':
+        return x.float()
+    return x.float() / 255.0
+
+
+class LogitStore(object):
+    """Per-image x per-variant outputs in chunked, memory-mapped files.
+
+    Layout of `root`:
+        store.json          n_classes and encoding
+        chunk_<pid>_<n>.bin raw arrays, appended by one writer process each
+        index.jsonl         one record per array: image, variant, chunk,
+                            byte offset, shape (the last record wins)
+
+    Arrays are written before their index records and index records are
+    appended under a file lock, so several scripts may fill the same store
+    at once. Reads map the chunk files and only touch the requested arrays.
+    """
+    def __init__(self, root, n_classes=None, encoding='fp16', chunk_mb=256):
+        if encoding not in key2dtype:
+            raise ValueError('Logit store encoding {} not in {}'.format(
+                encoding, sorted(key2dtype.keys())))
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        meta_path = os.path.join(root, 'store.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path) as fp:
+                meta = json.load(fp)
+            if n_classes is not None and meta['n_classes'] != n_classes:
+                raise ValueError('Store {} holds {} classes, not {}'.format(
+                    root, meta['n_classes'], n_classes))
+            if meta['encoding'] != encoding:
+                logger.info('Logit store {} uses {} encoding'.format(root, meta['encoding']))
+        else:
+            meta = {'n_classes': n_classes, 'encoding': encoding}
+            with open(meta_path, 'w') as fp:
+                json.dump(meta, fp)
+        self.n_classes = meta['n_classes']
+        self.encoding = meta['encoding']
+        self.dtype = key2dtype[self.encoding]
+
+        self.chunk_bytes = int(chunk_mb * 2 ** 20)
+        self.index = {}
+        self._pending = []
+        self._fp = None
+        self._chunk = None
+        self._n_chunks = 0
+        self._maps = {}
+        self.refresh()
+
+    # Writing
+
+    def _open_chunk(self):
+        if self._fp is not None:
+            self._fp.close()
+        self._chunk = 'chunk_{}_{}.bin'.format(os.getpid(), self._n_chunks)
+        while os.path.exists(os.path.join(self.root, self._chunk)):
+            self._n_chunks += 1
+            self._chunk = 'chunk_{}_{}.bin'.format(os.getpid(), self._n_chunks)
+        self._n_chunks += 1
+        self._fp = open(os.path.join(self.root, self._chunk), 'ab')
+
+    def put(self, image, variant, logits):
+        """Stores (K, H, W) or (1, K, H, W) logits of `image` under `variant`"""
+        if logits.dim() == 4:
+            if logits.size(0) != 1:
+                raise ValueError('put() takes one image, got a batch of {}'.format(logits.size(0)))
+            logits = logits[0]
+        arr = encode(logits, self.encoding)
+        if self._fp is None or self._fp.tell() + arr.nbytes > self.chunk_bytes:
+            self._open_chunk()
+        record = {'image': image, 'variant': variant, 'chunk': self._chunk,
+                  'offset': self._fp.tell(), 'shape': list(arr.shape)}
+        self._fp.write(arr.tobytes())
+        self._pending.append(record)
+        self.index[(image, variant)] = record
+        if len(self._pending) >= 64:
+            self.flush()
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+        if not self._pending:
+            return
+        with locked_append(os.path.join(self.root, 'index.jsonl')) as fp:
+            for record in self._pending:
+                fp.write(json.dumps(record, sort_keys=True) + '\n')
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._maps = {}
+
+    # Reading
+
+    def refresh(self):
+        """Re-reads the index, picking up arrays written by other processes"""
+        index_path = os.path.join(self.root, 'index.jsonl')
+        if not os.path.isfile(index_path):
+            return
+        with open(index_path) as fp:
+            for line in fp:
+                if line.strip():
+                    record = json.loads(line)
+                    self.index[(record['image'], record['variant'])] = record
+
+    def images(self):
+        return sorted(set(image for image, _ in self.index))
+
+    def variants(self, image=None):
+        return sorted(set(v for i, v in self.index if image is None or i == image))
+
+    def nbytes(self):
+        return sum(os.path.getsize(os.path.join(self.root, f))
+                   for f in os.listdir(self.root) if f.endswith('.bin'))
+
+    def _array(self, record):
+        nbytes = int(np.prod(record['shape'])) * np.dtype(self.dtype).itemsize
+        end = record['offset'] + nbytes
+        mm = self._maps.get(record['chunk'])
+        if mm is None or len(mm) < end:
+            mm = np.memmap(os.path.join(self.root, record['chunk']), dtype=np.uint8, mode='r')
+            self._maps[record['chunk']] = mm
+        return mm[record['offset']:end].view(self.dtype).reshape(record['shape'])
+
+    def get(self, image, variant, device='cpu'):
+        """Float32 (K, H, W) tensor: logits (fp16 store) or probabilities (uint8)"""
+        if self._pending:
+            self.flush()
+        try:
+            record = self.index[(image, variant)]
+        except KeyError:
+            raise KeyError('No {} output for image {} in {}'.format(variant, image, self.root))
+        return decode(self._array(record), self.encoding, device)
+
+    def fuse(self, image, variants=None, weights=None, device='cpu', skip_missing=False):
+        """Weighted mean of the chosen variants of one image, one array at a time.
+
+        With `skip_missing`, variants not stored for this image (e.g. scales
+        skipped by an early exit) are left out of the mean.
+        """
+        variants = variants if variants is not None else self.variants(image)
+        weights = weights if weights is not None else [1.0] * len(variants)
+        fused = None
+        total = 0.0
+        for variant, w in zip(variants, weights):
+            if skip_missing and (image, variant) not in self.index:
+                continue
+            x = self.get(image, variant, device)
+            if fused is None:
+                fused = x.mul_(w)
+            else:
+                fused.add_(x, alpha=w)
+            total += w
+        if fused is None:
+            raise KeyError('None of {} stored for image {}'.format(variants, image))
+        return fused / total
+
+    def combine(self, variants=None, weights=None, images=None, device='cpu',
+                skip_missing=False):
+        """Yields (image, fused) for every image, streaming through the store"""
+        for image in (images if images is not None else self.images()):
+            yield image, self.fuse(image, variants, weights, device, skip_missing)
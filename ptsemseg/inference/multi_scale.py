@@ -0,0 +1,113 @@
+"""
+Multi-scale inference with on-device resizing and confidence-based early exit
+"""
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger('ptsemseg')
+
+
+class MultiScale(object):
+    """Runs a model on resized copies of a batch and averages the logits.
+
+    Scales run cheapest first. The `exit_after` smallest scales are always
+    evaluated; if `exit_confidence` is set, images whose mean top-class
+    probability over those scales reaches it skip the remaining (larger,
+    costlier) scales. With `streams`, the scales of a round are issued on
+    separate CUDA streams so small-scale forwards can overlap.
+
+    :param size_divisor: round resized sides to a multiple of this, for
+        models that need e.g. multiples of 32
+    """
+    def __init__(self, model, scales=(0.5, 0.75, 1.25, 1.5), streams=False,
+                 exit_confidence=None, exit_after=None, size_divisor=None):
+        self.model = model
+        self.scales = sorted(scales)
+        self.streams = streams
+        self.exit_confidence = exit_confidence
+        if exit_after is None:
+            exit_after = max(1, len([s for s in self.scales if s <= 1]))
+        self.exit_after = min(exit_after, len(self.scales))
+        self.size_divisor = size_divisor
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'images': 0, 'forwards': 0, 'exited': 0}
+
+    def _size(self, size, scale):
+        size = [max(1, int(round(s * scale))) for s in size]
+        if self.size_divisor:
+            d = self.size_divisor
+            size = [max(d, int(round(s / float(d))) * d) for s in size]
+        return tuple(size)
+
+    def _forward(self, images, scale):
+        size = tuple(images.shape[2:])
+        scaled = self._size(size, scale)
+        x = images
+        if scaled != size:
+            x = F.interpolate(images, size=scaled, mode='bilinear', align_corners=False)
+        y = self.model(x)
+        if tuple(y.shape[2:]) != size:
+            y = F.interpolate(y, size=size, mode='bilinear', align_corners=False)
+        return y
+
+    def _forward_scales(self, images, scales):
+        if not (self.streams and images.is_cuda and len(scales) > 1):
+            return [self._forward(images, s) for s in scales]
+
+        current = torch.cuda.current_stream(images.device)
+        outputs = []
+        for s in scales:
+            stream = torch.cuda.Stream(images.device)
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream):
+                y = self._forward(images, s)
+            current.wait_stream(stream)
+            # y's memory was allocated on `stream` but is used on `current`
+            y.record_stream(current)
+            outputs.append(y)
+        return outputs
+
+    def variants(self, images):
+        """Returns {scale: (logits, image indices)} at the input size.
+
+        Scales skipped by the early exit only cover the images that were
+        still uncertain, listed in the index tensor.
+        """
+        n = images.size(0)
+        all_idx = torch.arange(n, device=images.device)
+        first, rest = self.scales[:self.exit_after], self.scales[self.exit_after:]
+
+        outputs = OrderedDict()
+        for s, y in zip(first, self._forward_scales(images, first)):
+            outputs[s] = (y, all_idx)
+
+        active = all_idx
+        if self.exit_confidence is not None and rest:
+            mean = sum(y for y, _ in outputs.values()) / float(len(first))
+            confidence = F.softmax(mean.float(), dim=1).max(1)[0].view(n, -1).mean(1)
+            active = all_idx[confidence < self.exit_confidence]
+
+        if len(active):
+            x = images if len(active) == n else images.index_select(0, active)
+            for s, y in zip(rest, self._forward_scales(x, rest)):
+                outputs[s] = (y, active)
+
+        self.stats['images'] += n
+        self.stats['forwards'] += n * len(first) + len(active) * len(rest)
+        self.stats['exited'] += n - len(active) if rest else 0
+        return outputs
+
+    def __call__(self, images):
+        fused = None
+        counts = images.new_zeros(images.size(0))
+        for y, idx in self.variants(images).values():
+            if fused is None:
+                fused = y.new_zeros((images.size(0),) + tuple(y.shape[1:])).float()
+            fused.index_add_(0, idx, y.float())
+            counts.index_add_(0, idx, torch.ones_like(idx, dtype=counts.dtype))
+        return fused / counts.view(-1, 1, 1, 1)
@@ -0,0 +1,123 @@
+"""
+Three-stage inference pipeline: reader pool -> batched prediction -> writer pool
+"""
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('ptsemseg')
+
+_done = object()
+
+
+class InferencePipeline(object):
+    """Overlaps disk reads, device inference and output encoding.
+
+    Reader threads call `read_fn(item)` and feed a bounded queue; the
+    calling thread groups same-shape inputs into batches of `batch_size`
+    and calls `predict_fn(inputs)`, which returns one output per input;
+    writer threads call `write_fn(item, output)` from a second bounded
+    queue. Image decoding / encoding in OpenCV releases the GIL, so the
+    pools run in parallel with the device.
+
+    :param queue_size: bound of both queues, in items
+    """
+    def __init__(self, read_fn, predict_fn, write_fn, batch_size=4,
+                 n_readers=4, n_writers=4, queue_size=16):
+        self.read_fn = read_fn
+        self.predict_fn = predict_fn
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self.n_readers = n_readers
+        self.n_writers = n_writers
+        self.queue_size = queue_size
+        self._errors = []
+
+    def _guard(self, fn):
+        def run(*args):
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception('Inference pipeline worker failed')
+                self._errors.append(e)
+        return run
+
+    def _reader(self, items, read_queue):
+        while not self._errors:
+            try:
+                item = items.get_nowait()
+            except queue.Empty:
+                break
+            read_queue.put((item, self.read_fn(item)))
+
+    def _writer(self, write_queue):
+        # Keeps draining after a failure so the producer never blocks
+        while True:
+            job = write_queue.get()
+            if job is _done:
+                return
+            if not self._errors:
+                self._guard(self.write_fn)(*job)
+
+    def _predict(self, batch, write_queue):
+        outputs = self.predict_fn([x for _, x in batch])
+        for (item, _), output in zip(batch, outputs):
+            write_queue.put((item, output))
+
+    def run(self, items, progress=None):
+        """Processes every item, returns the number written.
+
+        `progress`, if given, is called with the number of items in each
+        finished batch (e.g. tqdm's update).
+        """
+        items = list(items)
+        item_queue = queue.Queue()
+        for item in items:
+            item_queue.put(item)
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+
+        readers = [threading.Thread(target=self._guard(self._reader),
+                                    args=(item_queue, read_queue))
+                   for _ in range(self.n_readers)]
+        writers = [threading.Thread(target=self._writer, args=(write_queue,))
+                   for _ in range(self.n_writers)]
+        for t in readers + writers:
+            t.daemon = True
+            t.start()
+
+        pending = OrderedDict()
+        n_read = 0
+        try:
+            while n_read < len(items) and not self._errors:
+                try:
+                    item, x = read_queue.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(t.is_alive() for t in readers):
+                        break
+                    continue
+                n_read += 1
+                batch = pending.setdefault(getattr(x, 'shape', None), [])
+                batch.append((item, x))
+                if len(batch) == self.batch_size:
+                    del pending[getattr(x, 'shape', None)]
+                    self._predict(batch, write_queue)
+                    if progress is not None:
+                        progress(len(batch))
+            # Partial batches of every shape
+            for batch in pending.values():
+                if self._errors:
+                    break
+                self._predict(batch, write_queue)
+                if progress is not None:
+                    progress(len(batch))
+        finally:
+            for _ in writers:
+                write_queue.put(_done)
+            for t in writers:
+                t.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return n_read
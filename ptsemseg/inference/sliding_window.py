@@ -0,0 +1,117 @@
+"""
+Model-agnostic sliding-window (tiled) prediction on device
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def tile_starts(length, tile, stride):
+    """Start offsets covering [0, length) with the last tile flush to the end"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def gaussian_window(tile_size, sigma_scale=0.125, device=None):
+    """2D Gaussian weights peaking at the tile centre.
+
+    Pixels near tile borders see less context, so their predictions get
+    less weight where tiles overlap. Weights are kept strictly positive so
+    every pixel is covered.
+    """
+    windows = []
+    for n in tile_size:
+        sigma = max(n * sigma_scale, 1.0)
+        coords = torch.arange(n, dtype=torch.float32, device=device) - (n - 1) / 2.0
+        windows.append(torch.exp(-coords ** 2 / (2 * sigma ** 2)))
+    window = windows[0][:, None] * windows[1][None, :]
+    window = window / window.max()
+    return window.clamp(min=1e-3)
+
+
+key2window = {'gaussian': gaussian_window,
+              'constant': lambda tile_size, device=None: torch.ones(tile_size, device=device),}
+
+
+class SlidingWindow(object):
+    """Predicts images of any size from overlapping tiles.
+
+    Tiles of all images in the batch are stacked and run `batch_tiles` at a
+    time; each output is weighted by a window precomputed on the device and
+    accumulated, and the sum is normalized by the accumulated weights.
+    Images smaller than a tile are padded and cropped back.
+
+    :param model: any callable mapping NCHW images to NCHW logits, e.g. a
+        model from get_model or a TTA wrapping one
+    :param tile_size: (rows, cols) of the tiles fed to the model
+    :param overlap: fraction of a tile shared with its neighbour
+    :param window: 'gaussian' or 'constant' blending weights
+    :param probs: blend softmax probabilities instead of logits
+    """
+    def __init__(self, model, tile_size=(512, 512), overlap=0.25, batch_tiles=8,
+                 window='gaussian', probs=False):
+        if window not in key2window:
+            raise NotImplementedError('Window {} not implemented'.format(window))
+        if not 0 <= overlap < 1:
+            raise ValueError('Tile overlap must be in [0, 1), got {}'.format(overlap))
+        self.model = model
+        self.tile_size = tuple(tile_size)
+        self.stride = tuple(max(1, int(math.floor(t * (1 - overlap)))) for t in self.tile_size)
+        self.batch_tiles = batch_tiles
+        self.window = window
+        self.probs = probs
+        self._windows = {}
+
+    def _get_window(self, device):
+        if device not in self._windows:
+            self._windows[device] = key2window[self.window](self.tile_size, device=device)
+        return self._windows[device]
+
+    def _pad(self, images):
+        th, tw = self.tile_size
+        h, w = images.shape[2:]
+        pad_h, pad_w = max(th - h, 0), max(tw - w, 0)
+        if pad_h == 0 and pad_w == 0:
+            return images
+        mode = 'reflect' if pad_h < h and pad_w < w else 'constant'
+        return F.pad(images, (0, pad_w, 0, pad_h), mode=mode)
+
+    def tiles(self, shape):
+        """(row, col) offsets of every tile for an image of `shape` (rows, cols)"""
+        ys = tile_starts(shape[0], self.tile_size[0], self.stride[0])
+        xs = tile_starts(shape[1], self.tile_size[1], self.stride[1])
+        return [(y, x) for y in ys for x in xs]
+
+    def __call__(self, images):
+        n, _, h, w = images.shape
+        images = self._pad(images)
+        th, tw = self.tile_size
+        window = self._get_window(images.device)
+
+        jobs = [(i, y, x) for i in range(n) for y, x in self.tiles(images.shape[2:])]
+        scores = None
+        weights = images.new_zeros((1, 1) + tuple(images.shape[2:]))
+        for y, x in self.tiles(images.shape[2:]):
+            weights[:, :, y:y + th, x:x + tw] += window
+
+        for c in range(0, len(jobs), self.batch_tiles):
+            chunk = jobs[c:c + self.batch_tiles]
+            crops = torch.stack([images[i, :, y:y + th, x:x + tw] for i, y, x in chunk])
+            outputs = self.model(crops)
+            if tuple(outputs.shape[2:]) != self.tile_size:
+                outputs = F.interpolate(outputs, size=self.tile_size, mode='bilinear',
+                                        align_corners=False)
+            if self.probs:
+                outputs = F.softmax(outputs, dim=1)
+            outputs = outputs.float() * window
+            if scores is None:
+                scores = outputs.new_zeros((n, outputs.size(1)) + tuple(images.shape[2:]))
+            for (i, y, x), out in zip(chunk, outputs):
+                scores[i, :, y:y + th, x:x + tw] += out
+
+        scores /= weights
+        return scores[:, :, :h, :w]
@@ -0,0 +1,204 @@
+"""
+Batched test-time augmentation on NCHW tensors
+"""
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger('ptsemseg')
+
+
+def _resize(y, size):
+    # Models may predict below the input resolution: bring every view back
+    # to the input size so they can be merged
+    if tuple(y.shape[2:]) == tuple(size):
+        return y
+    return F.interpolate(y, size=size, mode='bilinear', align_corners=False)
+
+
+class Identity(object):
+    def __call__(self, x):
+        return x
+
+    def invert(self, y, size):
+        return _resize(y, size)
+
+
+class HFlip(object):
+    def __call__(self, x):
+        return x.flip(3)
+
+    def invert(self, y, size):
+        return _resize(y.flip(3), size)
+
+
+class VFlip(object):
+    def __call__(self, x):
+        return x.flip(2)
+
+    def invert(self, y, size):
+        return _resize(y.flip(2), size)
+
+
+class Transpose(object):
+    """Swaps rows and columns (mirror over the main diagonal)"""
+    def __call__(self, x):
+        return x.transpose(2, 3)
+
+    def invert(self, y, size):
+        return _resize(y.transpose(2, 3), size)
+
+
+def _rotate(x, k):
+    # Counter-clockwise rotation by k * 90 degrees using transpose / flip
+    k = k % 4
+    if k == 1:
+        return x.transpose(2, 3).flip(2)
+    if k == 2:
+        return x.flip(2).flip(3)
+    if k == 3:
+        return x.transpose(2, 3).flip(3)
+    return x
+
+
+class Rotate90(object):
+    """Counter-clockwise rotation by k * 90 degrees"""
+    def __init__(self, k=1):
+        self.k = k
+
+    def __call__(self, x):
+        return _rotate(x, self.k)
+
+    def invert(self, y, size):
+        return _resize(_rotate(y, -self.k), size)
+
+
+class Scale(object):
+    """Bilinear resize by `factor`; logits are resized back to the input size"""
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, x):
+        if self.factor == 1:
+            return x
+        size = (int(round(x.size(2) * self.factor)),
+                int(round(x.size(3) * self.factor)))
+        return F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+
+    def invert(self, y, size):
+        return _resize(y, size)
+
+
+class Chain(object):
+    """Applies transforms left to right, inverts them right to left"""
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+    def invert(self, y, size):
+        # every step is inverted to the size its input had
+        sizes = []
+        x_size = tuple(size)
+        for t in self.transforms:
+            sizes.append(x_size)
+            if isinstance(t, Scale) and t.factor != 1:
+                x_size = (int(round(x_size[0] * t.factor)),
+                          int(round(x_size[1] * t.factor)))
+            elif isinstance(t, Transpose) or (isinstance(t, Rotate90) and t.k % 2):
+                x_size = (x_size[1], x_size[0])
+        for t, s in zip(reversed(self.transforms), reversed(sizes)):
+            y = t.invert(y, s)
+        return y
+
+
+key2transform = {'identity': lambda: Identity(),
+                 'hflip': lambda: HFlip(),
+                 'vflip': lambda: VFlip(),
+                 'transpose': lambda: Transpose(),
+                 'rot90': lambda: Rotate90(1),
+                 'rot180': lambda: Rotate90(2),
+                 'rot270': lambda: Rotate90(3),
+                 'scale': lambda factor: Scale(float(factor)),}
+
+
+def get_transform(spec):
+    """Builds a transform from a spec such as 'hflip', 'scale:0.75' or
+    'hflip+scale:1.25' (applied left to right). Transform objects are
+    returned unchanged."""
+    if not isinstance(spec, str):
+        return spec
+    transforms = []
+    for part in spec.split('+'):
+        name, _, arg = part.strip().partition(':')
+        if name not in key2transform:
+            raise NotImplementedError('TTA transform {} not implemented'.format(name))
+        transforms.append(key2transform[name](arg) if arg else key2transform[name]())
+    return transforms[0] if len(transforms) == 1 else Chain(transforms)
+
+
+class TTA(object):
+    """Runs a model on several transformed copies of a batch and merges them.
+
+    Variants with the same shape are concatenated along the batch dimension
+    and go through the model in one forward pass (split into chunks of at
+    most `max_batch` images if given). Each output is mapped back with the
+    inverse transform, on the logits, before merging.
+
+    :param transforms: list of transforms or specs (see get_transform)
+    :param merge: 'mean', 'max' or 'sum'
+    :param probs: merge softmax probabilities instead of raw logits
+    """
+    def __init__(self, model, transforms=('identity', 'hflip'), merge='mean',
+                 probs=False, max_batch=None):
+        if merge not in ['mean', 'max', 'sum']:
+            raise ValueError('TTA merge {} not in [mean, max, sum]'.format(merge))
+        self.model = model
+        self.transforms = [get_transform(t) for t in transforms]
+        self.merge = merge
+        self.probs = probs
+        self.max_batch = max_batch
+
+    def _forward(self, x):
+        if self.max_batch is None or x.size(0) <= self.max_batch:
+            return self.model(x)
+        return torch.cat([self.model(c) for c in x.split(self.max_batch)])
+
+    def variants(self, images):
+        """Returns the logits of every transform, mapped back to `images`' frame"""
+        n = images.size(0)
+        size = tuple(images.shape[2:])
+
+        # Group transformed copies by shape: one forward per group
+        groups = OrderedDict()
+        for idx, t in enumerate(self.transforms):
+            x = t(images)
+            groups.setdefault(tuple(x.shape[2:]), []).append((idx, x))
+
+        outputs = [None] * len(self.transforms)
+        for members in groups.values():
+            batch = torch.cat([x for _, x in members])
+            logits = self._forward(batch)
+            for (idx, _), y in zip(members, logits.split(n)):
+                y = self.transforms[idx].invert(y, size)
+                outputs[idx] = F.softmax(y, dim=1) if self.probs else y
+        return outputs
+
+    def __call__(self, images):
+        outputs = self.variants(images)
+        if self.merge == 'max':
+            merged = outputs[0]
+            for y in outputs[1:]:
+                merged = torch.max(merged, y)
+            return merged
+        merged = outputs[0].clone()
+        for y in outputs[1:]:
+            merged += y
+        if self.merge == 'mean':
+            merged /= len(outputs)
+        return merged
@@ -1,4 +1,5 @@
 import os
+import time
 import collections
 import torch
 import torchvision
@@ -12,6 +13,11 @@ from ptsemseg.augmentations import *
 import cv2 as cv
 from torchvision import transforms
 
+# Decoded images shared by every myLoader instance in the process, keyed by
+# path. Filled by warm_cache() before DataLoader workers are forked, so the
+# workers of all runs in a sweep read it copy-on-write instead of decoding.
+_decoded_cache = {}
+
 
 class myLoader(data.Dataset):
     def __init__(
@@ -22,9 +28,11 @@ class myLoader(data.Dataset):
         img_size=512,
         augmentations=None,
         img_norm=True,
+        cache=False,
     ):
         self.root = root
         self.split = split
+        self.cache = cache
         self.img_size = (
             img_size if isinstance(img_size, tuple) else (img_size, img_size)
         )
@@ -49,22 +57,57 @@ class myLoader(data.Dataset):
     def __len__(self):
         return len(self.files[self.split])
 
-    def __getitem__(self, index):
+    def _paths(self, index):
         img_name = self.files[self.split][index]
         img_path = self.root + "/" + self.split + "/" + img_name
         lbl_path = self.root + "/" + self.split + "_labels/" + img_name
+        return img_path, lbl_path
+
+    def _read(self, img_path, lbl_path, times=None):
+        if img_path in _decoded_cache:
+            return _decoded_cache[img_path], _decoded_cache[lbl_path]
+
+        t0 = time.perf_counter()
+        img_buf = np.fromfile(img_path, dtype=np.uint8)
+        lbl_buf = np.fromfile(lbl_path, dtype=np.uint8)
+        t1 = time.perf_counter()
+        img = cv.cvtColor(cv.imdecode(img_buf, -1), cv.COLOR_BGR2RGB)
+        lbl = cv.imdecode(lbl_buf, -1)
+        if times is not None:
+            times["read"] = t1 - t0
+            times["decode"] = time.perf_counter() - t1
+
+        if self.cache:
+            _decoded_cache[img_path] = img
+            _decoded_cache[lbl_path] = lbl
+        return img, lbl
 
-        img = cv.cvtColor(cv.imread(img_path, -1), cv.COLOR_BGR2RGB)
-        lbl = cv.imread(lbl_path, -1)
+    def warm_cache(self):
+        """Decodes the whole split into the process-wide cache"""
+        for index in range(len(self)):
+            self._read(*self._paths(index))
+
+    def get_item_timed(self, index):
+        """__getitem__ that also returns the seconds spent in each stage"""
+        times = {"read": 0.0, "decode": 0.0, "augment": 0.0, "transform": 0.0}
+        img, lbl = self._read(*self._paths(index), times=times)
         # im = Image.open(im_path)
         # lbl = Image.open(lbl_path)
 
         if self.augmentations is not None:
+            t0 = time.perf_counter()
             img, lbl = self.augmentations(img, lbl)
+            times["augment"] = time.perf_counter() - t0
 
         if self.is_transform:
+            t0 = time.perf_counter()
             img, lbl = self.transform(img, lbl)
+            times["transform"] = time.perf_counter() - t0
+
+        return img, lbl, times
 
+    def __getitem__(self, index):
+        img, lbl, _ = self.get_item_timed(index)
         return img, lbl
 
     def transform(self, img, lbl):
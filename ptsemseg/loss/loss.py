@@ -18,8 +18,7 @@ def cross_entropy2d(input, target, weight=None, size_average=True):
     elif h != ht and w != wt:
         raise Exception("Only support upsampling")
 
-    input = input.transpose(1, 2).transpose(2, 3).contiguous().view(-1, c)
-    target = target.view(-1)
+    # cross_entropy takes NCHW input directly, avoiding a layout-changing copy
     loss = F.cross_entropy(
         input, target, weight=weight, size_average=size_average, ignore_index=250
     )
@@ -58,15 +57,12 @@ def bootstrapped_cross_entropy2d(input,
                                    weight=None,
                                    size_average=True):
 
-        n, c, h, w = input.size()
-        input = input.transpose(1, 2).transpose(2, 3).contiguous().view(-1, c)
-        target = target.view(-1)
         loss = F.cross_entropy(input, 
                                target, 
                                weight=weight, 
                                reduce=False,
                                size_average=False, 
-                               ignore_index=250)
+                               ignore_index=250).view(-1)
 
         topk_loss, _ = loss.topk(K)
         reduced_topk_loss = topk_loss.sum() / K
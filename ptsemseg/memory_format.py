@@ -0,0 +1,105 @@
+"""
+Channels-last (NHWC) memory format helpers
+"""
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('ptsemseg')
+
+
+def channels_last_available():
+    return hasattr(torch, 'channels_last')
+
+
+def to_channels_last(x, enabled=True):
+    """Converts a module or a 4D tensor to channels-last if enabled.
+
+    Other tensors, and everything on builds without channels-last support,
+    are returned unchanged.
+    """
+    if not enabled or not channels_last_available():
+        return x
+    if isinstance(x, nn.Module):
+        return x.to(memory_format=torch.channels_last)
+    if torch.is_tensor(x) and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def get_channels_last(cfg):
+    enabled = cfg.get('channels_last', False)
+    if enabled and not channels_last_available():
+        logger.warning('channels_last requested but not supported by this torch build')
+        return False
+    if enabled:
+        logger.info('Using channels_last memory format')
+    return enabled
+
+
+def _is_channels_last(t):
+    return (torch.is_tensor(t) and t.dim() == 4 and
+            t.is_contiguous(memory_format=torch.channels_last))
+
+
+def _tensors(obj):
+    if torch.is_tensor(obj):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for o in obj for t in _tensors(o)]
+    if isinstance(obj, dict):
+        return [t for o in obj.values() for t in _tensors(o)]
+    return []
+
+
+def audit_layout(model, images):
+    """Runs one forward pass and reports ops that drop channels-last layout.
+
+    An op is reported when one of its 4D inputs is channels-last and one of
+    its 4D outputs is not, i.e. it forced a conversion back to NCHW (or a
+    contiguous NCHW copy). Ops are attributed to the innermost module that
+    called them.
+
+    Returns an OrderedDict mapping "module_name: op_name" to the number of
+    offending calls.
+    """
+    from torch.overrides import TorchFunctionMode
+
+    stack = ['<model>']
+    found = OrderedDict()
+
+    class _LayoutMode(TorchFunctionMode):
+        def __torch_function__(self, func, types, args=(), kwargs=None):
+            kwargs = kwargs or {}
+            out = func(*args, **kwargs)
+            ins = [t for t in _tensors((args, kwargs)) if t.dim() == 4]
+            outs = [t for t in _tensors(out) if t.dim() == 4]
+            if (any(_is_channels_last(t) for t in ins) and
+                    any(not _is_channels_last(t) for t in outs)):
+                key = '{}: {}'.format(stack[-1], getattr(func, '__name__', str(func)))
+                found[key] = found.get(key, 0) + 1
+            return out
+
+    def _push(name):
+        def hook(module, inputs):
+            stack.append(name)
+        return hook
+
+    def _pop(module, inputs, outputs):
+        stack.pop()
+
+    handles = []
+    for name, module in model.named_modules():
+        if name:
+            handles.append(module.register_forward_pre_hook(_push(name)))
+            handles.append(module.register_forward_hook(_pop))
+
+    try:
+        with torch.no_grad(), _LayoutMode():
+            model(to_channels_last(images))
+    finally:
+        for h in handles:
+            h.remove()
+    return found
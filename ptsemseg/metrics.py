@@ -1,6 +1,8 @@
 # Adapted from score written by wkentaro
 # https://github.com/wkentaro/pytorch-fcn/blob/master/torchfcn/utils.py
 
+import time
+import torch
 import numpy as np
 
 
@@ -63,6 +65,37 @@ class runningScore(object):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
 
+class torchRunningScore(runningScore):
+    """runningScore backend that keeps the confusion matrix on device.
+
+    update() takes label/prediction tensors for a whole batch and builds the
+    histogram with a single bincount, so only the n_classes x n_classes
+    matrix is ever copied to the host (in get_scores).
+    """
+    def __init__(self, n_classes, device=None):
+        self.n_classes = n_classes
+        self.device = device
+        self.reset()
+
+    def update(self, label_trues, label_preds):
+        lt = label_trues.view(-1).long()
+        lp = label_preds.view(-1).long()
+        mask = (lt >= 0) & (lt < self.n_classes)
+        self.hist += torch.bincount(
+            self.n_classes * lt[mask] + lp[mask],
+            minlength=self.n_classes ** 2,
+        ).view(self.n_classes, self.n_classes)
+
+    def get_scores(self):
+        self.confusion_matrix = self.hist.cpu().numpy().astype(np.float64)
+        return super(torchRunningScore, self).get_scores()
+
+    def reset(self):
+        self.hist = torch.zeros((self.n_classes, self.n_classes),
+                                dtype=torch.long, device=self.device)
+        self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
+
+
 
 class averageMeter(object):
     """Computes and stores the average and current value"""
@@ -81,3 +114,70 @@ class averageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+
+class lossBuffer(object):
+    """Keeps per-step losses on device and fetches them in one transfer.
+
+    update() only detaches the loss, so no host sync happens per step;
+    flush() stacks everything buffered so far and returns a list of
+    (step, value) pairs.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.steps = []
+        self.losses = []
+
+    def update(self, step, loss):
+        self.steps.append(step)
+        self.losses.append(loss.detach())
+
+    def flush(self):
+        if not self.losses:
+            return []
+        values = torch.stack(self.losses).cpu().tolist()
+        out = list(zip(self.steps, values))
+        self.reset()
+        return out
+
+
+class stepTimer(object):
+    """Times training steps with CUDA events, or perf_counter on CPU.
+
+    Events are only resolved in flush(), which waits for the last recorded
+    step instead of synchronizing the device after every step.
+    """
+    def __init__(self, device):
+        self.use_cuda = torch.device(device).type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self.pending = []
+        self._start = None
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self):
+        self._start = self._mark()
+
+    def stop(self):
+        self.pending.append((self._start, self._mark()))
+        self._start = None
+
+    def flush(self):
+        """Returns the elapsed time in seconds of every step since the last flush"""
+        if not self.pending:
+            return []
+        if self.use_cuda:
+            self.pending[-1][1].synchronize()
+            times = [s.elapsed_time(e) / 1000.0 for s, e in self.pending]
+        else:
+            times = [e - s for s, e in self.pending]
+        self.pending = []
+        return times
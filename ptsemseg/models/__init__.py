@@ -27,6 +27,29 @@ from ptsemseg.models.MV3_1_true_2_res101 import MV3_1_true_2_ResNet101
 from ptsemseg.models.MVD3_1_true_2_os16 import MVD3_1_true_2_os16_ResNet50
 from ptsemseg.models.MV3_1_true_2_dropout import MV3_1_true_2_dropout_ResNet50
 
+key2model = {
+    "fcn32s": fcn32s,
+    "fcn8s": fcn8s,
+    "fcn16s": fcn16s,
+    "unet": unet,
+    "segnet": segnet,
+    "pspnet": pspnet,
+    "icnet": icnet,
+    "icnetBN": icnet,
+    "linknet": linknet,
+    "frrnA": frrn,
+    "frrnB": frrn,
+    "refinenet50": rf50,
+    "deeplabv3_os16_MG": DeepLabV3_MG,
+    "deeplabv3_os16_MG_plus": DeepLabV3_MG_plus,
+    # "deeplabv3":Res_Deeplab,
+    "mv3_res50": MVD3_1_true_2_os16_ResNet50,
+    # "mv2_res50": MV2_10_ResNet50,
+    "mv3_res101":MV3_1_true_2_ResNet101,
+    "mv3_dropout_res50":MV3_1_true_2_dropout_ResNet50,
+}
+
+
 def get_model(model_dict, n_classes):
     name = model_dict['arch']
     model = _get_model_instance(name)
@@ -84,27 +107,6 @@ def get_model(model_dict, n_classes):
 
 def _get_model_instance(name):
     try:
-        return {
-            "fcn32s": fcn32s,
-            "fcn8s": fcn8s,
-            "fcn16s": fcn16s,
-            "unet": unet,
-            "segnet": segnet,
-            "pspnet": pspnet,
-            "icnet": icnet,
-            "icnetBN": icnet,
-            "linknet": linknet,
-            "frrnA": frrn,
-            "frrnB": frrn,
-            "refinenet50": rf50,
-            "deeplabv3_os16_MG": DeepLabV3_MG,
-            "deeplabv3_os16_MG_plus": DeepLabV3_MG_plus,
-            # "deeplabv3":Res_Deeplab,
-            "mv3_res50": MVD3_1_true_2_os16_ResNet50,
-            # "mv2_res50": MV2_10_ResNet50,
-            "mv3_res101":MV3_1_true_2_ResNet101,
-            "mv3_dropout_res50":MV3_1_true_2_dropout_ResNet50,
-
-        }[name]
-    except:
-        raise("Model {} not available".format(name))
+        return key2model[name]
+    except KeyError:
+        raise NotImplementedError("Model {} not available".format(name))
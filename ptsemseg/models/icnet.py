@@ -3,7 +3,6 @@ import numpy as np
 import torch.nn as nn
 
 from math import ceil
-from torch.autograd import Variable
 
 from ptsemseg import caffe_pb2
 from ptsemseg.models.utils import *
@@ -424,76 +423,30 @@ class icnet(nn.Module):
 
     def tile_predict(self, imgs, include_flip_mode=True):
         """
-        Predict by takin overlapping tiles from the image.
-
-        Strides are adaptively computed from the imgs shape
-        and input size
+        Predict by taking overlapping tiles from the image.
 
         :param imgs: torch.Tensor with shape [N, C, H, W] in BGR format
-        :param side: int with side length of model input
-        :param n_classes: int with number of classes in seg output.
+        :param include_flip_mode: also average horizontally flipped tiles
+        :return: np.ndarray [N, n_classes, H, W] of class probabilities
         """
+        from ptsemseg.inference import TTA, SlidingWindow
 
-        side_x, side_y = self.input_size
-        n_classes = self.n_classes
-        n_samples, c, h, w = imgs.shape
-        # n = int(max(h,w) / float(side) + 1)
-        n_x = int(h / float(side_x) + 1)
-        n_y = int(w / float(side_y) + 1)
-        stride_x = (h - side_x) / float(n_x)
-        stride_y = (w - side_y) / float(n_y)
-
-        x_ends = [
-            [int(i * stride_x), int(i * stride_x) + side_x] for i in range(n_x + 1)
-        ]
-        y_ends = [
-            [int(i * stride_y), int(i * stride_y) + side_y] for i in range(n_y + 1)
-        ]
-
-        pred = np.zeros([n_samples, n_classes, h, w])
-        count = np.zeros([h, w])
-
-        slice_count = 0
-        for sx, ex in x_ends:
-            for sy, ey in y_ends:
-                slice_count += 1
-
-                imgs_slice = imgs[:, :, sx:ex, sy:ey]
-                if include_flip_mode:
-                    imgs_slice_flip = torch.from_numpy(
-                        np.copy(imgs_slice.cpu().numpy()[:, :, :, ::-1])
-                    ).float()
-
-                is_model_on_cuda = next(self.parameters()).is_cuda
-
-                inp = Variable(imgs_slice, volatile=True)
-                if include_flip_mode:
-                    flp = Variable(imgs_slice_flip, volatile=True)
-
-                if is_model_on_cuda:
-                    inp = inp.cuda()
-                    if include_flip_mode:
-                        flp = flp.cuda()
-
-                psub1 = F.softmax(self.forward(inp), dim=1).data.cpu().numpy()
-                if include_flip_mode:
-                    psub2 = F.softmax(self.forward(flp), dim=1).data.cpu().numpy()
-                    psub = (psub1 + psub2[:, :, :, ::-1]) / 2.0
-                else:
-                    psub = psub1
-
-                pred[:, :, sx:ex, sy:ey] = psub
-                count[sx:ex, sy:ey] += 1.0
-
-        score = (pred / count[None, None, ...]).astype(np.float32)
-        return score / np.expand_dims(score.sum(axis=1), axis=1)
+        device = next(self.parameters()).device
+        predictor = self
+        if include_flip_mode:
+            predictor = TTA(self, ['identity', 'hflip'], merge='mean', probs=True)
+        tiler = SlidingWindow(predictor, tile_size=self.input_size,
+                              window='constant', probs=not include_flip_mode)
+        with torch.no_grad():
+            score = tiler(imgs.float().to(device))
+        score = score / score.sum(dim=1, keepdim=True)
+        return score.cpu().numpy().astype(np.float32)
 
 
 # For Testing Purposes only
 if __name__ == "__main__":
     cd = 0
     import os
-    from torch.autograd import Variable
     import matplotlib.pyplot as plt
     import scipy.misc as m
     from ptsemseg.loader.cityscapes_loader import cityscapesLoader as cl
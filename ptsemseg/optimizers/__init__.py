@@ -1,7 +1,10 @@
 import copy
+import inspect
 import logging
 import functools
 
+import torch.distributed as dist
+
 from torch.optim import SGD
 from torch.optim import Adam
 from torch.optim import ASGD
@@ -20,6 +23,15 @@ key2opt =  {'sgd': SGD,
             'adagrad': Adagrad,
             'rmsprop': RMSprop,}
 
+# Optimizer config keys handled here instead of being passed to the
+# optimizer class
+group_keys = ['no_decay_norm_bias', 'backbone_lr_mult', 'backbone_prefixes',
+              'shard_state']
+
+# Top-level modules of the ResNet backbones (mv*, refinenet, deeplab)
+default_backbone_prefixes = ['conv1', 'bn1', 'layer1', 'layer2', 'layer3',
+                             'layer4', 'resnet']
+
 def get_optimizer(cfg):
     if cfg['training']['optimizer'] is None:
         logger.info("Using SGD optimizer")
@@ -32,3 +44,105 @@ def get_optimizer(cfg):
 
         logger.info('Using {} optimizer'.format(opt_name))
         return key2opt[opt_name]
+
+
+def get_optimizer_params(cfg):
+    opt_dict = cfg['training']['optimizer'] or {}
+    return {k: v for k, v in opt_dict.items()
+            if k != 'name' and k not in group_keys}
+
+
+def _supported_impl_params(optimizer_cls, optimizer_params):
+    """Drops `foreach` / `fused` if this torch build's optimizer lacks them"""
+    signature = inspect.signature(optimizer_cls.__init__).parameters
+    params = dict(optimizer_params)
+    for key in ['foreach', 'fused']:
+        if key in params and key not in signature:
+            logger.warning('{} does not support {}=, ignoring it'.format(
+                optimizer_cls.__name__, key))
+            params.pop(key)
+    return params
+
+
+def get_param_groups(model, cfg):
+    """Splits model parameters into optimizer groups by rule.
+
+    - no_decay_norm_bias: 1-D parameters (norm weights and all biases) get
+      no weight decay
+    - backbone_lr_mult: parameters of the top-level modules listed in
+      backbone_prefixes train with lr * backbone_lr_mult, the decoder
+      (fpa, GAU, RefineBlocks, ...) with the base lr
+    """
+    opt_dict = cfg['training']['optimizer'] or {}
+    no_decay = opt_dict.get('no_decay_norm_bias', False)
+    lr_mult = opt_dict.get('backbone_lr_mult', 1.0)
+    prefixes = opt_dict.get('backbone_prefixes', default_backbone_prefixes)
+
+    if not no_decay and lr_mult == 1.0:
+        return [p for p in model.parameters() if p.requires_grad]
+
+    groups = {}
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        if name.startswith('module.'):
+            name = name[7:]
+        is_backbone = lr_mult != 1.0 and name.split('.')[0] in prefixes
+        is_no_decay = no_decay and param.dim() <= 1
+        groups.setdefault((is_backbone, is_no_decay), []).append(param)
+
+    param_groups = []
+    for (is_backbone, is_no_decay), params in sorted(groups.items()):
+        group = {'params': params}
+        if is_backbone:
+            group['lr'] = opt_dict.get('lr', 1.0e-3) * lr_mult
+        if is_no_decay:
+            group['weight_decay'] = 0.0
+        logger.info('Param group (backbone={}, no_decay={}): {} tensors'.format(
+            is_backbone, is_no_decay, len(params)))
+        param_groups.append(group)
+    return param_groups
+
+
+def build_optimizer(cfg, model):
+    """Creates the configured optimizer over the grouped model parameters.
+
+    `foreach: True` / `fused: True` select the multi-tensor or fused
+    implementations where this torch build provides them, so one step
+    launches a few kernels instead of one per parameter tensor.
+
+    With `shard_state: True` the optimizer is wrapped in
+    ZeroRedundancyOptimizer, so each rank only holds the optimizer state
+    (e.g. momentum buffers) of its own parameter shard. This needs an
+    initialized process group (DistributedDataParallel training; train.py
+    uses DataParallel), and callers must consolidate_state_dict() before
+    saving the optimizer state.
+    """
+    optimizer_cls = get_optimizer(cfg)
+    optimizer_params = _supported_impl_params(optimizer_cls,
+                                              get_optimizer_params(cfg))
+    param_groups = get_param_groups(model, cfg)
+
+    opt_dict = cfg['training']['optimizer'] or {}
+    if opt_dict.get('shard_state', False):
+        if dist.is_available() and dist.is_initialized():
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            logger.info('Sharding optimizer state over {} ranks'.format(
+                dist.get_world_size()))
+            return ZeroRedundancyOptimizer(param_groups,
+                                           optimizer_class=optimizer_cls,
+                                           **optimizer_params)
+        raise ValueError('shard_state needs an initialized torch.distributed '
+                         'process group (DistributedDataParallel training)')
+
+    if optimizer_params.get('fused', False):
+        try:
+            return optimizer_cls(param_groups, **optimizer_params)
+        except (RuntimeError, ValueError) as e:
+            # e.g. fused kernels not available for these params' device
+            logger.warning('Fused {} unavailable ({}), using foreach'.format(
+                optimizer_cls.__name__, e))
+            optimizer_params.pop('fused')
+            optimizer_params['foreach'] = True
+
+    return optimizer_cls(param_groups, **optimizer_params)
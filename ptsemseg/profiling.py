@@ -0,0 +1,343 @@
+"""
+Per-module cost accounting: MACs, parameters, activation sizes and timings
+"""
+import copy
+import json
+import time
+import logging
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('ptsemseg')
+
+
+def _numel(shape):
+    return int(np.prod(shape)) if len(shape) else 1
+
+
+def _first_tensor(obj):
+    if torch.is_tensor(obj):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        for o in obj:
+            t = _first_tensor(o)
+            if t is not None:
+                return t
+    return None
+
+
+def _tensors(obj):
+    if torch.is_tensor(obj):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for o in obj for t in _tensors(o)]
+    if isinstance(obj, dict):
+        return [t for o in obj.values() for t in _tensors(o)]
+    return []
+
+
+def count_macs(module, inputs, output):
+    """Multiply-accumulates of one call of a leaf module.
+
+    Covers the layers the models are built from (conv, linear, norm,
+    pooling, upsampling); other modules and functional ops count as 0.
+    """
+    inp = _first_tensor(inputs)
+    out = _first_tensor(output)
+    if inp is None or out is None:
+        return 0
+
+    if isinstance(module, nn.Conv2d):
+        kernel = _numel(module.kernel_size) * module.in_channels // module.groups
+        return out.numel() * kernel
+    if isinstance(module, nn.ConvTranspose2d):
+        kernel = _numel(module.kernel_size) * module.out_channels // module.groups
+        return inp.numel() * kernel
+    if isinstance(module, nn.Linear):
+        return out.numel() * module.in_features
+    if isinstance(module, (nn.BatchNorm2d, nn.GroupNorm, nn.InstanceNorm2d)):
+        return out.numel()
+    if isinstance(module, (nn.MaxPool2d, nn.AvgPool2d)):
+        kernel = module.kernel_size
+        kernel = _numel(kernel) if isinstance(kernel, (tuple, list)) else kernel ** 2
+        return out.numel() * kernel
+    if isinstance(module, (nn.AdaptiveAvgPool2d, nn.AdaptiveMaxPool2d)):
+        return inp.numel()
+    if isinstance(module, (nn.Upsample, nn.UpsamplingBilinear2d)):
+        return out.numel() * 4
+    return 0
+
+
+def tensor_bytes(obj):
+    return sum(t.numel() * t.element_size() for t in _tensors(obj))
+
+
+class layerProfiler(object):
+    """Hooks every submodule of a model and records its cost.
+
+    Per module: calls, forward / backward wall time (inclusive of children
+    and of functional ops called in its forward), MACs (own leaf layers
+    plus children), parameter count, output activation bytes and output
+    shape. Timing synchronizes the device around every module, so totals
+    are slower than an unprofiled run but the split between modules holds.
+    Backward time runs from the module's full backward pre-hook to its full
+    backward hook; while profiling, in-place modules are switched to
+    out-of-place and the model input is made to require grad.
+
+    Usage:
+        with layerProfiler(model) as prof:
+            loss = model(images).sum(); loss.backward()
+        prof.print_table()
+        prof.export_chrome_trace('trace.json')
+    """
+    def __init__(self, model, backward=True):
+        self.model = model
+        self.backward = backward
+        self.handles = []
+        self.stats = OrderedDict()
+        self.events = []
+        self.origin = None
+        self._starts = {}
+        self._backward_starts = {}
+        self._inplace = []
+
+        for name, module in model.named_modules():
+            name = name or '<model>'
+            self.stats[name] = {
+                'name': name,
+                'type': type(module).__name__,
+                'depth': 0 if name == '<model>' else name.count('.') + 1,
+                'is_leaf': len(list(module.children())) == 0,
+                'calls': 0,
+                'forward_s': 0.0,
+                'backward_s': 0.0,
+                'macs': 0,
+                'params': sum(p.numel() for p in module.parameters()),
+                'activation_bytes': 0,
+                'output_shape': None,
+            }
+
+    def _sync(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def _now(self):
+        self._sync()
+        return time.perf_counter()
+
+    def _event(self, name, phase, start, end):
+        self.events.append({'name': name, 'cat': phase, 'ph': 'X', 'pid': 0,
+                            'tid': 0 if phase == 'forward' else 1,
+                            'ts': (start - self.origin) * 1e6,
+                            'dur': (end - start) * 1e6})
+
+    def _pre_hook(self, name):
+        def hook(_, inputs):
+            self._starts[name] = self._now()
+            if name == '<model>' and self.backward and torch.is_grad_enabled():
+                # Inputs that need no grad would fire the first layer's
+                # backward hook before its weight grads are computed
+                return tuple(t.detach().requires_grad_()
+                             if torch.is_tensor(t) and t.is_floating_point() and
+                             not t.requires_grad else t for t in inputs)
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            end = self._now()
+            start = self._starts.pop(name, end)
+            st = self.stats[name]
+            st['calls'] += 1
+            st['forward_s'] += end - start
+            st['activation_bytes'] += tensor_bytes(output)
+            out = _first_tensor(output)
+            if out is not None:
+                st['output_shape'] = list(out.shape)
+            if st['is_leaf']:
+                st['macs'] += count_macs(module, inputs, output)
+            self._event(name, 'forward', start, end)
+        return hook
+
+    def _backward_pre_hook(self, name):
+        # grad w.r.t. the output arrives when this module's backward starts
+        def hook(*_):
+            self._backward_starts.setdefault(name, []).append(self._now())
+        return hook
+
+    def _backward_hook(self, name):
+        # and grad w.r.t. its inputs once all of it is done
+        def hook(*_):
+            starts = self._backward_starts.get(name)
+            if not starts:
+                return
+            start, end = starts.pop(), self._now()
+            self.stats[name]['backward_s'] += end - start
+            self._event(name, 'backward', start, end)
+        return hook
+
+    def __enter__(self):
+        self.origin = self._now()
+        if self.backward and not hasattr(nn.Module, 'register_full_backward_pre_hook'):
+            logger.warning('Backward timing needs torch >= 2.0, profiling forward only')
+            self.backward = False
+        for name, module in self.model.named_modules():
+            name = name or '<model>'
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._hook(name)))
+            if not self.backward:
+                continue
+            self.handles.append(module.register_full_backward_pre_hook(
+                self._backward_pre_hook(name)))
+            self.handles.append(module.register_full_backward_hook(
+                self._backward_hook(name)))
+            # Backward hooks forbid modifying a module's output in place
+            if getattr(module, 'inplace', False) is True:
+                module.inplace = False
+                self._inplace.append(module)
+        return self
+
+    def __exit__(self, *args):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        for module in self._inplace:
+            module.inplace = True
+        self._inplace = []
+        self._backward_starts.clear()
+        self._accumulate_macs()
+
+    def _accumulate_macs(self):
+        # Containers report the MACs of all their leaf layers
+        leaves = [(n, st['macs']) for n, st in self.stats.items() if st['is_leaf']]
+        for name, st in self.stats.items():
+            if st['is_leaf']:
+                continue
+            prefix = '' if name == '<model>' else name + '.'
+            st['macs'] = sum(m for n, m in leaves if n.startswith(prefix))
+
+    def table(self, sort_by='forward_s', max_depth=None):
+        rows = [st for st in self.stats.values() if st['calls'] > 0 and
+                (max_depth is None or st['depth'] <= max_depth)]
+        return sorted(rows, key=lambda st: st[sort_by], reverse=True)
+
+    def print_table(self, sort_by='forward_s', max_depth=None, limit=None):
+        rows = self.table(sort_by, max_depth)[:limit]
+        fmt = "{:<40} {:<22} {:>9} {:>9} {:>10} {:>10} {:>10}  {}"
+        print(fmt.format('module', 'type', 'fwd ms', 'bwd ms', 'GFLOPs',
+                         'params(M)', 'act MB', 'output'))
+        for st in rows:
+            print(fmt.format(st['name'][:40], st['type'][:22],
+                             '{:.2f}'.format(st['forward_s'] * 1000),
+                             '{:.2f}'.format(st['backward_s'] * 1000),
+                             '{:.3f}'.format(2 * st['macs'] / 1e9),
+                             '{:.3f}'.format(st['params'] / 1e6),
+                             '{:.2f}'.format(st['activation_bytes'] / 2.0 ** 20),
+                             st['output_shape']))
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.events}, fp)
+
+
+try:
+    from torch.utils._python_dispatch import TorchDispatchMode
+except ImportError:
+    TorchDispatchMode = None
+
+if TorchDispatchMode is not None:
+    class _liveTensorTracker(TorchDispatchMode):
+        """Tracks bytes of live op outputs to find the activation peak.
+
+        Only tensors owning their storage are counted (views are free) and a
+        tensor is released when its Python object is collected, so the peak
+        is an estimate of what the caching allocator would have to hold.
+        """
+        def __init__(self, base_bytes=0):
+            super(_liveTensorTracker, self).__init__()
+            self.live = base_bytes
+            self.peak = base_bytes
+            self._seen = set()
+
+        def _release(self, key, nbytes):
+            self.live -= nbytes
+            self._seen.discard(key)
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            out = func(*args, **(kwargs or {}))
+            for t in _tensors(out):
+                if t._base is not None or id(t) in self._seen:
+                    continue
+                nbytes = t.numel() * t.element_size()
+                self._seen.add(id(t))
+                self.live += nbytes
+                weakref.finalize(t, self._release, id(t), nbytes)
+            self.peak = max(self.peak, self.live)
+            return out
+else:
+    _liveTensorTracker = None
+
+
+def _analyze_on(model, images):
+    macs = [0]
+    activation_bytes = [0]
+    handles = []
+
+    def hook(module, inputs, output):
+        macs[0] += count_macs(module, inputs, output)
+        activation_bytes[0] += tensor_bytes(output)
+
+    for module in model.modules():
+        if len(list(module.children())) == 0:
+            handles.append(module.register_forward_hook(hook))
+
+    peak = None
+    try:
+        with torch.no_grad():
+            if _liveTensorTracker is not None:
+                with _liveTensorTracker(tensor_bytes(images)) as tracker:
+                    output = model(images)
+                    del output
+                peak = tracker.peak
+            else:
+                model(images)
+    finally:
+        for h in handles:
+            h.remove()
+    return macs[0], activation_bytes[0], peak
+
+
+def analyze_model(model, img_size, batch_size=1, in_channels=3, device='meta'):
+    """Static cost of one inference pass at `img_size` (rows, cols).
+
+    Shapes are propagated on the meta device, so nothing is computed and no
+    GPU is needed; models whose forward does not run on meta tensors (host
+    syncs, numpy calls) are run on the CPU instead. Returns MACs, parameter
+    count, the sum of all leaf-layer outputs (what training keeps for
+    backward, roughly) and the peak of simultaneously live activations.
+    """
+    rows, cols = img_size
+    model.eval()
+    params = sum(p.numel() for p in model.parameters())
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+
+    devices = [device, 'cpu'] if device != 'cpu' else ['cpu']
+    for i, dev in enumerate(devices):
+        try:
+            # meta tensors cannot be copied back, keep the original intact
+            target = copy.deepcopy(model).to(dev) if dev == 'meta' else model.to(dev)
+            images = torch.zeros(batch_size, in_channels, rows, cols, device=dev)
+            macs, activation_bytes, peak = _analyze_on(target, images)
+            break
+        except Exception:
+            if i == len(devices) - 1:
+                raise
+    return {'macs': macs,
+            'params': params,
+            'param_bytes': param_bytes,
+            'activation_bytes': activation_bytes,
+            'peak_activation_bytes': peak,
+            'device': dev}
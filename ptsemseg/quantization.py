@@ -0,0 +1,236 @@
+"""
+Post-training static INT8 quantization for CPU inference
+"""
+import copy
+import json
+import logging
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+try:
+    import torch.ao.quantization as tq
+except ImportError:
+    import torch.quantization as tq
+
+try:
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    prepare_fx = convert_fx = None
+
+logger = logging.getLogger('ptsemseg')
+
+key2backend = {
+    'x86': 'x86',
+    'fbgemm': 'fbgemm',
+    'qnnpack': 'qnnpack',
+}
+
+
+def _set_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def fold_batchnorm(model, example_inputs):
+    """Folds every BatchNorm2d that directly consumes a Conv2d output into
+    the conv's weight and bias and replaces it with an Identity.
+
+    Conv -> BN pairs are found by running `example_inputs` with forward
+    hooks, so this works whatever the model's layout. Layers called more
+    than once with different partners are left alone. Returns the number of
+    folded pairs.
+    """
+    model.eval()
+    names = {m: n for n, m in model.named_modules()}
+    calls, pairs, last = {}, {}, {}
+
+    def conv_hook(m, inputs, output):
+        calls[m] = calls.get(m, 0) + 1
+        last['conv'], last['output'] = m, output
+
+    def bn_hook(m, inputs):
+        calls[m] = calls.get(m, 0) + 1
+        if last.get('output') is not None and inputs[0] is last['output']:
+            key = (last['conv'], m)
+            pairs[key] = pairs.get(key, 0) + 1
+
+    handles = []
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d):
+            handles.append(m.register_forward_hook(conv_hook))
+        elif isinstance(m, nn.BatchNorm2d):
+            handles.append(m.register_forward_pre_hook(bn_hook))
+    try:
+        with torch.no_grad():
+            model(example_inputs)
+    finally:
+        for h in handles:
+            h.remove()
+        last.clear()
+
+    n_folded = 0
+    for (conv, bn), n in pairs.items():
+        if calls[conv] != n or calls[bn] != n:
+            continue
+        _set_module(model, names[conv], fuse_conv_bn_eval(conv, bn))
+        _set_module(model, names[bn], nn.Identity())
+        n_folded += 1
+    logger.info('Folded {} BatchNorm layers'.format(n_folded))
+    return n_folded
+
+
+# Layers that run on quantized tensors between two quantized convolutions
+_passthrough = (nn.Identity, nn.ReLU, nn.ReLU6, nn.MaxPool2d, nn.Dropout, nn.Dropout2d)
+
+
+def _quantizable(m):
+    return isinstance(m, nn.Linear) or (isinstance(m, nn.Conv2d) and m.padding_mode == 'zeros')
+
+
+def _sequential_runs(model):
+    """Names of runs of consecutive nn.Sequential children that can stay
+    quantized from one layer to the next (conv, folded BN, relu, pooling)"""
+    runs = []
+    for name, seq in model.named_modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        prefix = name + '.' if name else ''
+        run = []
+        for child_name, child in list(seq.named_children()) + [(None, None)]:
+            if child is not None and (_quantizable(child) or isinstance(child, _passthrough)):
+                run.append((prefix + child_name, child))
+                continue
+            if any(_quantizable(m) for _, m in run):
+                runs.append([n for n, _ in run])
+            run = []
+    return runs
+
+
+class _QuantizedLayer(nn.Module):
+    """Quantizes the input of a layer and / or dequantizes its output, so
+    the functional code around it (additions, upsampling, concatenation)
+    keeps running in float"""
+    def __init__(self, module, quant=True, dequant=True):
+        super(_QuantizedLayer, self).__init__()
+        self.quant = tq.QuantStub() if quant else nn.Identity()
+        self.module = module
+        self.dequant = tq.DeQuantStub() if dequant else nn.Identity()
+
+    def forward(self, x):
+        return self.dequant(self.module(self.quant(x)))
+
+
+def _prepare_eager(model, example_inputs, backend, group=True):
+    fold_batchnorm(model, example_inputs)
+    qconfig = tq.get_default_qconfig(backend)
+    # A run inside an nn.Sequential is quantized on entry to its first layer
+    # and dequantized after its last; every other layer gets its own pair
+    runs = _sequential_runs(model) if group else []
+    grouped = set(n for run in runs for n in run)
+    singles = [n for n, m in model.named_modules() if _quantizable(m) and n not in grouped]
+    for run in runs:
+        for i, name in enumerate(run):
+            module = model.get_submodule(name)
+            if i == 0 or i == len(run) - 1:
+                module = _QuantizedLayer(module, quant=i == 0, dequant=i == len(run) - 1)
+                _set_module(model, name, module)
+            module.qconfig = qconfig
+    for name in singles:
+        layer = _QuantizedLayer(model.get_submodule(name))
+        layer.qconfig = qconfig
+        _set_module(model, name, layer)
+    logger.info('Quantizing {} layer runs and {} single layers in eager mode'.format(
+        len(runs), len(singles)))
+    return tq.prepare(model)
+
+
+def _prepare_fx(model, example_inputs, backend):
+    # FX fuses conv / bn / relu itself and quantizes the whole graph,
+    # including the additions and concatenations between layers
+    qconfig_mapping = tq.get_default_qconfig_mapping(backend)
+    return prepare_fx(model, qconfig_mapping, (example_inputs,))
+
+
+def _calibrate(prepared, calibration):
+    with torch.no_grad():
+        for images in calibration:
+            prepared(images)
+
+
+def _quantize_fx(model, calibration, backend):
+    prepared = _prepare_fx(model, calibration[0], backend)
+    _calibrate(prepared, calibration)
+    return convert_fx(prepared)
+
+
+def _quantize_eager(model, calibration, backend, group=True):
+    prepared = _prepare_eager(model, calibration[0], backend, group)
+    _calibrate(prepared, calibration)
+    quantized = tq.convert(prepared)
+    if group:
+        # A grouped layer called outside its Sequential gets a float input
+        with torch.no_grad():
+            quantized(calibration[0])
+    return quantized
+
+
+def quantize_model(model, calibration, backend='fbgemm', mode='fx'):
+    """Static INT8 quantization of a float model for CPU inference.
+
+    :param calibration: list of CPU image batches; observers record
+        activation ranges on each of them before conversion
+    :param mode: 'fx' traces the model into a graph and quantizes it end to
+        end; if tracing, calibration or conversion fails it falls back to
+        'eager', which folds BatchNorm and quantizes runs of conv / relu /
+        pooling layers inside nn.Sequential containers and every other conv
+        / linear layer on its own. Everything between them stays in float,
+        so eager mode may be no faster than the float model.
+    :returns: (quantized model, mode used)
+    """
+    if backend not in key2backend:
+        raise NotImplementedError('Quantization backend {} not implemented'.format(backend))
+    torch.backends.quantized.engine = key2backend[backend]
+    model = model.cpu().eval()
+
+    if mode == 'fx':
+        if prepare_fx is None:
+            logger.warning('FX quantization is not available, using eager mode')
+        else:
+            try:
+                return _quantize_fx(copy.deepcopy(model), calibration, backend), mode
+            except Exception as e:
+                logger.warning('FX quantization failed ({}), using eager mode'.format(
+                    str(e).split('\n')[0]))
+    logger.warning('Eager quantization keeps the code between quantized layers '
+                   'in float and may give no speedup, check the measured latency')
+    try:
+        return _quantize_eager(copy.deepcopy(model), calibration, backend), 'eager'
+    except Exception as e:
+        logger.warning('Grouped eager quantization failed ({}), quantizing layer by layer'.format(
+            str(e).split('\n')[0]))
+    return _quantize_eager(copy.deepcopy(model), calibration, backend, group=False), 'eager'
+
+
+def save_quantized(model, path, example_inputs, meta=None):
+    """Saves a TorchScript artifact (torch.jit.load, no ptsemseg needed)
+    when the model traces, a pickled module (torch.load) otherwise. The
+    traced graph is specialized to the size of `example_inputs`. `meta` is
+    written next to it as <path>.json."""
+    meta = dict(meta or {})
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_inputs)
+        torch.jit.save(traced, path)
+        meta['format'] = 'torchscript'
+        meta['input_size'] = list(example_inputs.shape[1:])
+    except Exception as e:
+        logger.warning('Tracing the quantized model failed ({}), pickling it'.format(
+            str(e).split('\n')[0]))
+        torch.save(model, path)
+        meta['format'] = 'pickle'
+    with open(path + '.json', 'w') as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+    logger.info('Saved quantized model to {}'.format(path))
+    return meta['format']
@@ -0,0 +1,187 @@
+"""
+Structured training telemetry: timestamped events written as JSON lines
+"""
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('ptsemseg')
+
+# Fallback when fcntl is unavailable: only serializes writers in this process
+_append_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked_append(path, **open_kwargs):
+    """Opens `path` for appending under an exclusive lock.
+
+    The lock is an flock on the file itself, so concurrent runs (processes,
+    or sweep threads with their own file handles) writing to the same
+    results file never interleave their lines.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'a', **open_kwargs) as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield fp
+                fp.flush()
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        else:
+            with _append_lock:
+                yield fp
+                fp.flush()
+
+
+def _to_json(v):
+    if torch.is_tensor(v):
+        return v.item() if v.numel() == 1 else v.tolist()
+    if hasattr(v, 'item') and hasattr(v, 'dtype'):
+        # numpy scalars
+        return v.item()
+    if isinstance(v, dict):
+        return {str(k): _to_json(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_to_json(x) for x in v]
+    return v
+
+
+class JsonlSink(object):
+    """Buffered JSONL writer flushed by a background thread.
+
+    Records are appended to an in-memory buffer and written every
+    `flush_interval` seconds, when the buffer holds `max_buffer` records,
+    and on close(). Each flush writes the whole buffer under locked_append.
+    """
+    def __init__(self, path, flush_interval=5.0, max_buffer=256):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='telemetry-flush')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def write(self, record):
+        with self._lock:
+            self.buffer.append(json.dumps(_to_json(record), sort_keys=True))
+            full = len(self.buffer) >= self.max_buffer
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self.buffer = self.buffer, []
+        if not lines:
+            return
+        try:
+            with locked_append(self.path) as fp:
+                fp.write('\n'.join(lines) + '\n')
+        except (IOError, OSError) as e:
+            logger.warning('Telemetry flush to {} failed: {}'.format(self.path, e))
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+
+class Telemetry(object):
+    """Emits timestamped events of one run.
+
+    Every event goes to the run's JSONL sink; numeric fields are mirrored to
+    the tensorboard `writer` as '<event>/<field>' scalars when a step is
+    given, except the names in `no_mirror` (already written elsewhere).
+    Records sent with result() are also appended to the shared results
+    store, which many runs may write to at once.
+    """
+    def __init__(self, sink, run_id, writer=None, results_path=None, no_mirror=()):
+        self.sink = sink
+        self.run_id = str(run_id)
+        self.writer = writer
+        self.results_path = results_path
+        self.no_mirror = set(no_mirror)
+
+    def _record(self, event, step, fields):
+        record = {'ts': time.time(), 'run_id': self.run_id, 'event': event}
+        if step is not None:
+            record['step'] = step
+        record.update(_to_json(fields))
+        return record
+
+    def emit(self, event, step=None, **fields):
+        record = self._record(event, step, fields)
+        if self.sink is not None:
+            self.sink.write(record)
+        if self.writer is not None and step is not None:
+            for k, v in record.items():
+                if k in ('ts', 'step') or isinstance(v, bool):
+                    continue
+                tag = '{}/{}'.format(event, k)
+                if isinstance(v, (int, float)) and tag not in self.no_mirror:
+                    self.writer.add_scalar(tag, v, step)
+
+    def result(self, step=None, **fields):
+        self.emit('result', step, **fields)
+        if self.results_path is not None:
+            with locked_append(self.results_path) as fp:
+                fp.write(json.dumps(self._record('result', step, fields),
+                                    sort_keys=True) + '\n')
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+
+
+def metric_fields(score):
+    """runningScore keys ("Mean F1 : \\t") as plain field names ("mean_f1")"""
+    return {k.split(':')[0].strip().lower().replace(' ', '_'): v
+            for k, v in score.items()}
+
+
+def get_telemetry(cfg, run_id, logdir, writer=None):
+    """Reads `training: telemetry:`, e.g.
+
+        telemetry:
+            path: telemetry.jsonl      # relative to the run's logdir
+            flush_interval: 5
+            results: results.jsonl     # shared across runs, None to disable
+
+    Set `telemetry: False` to turn events off.
+    """
+    # train.py writes every step's loss to tensorboard as loss/train_loss
+    no_mirror = ('train/loss',)
+    telemetry_dict = cfg['training'].get('telemetry', None)
+    if telemetry_dict is False:
+        return Telemetry(None, run_id, writer=writer, no_mirror=no_mirror)
+    telemetry_dict = telemetry_dict or {}
+
+    path = os.path.join(logdir, telemetry_dict.get('path', 'telemetry.jsonl'))
+    sink = JsonlSink(path,
+                     flush_interval=telemetry_dict.get('flush_interval', 5.0),
+                     max_buffer=telemetry_dict.get('max_buffer', 256))
+    logger.info('Writing telemetry to {}'.format(path))
+    return Telemetry(sink, run_id, writer=writer,
+                     results_path=telemetry_dict.get('results', 'results.jsonl'),
+                     no_mirror=no_mirror)
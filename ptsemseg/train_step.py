@@ -0,0 +1,195 @@
+import time
+import logging
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('ptsemseg')
+
+
+def _unwrap(model):
+    if isinstance(model, nn.DataParallel):
+        return model.module
+    return model
+
+
+class eagerStep(object):
+    """Plain forward / loss / backward / optimizer step"""
+    def __init__(self, model, loss_fn, optimizer):
+        self.model = model
+        self.loss_fn = loss_fn
+        self.optimizer = optimizer
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def __call__(self, images, labels):
+        self.zero_grad()
+        outputs = self.model(images)
+        loss = self.loss_fn(input=outputs, target=labels)
+        loss.backward()
+        self.optimizer.step()
+        return loss
+
+
+class compiledStep(eagerStep):
+    """Train step whose forward runs through torch.compile.
+
+    The compiled module shares its parameters with `model`, so checkpoints
+    saved from `model` keep their usual keys. A DataParallel wrapper is
+    bypassed, the step runs on the device holding the parameters. If
+    compilation fails and `fallback` is set the step continues in eager mode.
+    """
+    def __init__(self, model, loss_fn, optimizer, backend='inductor',
+                 mode=None, fullgraph=False, dynamic=None, fallback=True,
+                 report_graph_breaks=True):
+        super(compiledStep, self).__init__(model, loss_fn, optimizer)
+        self.eager_forward = model
+        self.fallback = fallback
+        self.report_graph_breaks = report_graph_breaks
+        self.compile_time = None
+
+        self.module = _unwrap(model)
+        self.model = torch.compile(self.module, backend=backend, mode=mode,
+                                   fullgraph=fullgraph, dynamic=dynamic)
+
+    def _report_graph_breaks(self, images):
+        # explain() runs a real forward pass, keep BN running stats untouched
+        buffers = {k: v.clone() for k, v in self.module.named_buffers()}
+        try:
+            import torch._dynamo
+            torch._dynamo.reset()
+            explanation = torch._dynamo.explain(self.module)(images)
+            logger.info('torch.compile: {} graph(s), {} graph break(s)'.format(
+                explanation.graph_count, explanation.graph_break_count))
+            for reason in explanation.break_reasons:
+                logger.info('Graph break: {}'.format(reason.reason))
+            torch._dynamo.reset()
+        except Exception as e:
+            logger.info('Could not collect graph breaks: {}'.format(e))
+        finally:
+            self.module.load_state_dict(buffers, strict=False)
+
+    def __call__(self, images, labels):
+        if self.compile_time is not None:
+            return super(compiledStep, self).__call__(images, labels)
+
+        if self.report_graph_breaks:
+            self._report_graph_breaks(images)
+
+        start_ts = time.perf_counter()
+        try:
+            loss = super(compiledStep, self).__call__(images, labels)
+            if images.is_cuda:
+                torch.cuda.synchronize()
+        except Exception as e:
+            if not self.fallback:
+                raise
+            logger.warning('torch.compile failed ({}), falling back to eager'.format(e))
+            self.model = self.eager_forward
+            loss = super(compiledStep, self).__call__(images, labels)
+        self.compile_time = time.perf_counter() - start_ts
+        logger.info('First (compiling) train step took {:.1f}s'.format(self.compile_time))
+        return loss
+
+
+class cudaGraphStep(eagerStep):
+    """Captures the whole train step in a CUDA graph and replays it.
+
+    Requires static input shapes (fixed img_rows x img_cols crops); batches
+    of another shape, such as a short last batch, run eagerly. The learning
+    rate is baked into the captured optimizer step, so only a constant LR
+    schedule is supported. The warm-up iterations before capture are real
+    training steps on the first batch.
+    """
+    def __init__(self, model, loss_fn, optimizer, warmup_iters=3):
+        super(cudaGraphStep, self).__init__(_unwrap(model), loss_fn, optimizer)
+        self.warmup_iters = warmup_iters
+        self.graph = None
+        self.compile_time = None
+
+    def _capture(self, images, labels):
+        start_ts = time.perf_counter()
+        self.static_images = images.clone()
+        self.static_labels = labels.clone()
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                super(cudaGraphStep, self).__call__(self.static_images,
+                                                    self.static_labels)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        self.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self.graph):
+            outputs = self.model(self.static_images)
+            self.static_loss = self.loss_fn(input=outputs,
+                                            target=self.static_labels)
+            self.static_loss.backward()
+            self.optimizer.step()
+        torch.cuda.synchronize()
+        self.compile_time = time.perf_counter() - start_ts
+        logger.info('Captured train step CUDA graph in {:.1f}s'.format(self.compile_time))
+
+    def zero_grad(self):
+        # Once captured, the graph's backward writes into the existing .grad
+        # tensors: eager steps must zero them in place, not free them
+        self.optimizer.zero_grad(set_to_none=self.graph is None)
+
+    def __call__(self, images, labels):
+        if self.graph is None:
+            self._capture(images, labels)
+        elif (images.shape != self.static_images.shape or
+              labels.shape != self.static_labels.shape):
+            return super(cudaGraphStep, self).__call__(images, labels)
+        else:
+            self.static_images.copy_(images)
+            self.static_labels.copy_(labels)
+        self.graph.replay()
+        # static_loss is overwritten by the next replay
+        return self.static_loss.detach().clone()
+
+
+def get_train_step(model, loss_fn, optimizer, compile_dict=None,
+                   lr_schedule=None):
+    """Builds the callable used for one training iteration.
+
+    :param compile_dict: `training: compile:` section of the config, with
+        `mode` one of 'eager', 'compile' or 'cudagraph'; the remaining keys
+        are passed to the step class.
+    """
+    if compile_dict is None:
+        return eagerStep(model, loss_fn, optimizer)
+
+    compile_dict = dict(compile_dict)
+    mode = compile_dict.pop('mode', 'compile')
+
+    if mode == 'eager':
+        return eagerStep(model, loss_fn, optimizer)
+
+    if mode == 'compile':
+        if not hasattr(torch, 'compile'):
+            logger.warning('torch.compile is not available, using eager train step')
+            return eagerStep(model, loss_fn, optimizer)
+        logger.info('Using compiled train step with {} params'.format(compile_dict))
+        return compiledStep(model, loss_fn, optimizer, **compile_dict)
+
+    if mode == 'cudagraph':
+        device = next(model.parameters()).device
+        if device.type != 'cuda' or not hasattr(torch.cuda, 'CUDAGraph'):
+            logger.warning('CUDA graphs need a CUDA device, using eager train step')
+            return eagerStep(model, loss_fn, optimizer)
+        if isinstance(model, nn.DataParallel) and len(model.device_ids) > 1:
+            logger.warning('CUDA graphs do not support multi-device DataParallel, '
+                           'using eager train step')
+            return eagerStep(model, loss_fn, optimizer)
+        if lr_schedule is not None:
+            logger.warning('CUDA graphs bake in the learning rate and need a '
+                           'constant lr_schedule, using eager train step')
+            return eagerStep(model, loss_fn, optimizer)
+        logger.info('Using CUDA graph train step with {} params'.format(compile_dict))
+        return cudaGraphStep(model, loss_fn, optimizer, **compile_dict)
+
+    raise NotImplementedError('Train step mode {} not implemented'.format(mode))
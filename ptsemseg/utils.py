@@ -4,6 +4,8 @@ Misc Utility functions
 import os
 import logging
 import datetime
+import itertools
+import threading
 import numpy as np
 
 from collections import OrderedDict
@@ -48,6 +50,22 @@ def convert_state_dict(state_dict):
     return new_state_dict
 
 
+_run_id_lock = threading.Lock()
+_run_id_counter = itertools.count()
+
+
+def get_run_id():
+    """Returns a run id unique across processes and threads.
+
+    Made of the start time, the process id and a per-process counter, so
+    concurrent runs (e.g. in a sweep) never share a run directory.
+    """
+    with _run_id_lock:
+        count = next(_run_id_counter)
+    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    return '{}_{}_{}'.format(ts, os.getpid(), count)
+
+
 def get_logger(logdir):
     logger = logging.getLogger('ptsemseg')
     ts = str(datetime.datetime.now()).split('.')[0].replace(" ", "_")
@@ -0,0 +1,143 @@
+import os
+import time
+import yaml
+import torch
+import argparse
+
+from torch.utils import data
+
+from tqdm import tqdm
+
+from ptsemseg.loader import get_loader
+from ptsemseg.metrics import runningScore
+from ptsemseg.inference import inference_context, load_model
+from ptsemseg.quantization import quantize_model, save_quantized
+
+
+def calibration_batches(loader, n_images, batch_size, seed=0):
+    """`n_images` random images of `loader` as CPU batches"""
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(loader), generator=generator)[:n_images].tolist()
+    calibloader = data.DataLoader(data.Subset(loader, indices), batch_size=batch_size)
+    return [images for images, _ in calibloader]
+
+
+def evaluate(model, valloader, n_classes, max_images=None):
+    running_metrics = runningScore(n_classes)
+    n_images, elapsed = 0, 0.0
+    with inference_context():
+        for images, labels in tqdm(valloader):
+            if max_images is not None and n_images >= max_images:
+                break
+            start_ts = time.perf_counter()
+            pred = model(images).argmax(1)
+            elapsed += time.perf_counter() - start_ts
+            running_metrics.update(labels.numpy(), pred.numpy())
+            n_images += images.size(0)
+    score, _ = running_metrics.get_scores()
+    return {'mean_iou': float(score["Mean IoU : \t"]),
+            'mean_f1': float(score["Mean F1 : \t"]),
+            'overall_acc': float(score["Overall Acc: \t"]),
+            'images_per_s': n_images / max(elapsed, 1e-12),
+            'ms_per_image': 1000 * elapsed / max(n_images, 1)}
+
+
+def quantize(cfg, args):
+
+    device = torch.device("cpu")
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # Setup Dataloaders
+    data_loader = get_loader(cfg['data']['dataset'])
+    data_path = cfg['data']['path']
+    img_size = (cfg['data']['img_rows'], cfg['data']['img_cols'])
+
+    c_loader = data_loader(data_path, split=cfg['data'][args.calib_split],
+                           is_transform=True, img_size=img_size)
+    v_loader = data_loader(data_path, split=cfg['data']['val_split'],
+                           is_transform=True, img_size=img_size)
+    n_classes = v_loader.n_classes
+    valloader = data.DataLoader(v_loader, batch_size=args.batch_size,
+                                num_workers=cfg['training']['n_workers'])
+
+    # Setup Model
+    model = load_model(cfg, args.model_path, n_classes, device)
+
+    calibration = calibration_batches(c_loader, args.calib_images, args.batch_size)
+    print("Calibrating on {} images from the {} split".format(
+        sum(b.size(0) for b in calibration), cfg['data'][args.calib_split]))
+    qmodel, mode = quantize_model(model, calibration, backend=args.backend, mode=args.mode)
+    print("Quantized {} ({} mode, {} backend)".format(cfg['model']['arch'], mode, args.backend))
+
+    float_rlt = evaluate(model, valloader, n_classes, args.eval_images)
+    int8_rlt = evaluate(qmodel, valloader, n_classes, args.eval_images)
+
+    fmt = "{:<12} {:>10} {:>10} {:>10}"
+    print(fmt.format("", "fp32", "int8", "delta"))
+    for k in ['mean_iou', 'mean_f1', 'overall_acc', 'images_per_s', 'ms_per_image']:
+        print(fmt.format(k, "{:.4f}".format(float_rlt[k]), "{:.4f}".format(int8_rlt[k]),
+                         "{:+.4f}".format(int8_rlt[k] - float_rlt[k])))
+    speedup = int8_rlt['images_per_s'] / float_rlt['images_per_s']
+    print("speedup      {:.2f}x".format(speedup))
+    if mode == 'eager' and speedup < 1:
+        print("Warning: the eager-mode INT8 model is slower than the float one, "
+              "the float code between its quantized layers dominates")
+
+    out_path = args.out_path
+    if out_path is None:
+        out_path = os.path.splitext(args.model_path)[0] + "_int8.pt"
+    meta = {'arch': cfg['model']['arch'], 'n_classes': n_classes,
+            'model_path': args.model_path, 'mode': mode, 'backend': args.backend,
+            'calib_images': args.calib_images, 'fp32': float_rlt, 'int8': int8_rlt}
+    artifact = save_quantized(qmodel, out_path, calibration[0][:1], meta)
+    print("Saved {} artifact to : {}".format(artifact, out_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparams")
+    parser.add_argument(
+        "--config",
+        nargs="?",
+        type=str,
+        default="configs/mv3_1_true_2_res50_data17.yml",
+        help="Config file to be used",
+    )
+    parser.add_argument(
+        "--model_path",
+        nargs="?",
+        type=str,
+        default="pretrain/data17/mv3_res50_my_best_model.pkl",
+        help="Path to the saved model",
+    )
+    parser.add_argument(
+        "--out_path",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Path of the quantized model | <model_path>_int8.pt by default",
+    )
+    parser.add_argument("--mode", type=str, default="fx", choices=["fx", "eager"],
+                        help="Whole-graph (FX) or per-layer (eager) quantization | \
+                              falls back to eager when FX quantization fails")
+    parser.add_argument("--backend", type=str, default="fbgemm",
+                        choices=["x86", "fbgemm", "qnnpack"],
+                        help="Quantized kernels, qnnpack on ARM")
+    parser.add_argument("--calib_images", type=int, default=64,
+                        help="Images used to calibrate activation ranges")
+    parser.add_argument("--calib_split", type=str, default="train_split",
+                        choices=["train_split", "val_split"],
+                        help="Split the calibration images are drawn from")
+    parser.add_argument("--eval_images", type=int, default=None,
+                        help="Validation images compared | all by default")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Images per batch")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="CPU threads | torch default by default")
+
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        cfg = yaml.load(fp)
+
+    quantize(cfg, args)
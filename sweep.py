@@ -0,0 +1,169 @@
+"""
+Runs a grid of training runs from one base config in a single process.
+
+Each device group gets a worker thread that pulls runs from a shared queue.
+Runs on the same worker reuse the DataLoaders (and their workers) when the
+data config matches, and with `data: cache: True` every run reads images
+from the decoded-data cache instead of decoding them again.
+
+    python sweep.py --config configs/mv3_1_true_2_res50_data17.yml \
+        --grid configs/sweep_lr.yml --devices 0 1
+
+The grid file maps dotted config keys to lists of values, e.g.
+
+    training.optimizer.lr: [1.0e-3, 5.0e-4]
+    model.arch: [mv3_res50, mv3_res101]
+    data.img_rows: [512, 384]
+
+Each run logs to its own run directory only (handlers filter on the worker
+thread). Seeding and model construction are serialized between workers and
+every run's shuffling uses its own generator, so a run's initialization and
+data order depend only on its `seed`; cuDNN autotuning still makes GPU
+results nondeterministic.
+"""
+import os
+import copy
+import yaml
+import queue
+import logging
+import argparse
+import itertools
+import threading
+import traceback
+
+import torch
+from tensorboardX import SummaryWriter
+
+from ptsemseg.utils import get_logger, get_run_id
+from train import train
+
+_logger_lock = threading.Lock()
+
+
+class threadFilter(logging.Filter):
+    """Passes only records logged from the thread that created the filter.
+
+    All runs log through the shared 'ptsemseg' logger, so each run's file
+    handler keeps just the lines of its own worker thread.
+    """
+    def __init__(self):
+        super(threadFilter, self).__init__()
+        self.ident = threading.get_ident()
+
+    def filter(self, record):
+        return record.thread == self.ident
+
+
+def set_by_path(cfg, path, value):
+    keys = path.split('.')
+    node = cfg
+    for k in keys[:-1]:
+        if node.get(k) is None:
+            node[k] = {}
+        node = node[k]
+    node[keys[-1]] = value
+
+
+def expand_grid(base_cfg, grid):
+    """Returns a list of (overrides, cfg) for every combination in `grid`"""
+    paths = sorted(grid.keys())
+    runs = []
+    for values in itertools.product(*[grid[p] for p in paths]):
+        overrides = dict(zip(paths, values))
+        cfg = copy.deepcopy(base_cfg)
+        for path, value in overrides.items():
+            set_by_path(cfg, path, value)
+        runs.append((overrides, cfg))
+    return runs
+
+
+def run_one(cfg, overrides, name, device_ids, loader_cache):
+    run_id = get_run_id()
+    logdir = os.path.join('runs', name, str(run_id))
+    writer = SummaryWriter(log_dir=logdir)
+    with open(os.path.join(logdir, name + '.yml'), 'w') as fp:
+        yaml.safe_dump(cfg, fp, default_flow_style=False)
+
+    with _logger_lock:
+        logger = get_logger(logdir)
+        handler = logger.handlers[-1]
+        handler.addFilter(threadFilter())
+    print('RUNDIR: {} devices: {} overrides: {}'.format(logdir, device_ids, overrides))
+    logger.info('Sweep run {} with overrides {}'.format(run_id, overrides))
+    try:
+        train(cfg, writer, logger, run_id, device_ids=device_ids,
+              loader_cache=loader_cache)
+    finally:
+        writer.close()
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def device_worker(device_ids, run_queue, name):
+    # The current device is per thread: CUDA events, streams and
+    # synchronize() calls in train() go to this group's first device
+    if torch.cuda.is_available():
+        torch.cuda.set_device(device_ids[0])
+    # Runs on one device group are sequential, so they can share loaders
+    loader_cache = {}
+    while True:
+        try:
+            overrides, cfg = run_queue.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            run_one(cfg, overrides, name, device_ids, loader_cache)
+        except Exception:
+            logging.getLogger('ptsemseg').error(
+                'Sweep run {} failed:\n{}'.format(overrides, traceback.format_exc()))
+            traceback.print_exc()
+        finally:
+            run_queue.task_done()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep")
+    parser.add_argument(
+        "--config",
+        nargs="?",
+        type=str,
+        default="configs/mv3_1_true_2_res50_data17.yml",
+        help="Base configuration file"
+    )
+    parser.add_argument(
+        "--grid",
+        nargs="?",
+        type=str,
+        required=True,
+        help="YAML file mapping dotted config keys to lists of values"
+    )
+    parser.add_argument(
+        "--devices",
+        nargs="+",
+        type=str,
+        default=["0"],
+        help="Device groups to run on, e.g. '0 1' (one run per GPU) or '0,1 2,3'"
+    )
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        base_cfg = yaml.safe_load(fp)
+    with open(args.grid) as fp:
+        grid = yaml.safe_load(fp)
+
+    name = os.path.basename(args.config)[:-4]
+    runs = expand_grid(base_cfg, grid)
+    print('Sweeping {} runs on devices {}'.format(len(runs), args.devices))
+
+    run_queue = queue.Queue()
+    for run in runs:
+        run_queue.put(run)
+
+    workers = []
+    for group in args.devices:
+        device_ids = [int(d) for d in group.split(',')]
+        t = threading.Thread(target=device_worker, args=(device_ids, run_queue, name))
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
@@ -3,17 +3,15 @@ import torch
 import argparse
 import timeit
 import numpy as np
-import scipy.misc as misc
 import torch.nn as nn
-import torch.nn.functional as F
 import torchvision.models as models
 
 from torch.utils import data
 from tqdm import tqdm
 
-from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
-from ptsemseg.utils import convert_state_dict
+from ptsemseg.memory_format import get_channels_last
+from ptsemseg.inference import InferencePipeline, Predictor, load_model
 
 import yaml
 from pathlib import Path
@@ -41,36 +39,49 @@ def test(args,cfg):
     n_classes = loader.n_classes
 
     # Setup Model
-    model = get_model(cfg['model'], n_classes)
-    state = convert_state_dict(torch.load(args.model_path)["model_state"])
-    # state=torch.load(args.model_path)["model_state"]
-    model.load_state_dict(state)
-    model.eval()
-    model.to(device)
-
-    for j in tqdm(range(len(IMG_Str))):
-        img_path=IMG_Str[j]
-        img = misc.imread(img_path)
-        # img = img[:, :, ::-1]
-        img = img.astype(np.float64)
+    model = load_model(cfg, args.model_path, n_classes, device,
+                       cudnn_benchmark=args.cudnn_benchmark)
+    channels_last = get_channels_last(cfg)
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = os.path.join("test_out", os.path.basename(args.config)[:-4])
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    print("Write Segmaps to : {}".format(out_dir))
+
+    predictor = Predictor(model, channels_last=channels_last)
+
+    def read(img_path):
+        # uint8 HWC RGB; conversion to float happens on the device
+        img = cv.imread(img_path, cv.IMREAD_COLOR)
+        return cv.cvtColor(img, cv.COLOR_BGR2RGB)
+
+    def predict(imgs):
+        img = torch.from_numpy(np.stack(imgs))
+        if device.type == "cuda":
+            img = img.pin_memory()
+        images = img.to(device, non_blocking=True).permute(0, 3, 1, 2).float()
         # img -= loader.mean
         if args.img_norm:
-            img = img.astype(float) / 255.0
-
-        # NHWC -> NCHW
-        img = img.transpose(2, 0, 1)
-        img = np.expand_dims(img, 0)
-        img = torch.from_numpy(img).float()
-        images = img.to(device)
-        outputs = model(images)
-        pred = np.squeeze(outputs.data.max(1)[1].cpu().numpy(), axis=0)
+            images = images / 255.0
+        pred = predictor(images).argmax(1).to(torch.uint8).cpu().numpy()
+        return list(pred)
 
+    def write(img_path, pred):
         decoded = loader.decode_segmap(pred)
-        out_path="test_out/mv3_1_true_2_res50_data17/"+Path(img_path).name
-        decoded_bgr = cv.cvtColor(decoded, cv.COLOR_RGB2BGR)
-        # misc.imsave(out_path, decoded)
+        out_path = os.path.join(out_dir, Path(img_path).name)
+        decoded_bgr = cv.cvtColor(decoded.astype(np.uint8), cv.COLOR_RGB2BGR)
         cv.imwrite(out_path, decoded_bgr)
 
+    pipeline = InferencePipeline(read, predict, write,
+                                 batch_size=args.batch_size,
+                                 n_readers=args.n_readers,
+                                 n_writers=args.n_writers,
+                                 queue_size=args.queue_size)
+    with tqdm(total=len(IMG_Str)) as pbar:
+        pipeline.run(IMG_Str, progress=pbar.update)
+
     # print("Classes found: ", np.unique(pred))
     # print("Segmentation Mask Saved at: {}".format(args.out_path))
 
@@ -135,6 +146,28 @@ if __name__ == "__main__":
         default="tk.png",
         help="Path of the output segmap",
     )
+    parser.add_argument(
+        "--out_dir",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Directory for the output segmaps | test_out/<config name> by default",
+    )
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Images per forward pass")
+    parser.add_argument("--n_readers", type=int, default=4,
+                        help="Image reading threads")
+    parser.add_argument("--n_writers", type=int, default=4,
+                        help="Segmap encoding / writing threads")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="Bound of the read and write queues")
+    parser.add_argument(
+        "--cudnn_benchmark",
+        dest="cudnn_benchmark",
+        action="store_true",
+        help="Enable cuDNN autotuning, pays off when image sizes repeat | \
+                              False by default",
+    )
     parser.add_argument(
         "--config",
         nargs="?",
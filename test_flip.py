@@ -11,9 +11,9 @@ import torchvision.models as models
 from torch.utils import data
 from tqdm import tqdm
 
-from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
-from ptsemseg.utils import convert_state_dict
+from ptsemseg.memory_format import get_channels_last
+from ptsemseg.inference import TTA, AdaptiveTTA, LogitStore, Predictor, load_model
 
 import yaml
 from pathlib import Path
@@ -45,56 +45,58 @@ def test(args,cfg):
     n_classes = loader.n_classes
 
     # Setup Model
-    model = get_model(cfg['model'], n_classes)
-    state = convert_state_dict(torch.load(args.model_path)["model_state"])
-    # state=torch.load(args.model_path)["model_state"]
-    model.load_state_dict(state)
-    model.eval()
-    model.to(device)
-
+    model = load_model(cfg, args.model_path, n_classes, device,
+                       cudnn_benchmark=args.cudnn_benchmark)
+    channels_last = get_channels_last(cfg)
+
+
+    store_path = args.store
+    if store_path is None:
+        store_path = os.path.join("test_out", os.path.basename(args.config)[:-4], "logits")
+    store = LogitStore(store_path, n_classes, args.encoding)
+    print("Write Logits to : {}".format(store_path))
+
+    variants = ['identity', 'hflip']
+    tta = TTA(model, variants)
+    # One output per variant; combine them later with multi_scale.py
+    predictor = Predictor(model, tta.variants, channels_last=channels_last)
+    if args.adaptive is not None:
+        # Augment only the most uncertain tiles, store the fused output
+        adaptive = AdaptiveTTA(model, [v for v in variants if v != 'identity'],
+                               budget=args.adaptive)
+        predictor = Predictor(model, lambda x: [adaptive(x)], channels_last=channels_last)
+        variants = ['adaptive_flip']
 
     for j in tqdm(range(len(IMG_Str))):
         img_path=IMG_Str[j]
         img_input = misc.imread(img_path)
 
-        # scale_list=[2.0]
-
-        multi_avg=torch.zeros((1,6,512,512),dtype=torch.float32).to(device)
-        # torch.zeros(batch-size,num-classes,height,width)
-        for k in range(2):
-            img = img_input.astype(np.float64)
-            # img -= loader.mean
-            if args.img_norm:
-                img = img.astype(float) / 255.0
-
-            # NHWC -> NCHW
-            img = img.transpose(2, 0, 1)
-            img = np.expand_dims(img, 0)
-            img = torch.from_numpy(img).float()
-            if k==0:
-                img=torch.flip(img,[3])
-            else:
-                img=img
-            images = img.to(device)
-            outputs = model(images)
-            # del images
-            # bilinear is ok for both upsample and downsample
-            if k==0:
-                outputs=torch.flip(outputs,[3])
-            # outputs=outputs.to(device)
-            multi_avg=multi_avg+outputs
-            # del outputs
-        outputs=multi_avg
-        # outputs=multi_avg/2
-        out_path="test_out/mv3_1_true_2_res50_data10_MS/mv3_1_true_2_res50_data10_MS_7/"+Path(img_path).stem+"_F_sum.pt"
-
-        torch.save(outputs,out_path)
+        img = img_input.astype(np.float64)
+        # img -= loader.mean
+        if args.img_norm:
+            img = img.astype(float) / 255.0
+
+        # NHWC -> NCHW
+        img = img.transpose(2, 0, 1)
+        img = np.expand_dims(img, 0)
+        img = torch.from_numpy(img).float()
+        # All augmented copies of the same shape go through one forward
+        outputs = predictor(img.to(device))
+        for variant, logits in zip(variants, outputs):
+            store.put(Path(img_path).stem, variant, logits)
         # pred = np.squeeze(final.data.max(1)[1].cpu().numpy(), axis=0)
         #
         # decoded = loader.decode_segmap(pred)
         # out_path="test_out/mv3_1_true_2_res50_data10_MS/mv3_1_true_2_res50_data10_MS_7/"+Path(img_path).name
         # misc.imsave(out_path, decoded)
 
+    store.close()
+    if args.adaptive is not None:
+        print("Adaptive TTA: {:.2f} passes per image, {} of {} tiles refined".format(
+            adaptive.stats['passes'] / max(adaptive.stats['images'], 1),
+            adaptive.stats['refined'], adaptive.stats['tiles']))
+    print("Logit store size: {:.1f} MB".format(store.nbytes() / 2.0 ** 20))
+
     # print("Classes found: ", np.unique(pred))
     # print("Segmentation Mask Saved at: {}".format(args.out_path))
 
@@ -159,6 +161,32 @@ if __name__ == "__main__":
         default="tk.png",
         help="Path of the output segmap",
     )
+    parser.add_argument(
+        "--cudnn_benchmark",
+        dest="cudnn_benchmark",
+        action="store_true",
+        help="Enable cuDNN autotuning, pays off when image sizes repeat | \
+                              False by default",
+    )
+    parser.add_argument(
+        "--store",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Logit store directory | test_out/<config name>/logits by default",
+    )
+    parser.add_argument(
+        "--encoding",
+        nargs="?",
+        type=str,
+        default="fp16",
+        help="Store encoding: 'fp16' logits or 'uint8' probabilities",
+    )
+    parser.add_argument(
+        "--adaptive", nargs="?", type=float, default=None,
+        help="Adaptive TTA: after one pass, augment the most uncertain tiles \
+                              at this fraction of the full TTA cost | off by default",
+    )
     parser.add_argument(
         "--config",
         nargs="?",
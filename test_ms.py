@@ -3,17 +3,16 @@ import torch
 import argparse
 import timeit
 import numpy as np
-import scipy.misc as misc
 import torch.nn as nn
-import torch.nn.functional as F
 import torchvision.models as models
 
 from torch.utils import data
 from tqdm import tqdm
 
-from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
-from ptsemseg.utils import convert_state_dict
+from ptsemseg.memory_format import get_channels_last
+from ptsemseg.inference import (InferencePipeline, LogitStore, MultiScale,
+                                Predictor, load_model)
 
 import yaml
 from pathlib import Path
@@ -45,68 +44,55 @@ def test(args,cfg):
     n_classes = loader.n_classes
 
     # Setup Model
-    model = get_model(cfg['model'], n_classes)
-    state = convert_state_dict(torch.load(args.model_path)["model_state"])
-    # state=torch.load(args.model_path)["model_state"]
-    model.load_state_dict(state)
-    model.eval()
-    model.to(device)
-
-
-    for j in tqdm(range(len(IMG_Str))):
-        img_path=IMG_Str[j]
-        img_input = misc.imread(img_path)
-        sp=list(img_input.shape)
-        #shape height*width*channel
-        sp=sp[0:2]
-        ori_size=tuple(sp)
-        # img = img[:, :, ::-1]
-        # multiscale
-        # img_125=cv.resize(img,dsize=(0,0),fx=1.25,fy=1.25,interpolation=cv.INTER_LINEAR)
-        # img_075=cv.resize(img,dsize=(0,0),fx=0.75,fy=0.75,interpolation=cv.INTER_LINEAR)
-        # scale_list=[2.0,1.75,1.5,1.25,1,0.75,0.5]
-        scale_list=[1.5,1.25,0.75,0.5]
-        # scale_list=[1.4,1.2,0.8,0.6]
-
-        # scale_list=[2.0]
-
-        multi_avg=torch.zeros((1,6,512,512),dtype=torch.float32).to(device)
-        # torch.zeros(batch-size,num-classes,height,width)
-        for scale in scale_list:
-            if scale!=1:
-                img=cv.resize(img_input,dsize=(0,0),fx=scale,fy=scale,interpolation=cv.INTER_LINEAR)
-            else:
-                img=img_input
-            img = img.astype(np.float64)
-            # img -= loader.mean
-            if args.img_norm:
-                img = img.astype(float) / 255.0
-
-            # NHWC -> NCHW
-            img = img.transpose(2, 0, 1)
-            img = np.expand_dims(img, 0)
-            img = torch.from_numpy(img).float()
-            images = img.to(device)
-            outputs = model(images)
-            # del images
-            # bilinear is ok for both upsample and downsample
-            if scale!=1:
-                outputs=F.upsample(outputs,ori_size,mode='bilinear',align_corners=False)
-            # outputs=outputs.to(device)
-            multi_avg=multi_avg+outputs
-            # del outputs
-        # outputs=multi_avg/len(scale_list)
-        outputs=multi_avg
-        out_path="test_out/mv3_1_true_2_res50_data10_MS/mv3_1_true_2_res50_data10_MS_7/"+Path(img_path).stem+"_S4_not_1.pt"
-
-        torch.save(outputs,out_path)
-        # pred = np.squeeze(final.data.max(1)[1].cpu().numpy(), axis=0)
-        #
-        # decoded = loader.decode_segmap(pred)
-        # out_path="test_out/mv3_1_true_2_res50_data10_MS/mv3_1_true_2_res50_data10_MS_7/"+Path(img_path).name
-        # decoded_bgr = cv.cvtColor(decoded, cv.COLOR_RGB2BGR)
-        # # misc.imsave(out_path, decoded)
-        # cv.imwrite(out_path, decoded_bgr)
+    model = load_model(cfg, args.model_path, n_classes, device,
+                       cudnn_benchmark=args.cudnn_benchmark)
+    channels_last = get_channels_last(cfg)
+
+
+    store_path = args.store
+    if store_path is None:
+        store_path = os.path.join("test_out", os.path.basename(args.config)[:-4], "logits")
+    store = LogitStore(store_path, n_classes, args.encoding)
+    print("Write Logits to : {}".format(store_path))
+
+    # Scales run smallest first, each as one batched forward resized on the
+    # device; with --early_exit confident images skip the larger scales
+    ms = MultiScale(model, scales=args.scales, streams=args.streams,
+                    exit_confidence=args.early_exit)
+    predictor = Predictor(model, ms.variants, channels_last=channels_last)
+
+    def read(img_path):
+        img = cv.imread(img_path, cv.IMREAD_COLOR)
+        return cv.cvtColor(img, cv.COLOR_BGR2RGB)
+
+    def predict(imgs):
+        img = torch.from_numpy(np.stack(imgs)).to(device)
+        # NHWC -> NCHW
+        images = img.permute(0, 3, 1, 2).float()
+        # img -= loader.mean
+        if args.img_norm:
+            images = images / 255.0
+        outputs = [[] for _ in imgs]
+        for scale, (logits, idx) in predictor(images).items():
+            for y, i in zip(logits, idx.tolist()):
+                outputs[i].append(("scale:{}".format(scale), y))
+        return outputs
+
+    def write(img_path, outputs):
+        for variant, logits in outputs:
+            store.put(Path(img_path).stem, variant, logits)
+
+    # Images of the same size are batched; one writer as the store is
+    # written from a single thread
+    pipeline = InferencePipeline(read, predict, write, batch_size=args.batch_size,
+                                 n_readers=4, n_writers=1)
+    with tqdm(total=len(IMG_Str)) as pbar:
+        pipeline.run(IMG_Str, progress=pbar.update)
+    print("Forward passes: {forwards} for {images} images, {exited} exited early".format(
+        **ms.stats))
+
+    store.close()
+    print("Logit store size: {:.1f} MB".format(store.nbytes() / 2.0 ** 20))
 
     # print("Classes found: ", np.unique(pred))
     # print("Segmentation Mask Saved at: {}".format(args.out_path))
@@ -172,6 +158,45 @@ if __name__ == "__main__":
         default="tk.png",
         help="Path of the output segmap",
     )
+    parser.add_argument(
+        "--cudnn_benchmark",
+        dest="cudnn_benchmark",
+        action="store_true",
+        help="Enable cuDNN autotuning, pays off when image sizes repeat | \
+                              False by default",
+    )
+    parser.add_argument(
+        "--store",
+        nargs="?",
+        type=str,
+        default=None,
+        help="Logit store directory | test_out/<config name>/logits by default",
+    )
+    parser.add_argument(
+        "--encoding",
+        nargs="?",
+        type=str,
+        default="fp16",
+        help="Store encoding: 'fp16' logits or 'uint8' probabilities",
+    )
+    parser.add_argument(
+        "--scales", nargs="+", type=float, default=[1.5, 1.25, 0.75, 0.5],
+        help="Scales to evaluate",
+    )
+    parser.add_argument(
+        "--early_exit", nargs="?", type=float, default=None,
+        help="Skip scales above 1 for images whose mean top-class probability \
+                              over the smaller scales reaches this | off by default",
+    )
+    parser.add_argument(
+        "--streams",
+        dest="streams",
+        action="store_true",
+        help="Issue the scales of a round on separate CUDA streams | \
+                              False by default",
+    )
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Images of the same size per forward pass")
     parser.add_argument(
         "--config",
         nargs="?",
@@ -4,7 +4,11 @@ import yaml
 import time
 import shutil
 import torch
+import json
 import random
+import inspect
+import threading
+import contextlib
 import argparse
 import datetime
 import numpy as np
@@ -18,11 +22,16 @@ from tqdm import tqdm
 from ptsemseg.models import get_model
 from ptsemseg.loss import get_loss_function
 from ptsemseg.loader import get_loader 
-from ptsemseg.utils import get_logger
-from ptsemseg.metrics import runningScore, averageMeter
+from ptsemseg.utils import get_logger, get_run_id
+from ptsemseg.metrics import torchRunningScore, averageMeter, lossBuffer, stepTimer
 from ptsemseg.augmentations import get_composed_augmentations
 from ptsemseg.schedulers import get_scheduler
-from ptsemseg.optimizers import get_optimizer
+from ptsemseg.optimizers import build_optimizer
+from ptsemseg.train_step import get_train_step
+from ptsemseg.early_stopping import get_early_stopping
+from ptsemseg.ema import get_ema
+from ptsemseg.memory_format import get_channels_last, to_channels_last
+from ptsemseg.telemetry import get_telemetry, metric_fields
 
 from tensorboardX import SummaryWriter
 
@@ -31,22 +40,25 @@ import my_pt
 # import apex
 # import encoding
 
-def train(cfg, writer, logger,run_id):
-    
-    # Setup seeds
-    torch.manual_seed(cfg.get('seed', 1337))
-    torch.cuda.manual_seed(cfg.get('seed', 1337))
-    np.random.seed(cfg.get('seed', 1337))
-    random.seed(cfg.get('seed', 1337))
+# Serializes seeding and model construction between concurrent runs (sweep.py),
+# which share the global RNGs
+_rng_lock = threading.Lock()
 
-    # torch.backends.cudnn.deterministic = True
-    # torch.backends.cudnn.benchmark = False
 
-    torch.backends.cudnn.benchmark=True
+def get_dataloaders(cfg, logger, loader_cache=None):
+    """Builds the train and val DataLoaders.
 
-    os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
-    # Setup device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    If `loader_cache` (a dict) is given, loaders are reused for runs with
+    the same data config and keep their workers alive between runs.
+    """
+    # Compiled / graph-captured steps want a fixed batch shape
+    drop_last = cfg['training'].get('compile', None) is not None
+    key = json.dumps([cfg['data'], cfg['training'].get('augmentations', None),
+                      cfg['training']['batch_size'], cfg['training']['n_workers'],
+                      drop_last], sort_keys=True)
+    if loader_cache is not None and key in loader_cache:
+        logger.info("Reusing dataloaders for: {}".format(cfg['data']['path']))
+        return loader_cache[key]
 
     # Setup Augmentations
     augmentations = cfg['training'].get('augmentations', None)
@@ -58,53 +70,130 @@ def train(cfg, writer, logger,run_id):
 
     logger.info("Using dataset: {}".format(data_path))
 
+    # Only loaders that support it take the decoded-data cache option
+    data_kwargs = {}
+    if cfg['data'].get('cache', False):
+        data_kwargs['cache'] = True
 
     t_loader = data_loader(
         data_path,
         is_transform=True,
         split=cfg['data']['train_split'],
         img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),
-        augmentations=data_aug)
+        augmentations=data_aug,
+        **data_kwargs)
 
     v_loader = data_loader(
         data_path,
         is_transform=True,
         split=cfg['data']['val_split'],
-        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),)
+        img_size=(cfg['data']['img_rows'], cfg['data']['img_cols']),
+        **data_kwargs)
+
+    if data_kwargs.get('cache', False):
+        # Decode before workers are forked so they share the cache
+        logger.info("Warming decoded-data cache")
+        t_loader.warm_cache()
+        v_loader.warm_cache()
+
+    loader_kwargs = {}
+    loader_params = inspect.signature(data.DataLoader.__init__).parameters
+    if (loader_cache is not None and cfg['training']['n_workers'] > 0 and
+            'persistent_workers' in loader_params):
+        loader_kwargs['persistent_workers'] = True
+    t_loader_kwargs = dict(loader_kwargs)
+    if 'generator' in loader_params:
+        # Own shuffling / worker seed stream, reseeded by every run in train()
+        t_loader_kwargs['generator'] = torch.Generator()
 
-    n_classes = t_loader.n_classes
     trainloader = data.DataLoader(t_loader,
                                   batch_size=cfg['training']['batch_size'], 
                                   num_workers=cfg['training']['n_workers'], 
-                                  shuffle=True)
+                                  shuffle=True,
+                                  drop_last=drop_last,
+                                  **t_loader_kwargs)
 
     valloader = data.DataLoader(v_loader, 
                                 batch_size=cfg['training']['batch_size'], 
-                                num_workers=cfg['training']['n_workers'])
+                                num_workers=cfg['training']['n_workers'],
+                                **loader_kwargs)
+
+    if loader_cache is not None:
+        loader_cache[key] = (trainloader, valloader)
+    return trainloader, valloader
+
+
+def train(cfg, writer, logger, run_id, device_ids=None, loader_cache=None):
+    telemetry = get_telemetry(cfg, run_id, writer.file_writer.get_logdir(), writer)
+    try:
+        _train(cfg, writer, logger, run_id, telemetry, device_ids, loader_cache)
+    except Exception as e:
+        telemetry.emit('run_failed', error='{}: {}'.format(type(e).__name__, e))
+        raise
+    finally:
+        # Writes the events still buffered, also when training crashed
+        telemetry.close()
+
+
+def _train(cfg, writer, logger, run_id, telemetry, device_ids=None, loader_cache=None):
+    
+    # Setup seeds
+    seed = cfg.get('seed', 1337)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    # torch.backends.cudnn.deterministic = True
+    # torch.backends.cudnn.benchmark = False
+
+    torch.backends.cudnn.benchmark=True
+
+    if device_ids is None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
+        device_ids = [0, 1]
+    # Setup device
+    device = torch.device("cuda:{}".format(device_ids[0])
+                          if torch.cuda.is_available() else "cpu")
+
+    data_path = cfg['data']['path']
+    trainloader, valloader = get_dataloaders(cfg, logger, loader_cache)
+    t_loader = trainloader.dataset
+    if getattr(trainloader, 'generator', None) is not None:
+        trainloader.generator.manual_seed(seed)
+
+    compile_dict = cfg['training'].get('compile', None)
+
+    n_classes = t_loader.n_classes
 
     # Setup Metrics
-    running_metrics_val = runningScore(n_classes)
+    running_metrics_val = torchRunningScore(n_classes, device)
 
     # Setup Model
     # model = get_model(cfg['model'], n_classes).to(device)
-    model = get_model(cfg['model'], n_classes)
+    with _rng_lock:
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed(seed)
+        model = get_model(cfg['model'], n_classes)
     logger.info("Using Model: {}".format(cfg['model']['arch']))
 
     # model=apex.parallel.convert_syncbn_model(model)
     model=model.to(device)
+    channels_last = get_channels_last(cfg)
+    model = to_channels_last(model, channels_last)
 
 
     # a=range(torch.cuda.device_count())
     # model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
-    model = torch.nn.DataParallel(model, device_ids=[0,1])
+    if compile_dict is None:
+        model = torch.nn.DataParallel(model, device_ids=device_ids)
+    else:
+        # torch.compile / CUDA graphs run on a single device
+        model = torch.nn.DataParallel(model, device_ids=device_ids[:1])
     # model = encoding.parallel.DataParallelModel(model, device_ids=[0, 1])
 
     # Setup optimizer, lr_scheduler and loss function
-    optimizer_cls = get_optimizer(cfg)
-    optimizer_params = {k:v for k, v in cfg['training']['optimizer'].items() 
-                        if k != 'name'}
-
-    optimizer = optimizer_cls(model.parameters(), **optimizer_params)
+    optimizer = build_optimizer(cfg, model)
 
     # optimizer = FP16_Optimizer(optimizer, static_loss_scale=128.0)
 
@@ -119,16 +208,26 @@ def train(cfg, writer, logger,run_id):
     # loss_fn== encoding.parallel.DataParallelCriterion(loss_fn, device_ids=[0, 1])
     logger.info("Using loss {}".format(loss_fn))
 
+    train_step = get_train_step(model, loss_fn, optimizer, compile_dict,
+                                cfg['training']['lr_schedule'])
+
+    early_stop = get_early_stopping(cfg)
+
     start_iter = 0
+    checkpoint = None
     if cfg['training']['resume'] is not None:
         if os.path.isfile(cfg['training']['resume']):
             logger.info(
                 "Loading model and optimizer from checkpoint '{}'".format(cfg['training']['resume'])
             )
             checkpoint = torch.load(cfg['training']['resume'])
-            model.load_state_dict(checkpoint["model_state"])
+            # With EMA evaluation model_state holds the EMA weights; training
+            # continues from the raw ones the optimizer state belongs to
+            model.load_state_dict(checkpoint.get("raw_model_state", checkpoint["model_state"]))
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             scheduler.load_state_dict(checkpoint["scheduler_state"])
+            if early_stop is not None and "early_stop_state" in checkpoint:
+                early_stop.load_state_dict(checkpoint["early_stop_state"])
             # start_iter = checkpoint["epoch"]
             logger.info(
                 "Loaded checkpoint '{}' (iter {})".format(
@@ -138,9 +237,20 @@ def train(cfg, writer, logger,run_id):
         else:
             logger.info("No checkpoint found at '{}'".format(cfg['training']['resume']))
 
+    # EMA starts from the (possibly resumed) weights
+    ema = get_ema(cfg, model)
+    if ema is not None and checkpoint is not None and "ema_state" in checkpoint:
+        ema.load_state_dict(checkpoint["ema_state"])
+    ema_eval = ema is not None and cfg['training']['ema'].get('eval', True)
+
     val_loss_meter = averageMeter()
     time_meter = averageMeter()
     time_meter_val=averageMeter()
+    loss_buffer = lossBuffer()
+    step_timer = stepTimer(device)
+    # Stall detector: host time blocked on the loader vs device step time
+    data_wait_meter = averageMeter()
+    stall_warn_fraction = cfg['training'].get('stall_warn_fraction', 0.1)
 
     best_iou = -100.0
     i = start_iter
@@ -156,118 +266,172 @@ def train(cfg, writer, logger,run_id):
     best_f1_till_now=0
     best_OA_till_now=0
 
+    telemetry.emit('run_start', step=i, arch=cfg['model']['arch'], data_path=data_path,
+                   batch_size=batch_size, train_iter=train_iter,
+                   device_ids=list(device_ids))
+
     while i <= train_iter and flag:
+        data_ts = time.perf_counter()
         for (images, labels) in trainloader:
+            data_wait_meter.update(time.perf_counter() - data_ts)
             i += 1
-            start_ts = time.time()
+            step_timer.start()
             scheduler.step()
             model.train()
-            images = images.to(device)
+            images = to_channels_last(images.to(device), channels_last)
             labels = labels.to(device)
 
-            optimizer.zero_grad()
-            outputs = model(images)
-
-            loss = loss_fn(input=outputs, target=labels)
+            loss = train_step(images, labels)
+            if ema is not None:
+                ema.update()
 
-            loss.backward()
-            # optimizer.backward(loss)
+            step_timer.stop()
+            loss_buffer.update(i + 1, loss)
 
-            optimizer.step()
-            
-            time_meter.update(time.time() - start_ts)
+            if (i + 1) % cfg['training']['print_interval'] == 0:
+                for step_time in step_timer.flush():
+                    time_meter.update(step_time)
+                    ### add by Sprit
+                    time_meter_val.update(step_time)
 
-            ### add by Sprit
-            time_meter_val.update(time.time() - start_ts)
+                losses = loss_buffer.flush()
+                for step, step_loss in losses:
+                    writer.add_scalar('loss/train_loss', step_loss, step)
 
+                wait_fraction = data_wait_meter.avg / max(
+                    data_wait_meter.avg + time_meter.avg, 1e-12)
 
-            if (i + 1) % cfg['training']['print_interval'] == 0:
-                fmt_str = "Iter [{:d}/{:d}]  Loss: {:.4f}  Time/Image: {:.4f}"
+                fmt_str = "Iter [{:d}/{:d}]  Loss: {:.4f}  Time/Image: {:.4f}  Data wait: {:.4f}s ({:.0%})"
                 print_str = fmt_str.format(i + 1,
                                            train_iter,
-                                           loss.item(),
-                                           time_meter.avg / cfg['training']['batch_size'])
+                                           losses[-1][1],
+                                           time_meter.avg / cfg['training']['batch_size'],
+                                           data_wait_meter.avg,
+                                           wait_fraction)
 
 
                 print(print_str)
                 logger.info(print_str)
-                writer.add_scalar('loss/train_loss', loss.item(), i+1)
+                train_fields = {}
+                if device.type == 'cuda':
+                    train_fields['memory_allocated'] = torch.cuda.memory_allocated(device)
+                    train_fields['max_memory_allocated'] = torch.cuda.max_memory_allocated(device)
+                telemetry.emit('train', step=i + 1,
+                               loss=losses[-1][1],
+                               loss_mean=float(np.mean([l for _, l in losses])),
+                               lr=optimizer.param_groups[0]['lr'],
+                               step_time=time_meter.avg,
+                               data_wait=data_wait_meter.avg,
+                               data_wait_fraction=wait_fraction,
+                               **train_fields)
+                if wait_fraction > stall_warn_fraction:
+                    logger.warning("Input pipeline stall: {:.0%} of step time spent "
+                                   "waiting for data".format(wait_fraction))
                 time_meter.reset()
+                data_wait_meter.reset()
 
             if (i + 1) % cfg['training']['val_interval'] == 0 or \
                (i + 1) == train_iter:
-                model.eval()
-                with torch.no_grad():
-                    for i_val, (images_val, labels_val) in tqdm(enumerate(valloader)):
-                        images_val = images_val.to(device)
-                        labels_val = labels_val.to(device)
-
-                        outputs = model(images_val)
-                        # val_loss = loss_fn(input=outputs, target=labels_val)
-
-                        pred = outputs.data.max(1)[1].cpu().numpy()
-                        gt = labels_val.data.cpu().numpy()
-
-
-                        running_metrics_val.update(gt, pred)
-                        # val_loss_meter.update(val_loss.item())
-
-                # writer.add_scalar('loss/val_loss', val_loss_meter.avg, i+1)
-                # logger.info("Iter %d Loss: %.4f" % (i + 1, val_loss_meter.avg))
-
-                score, class_iou = running_metrics_val.get_scores()
-
-                for k, v in score.items():
-                    print(k, v)
-                    logger.info('{}: {}'.format(k, v))
-                    # writer.add_scalar('val_metrics/{}'.format(k), v, i+1)
-
-                for k, v in class_iou.items():
-                    logger.info('{}: {}'.format(k, v))
-                    # writer.add_scalar('val_metrics/cls_{}'.format(k), v, i+1)
-
-                # val_loss_meter.reset()
-                running_metrics_val.reset()
-
-                ### add by Sprit
-                avg_f1 = score["Mean F1 : \t"]
-                OA=score["Overall Acc: \t"]
-                val_rlt_f1.append(avg_f1)
-                val_rlt_OA.append(score["Overall Acc: \t"])
-
-                if avg_f1 >= best_f1_till_now:
-                    best_f1_till_now = avg_f1
-                    correspond_OA = score["Overall Acc: \t"]
-                    best_f1_epoch_till_now = i+1
-                print("\nBest F1 till now = ", best_f1_till_now)
-                print("Correspond OA= ", correspond_OA)
-                print("Best F1 Iter till now= ", best_f1_epoch_till_now)
-
-                if OA >= best_OA_till_now:
-                    best_OA_till_now = OA
-                    correspond_f1 = score["Mean F1 : \t"]
-                    # correspond_acc=score["Overall Acc: \t"]
-                    best_OA_epoch_till_now = i+1
-
-                    state = {
-                        "epoch": i + 1,
-                        "model_state": model.state_dict(),
-                        "optimizer_state": optimizer.state_dict(),
-                        "scheduler_state": scheduler.state_dict(),
-                        "best_OA": best_OA_till_now,
-                    }
-                    save_path = os.path.join(writer.file_writer.get_logdir(),
-                                             "{}_{}_best_model.pkl".format(
-                                                 cfg['model']['arch'],
-                                                 cfg['data']['dataset']))
-                    torch.save(state, save_path)
+                # Validate and save the EMA weights instead of the raw ones.
+                # raw_state references the raw tensors, which the swap keeps alive
+                raw_state = model.state_dict() if ema_eval else None
+                with ema.swapped() if ema_eval else contextlib.nullcontext():
+                    model.eval()
+                    val_ts = time.perf_counter()
+                    with torch.no_grad():
+                        for i_val, (images_val, labels_val) in tqdm(enumerate(valloader)):
+                            images_val = to_channels_last(images_val.to(device), channels_last)
+                            labels_val = labels_val.to(device)
+
+                            outputs = model(images_val)
+                            # val_loss = loss_fn(input=outputs, target=labels_val)
+
+                            pred = outputs.max(1)[1]
+                            running_metrics_val.update(labels_val, pred)
+                            # val_loss_meter.update(val_loss.item())
+
+                    # writer.add_scalar('loss/val_loss', val_loss_meter.avg, i+1)
+                    # logger.info("Iter %d Loss: %.4f" % (i + 1, val_loss_meter.avg))
+
+                    score, class_iou = running_metrics_val.get_scores()
+                    telemetry.emit('val', step=i + 1, val_time=time.perf_counter() - val_ts,
+                                   class_iou=class_iou, **metric_fields(score))
+
+                    for k, v in score.items():
+                        print(k, v)
+                        logger.info('{}: {}'.format(k, v))
+                        # writer.add_scalar('val_metrics/{}'.format(k), v, i+1)
+
+                    for k, v in class_iou.items():
+                        logger.info('{}: {}'.format(k, v))
+                        # writer.add_scalar('val_metrics/cls_{}'.format(k), v, i+1)
+
+                    # val_loss_meter.reset()
+                    running_metrics_val.reset()
+
+                    ### add by Sprit
+                    avg_f1 = score["Mean F1 : \t"]
+                    OA=score["Overall Acc: \t"]
+                    val_rlt_f1.append(avg_f1)
+                    val_rlt_OA.append(score["Overall Acc: \t"])
+
+                    if avg_f1 >= best_f1_till_now:
+                        best_f1_till_now = avg_f1
+                        correspond_OA = score["Overall Acc: \t"]
+                        best_f1_epoch_till_now = i+1
+                    print("\nBest F1 till now = ", best_f1_till_now)
+                    print("Correspond OA= ", correspond_OA)
+                    print("Best F1 Iter till now= ", best_f1_epoch_till_now)
+
+                    # Step before checkpointing so the saved state includes this round
+                    stop = early_stop is not None and early_stop.step(score, i + 1)
+
+                    if OA >= best_OA_till_now:
+                        best_OA_till_now = OA
+                        correspond_f1 = score["Mean F1 : \t"]
+                        # correspond_acc=score["Overall Acc: \t"]
+                        best_OA_epoch_till_now = i+1
+
+                        state = {
+                            "epoch": i + 1,
+                            "model_state": model.state_dict(),
+                            "optimizer_state": optimizer.state_dict(),
+                            "scheduler_state": scheduler.state_dict(),
+                            "best_OA": best_OA_till_now,
+                        }
+                        if early_stop is not None:
+                            state["early_stop_state"] = early_stop.state_dict()
+                        if ema_eval:
+                            state["raw_model_state"] = raw_state
+                        if ema is not None:
+                            state["ema_state"] = ema.state_dict()
+                        save_path = os.path.join(writer.file_writer.get_logdir(),
+                                                 "{}_{}_best_model.pkl".format(
+                                                     cfg['model']['arch'],
+                                                     cfg['data']['dataset']))
+                        torch.save(state, save_path)
 
                 print("Best OA till now = ", best_OA_till_now)
                 print("Correspond F1= ", correspond_f1)
                 # print("Correspond OA= ",correspond_acc)
                 print("Best OA Iter till now= ", best_OA_epoch_till_now)
 
+                if stop:
+                    stop_str = "Early stopping at iter {}: {} did not improve by {} " \
+                               "for {} validations (best {:.7f} at iter {})".format(
+                                   i + 1, early_stop.metric, early_stop.min_delta,
+                                   early_stop.patience, early_stop.best,
+                                   early_stop.best_iter)
+                    print(stop_str)
+                    logger.info(stop_str)
+                    telemetry.emit('early_stop', step=i + 1, metric=early_stop.metric,
+                                   best=early_stop.best, best_iter=early_stop.best_iter)
+                    flag = False
+
                 ### add by Sprit
+                for step_time in step_timer.flush():
+                    time_meter.update(step_time)
+                    time_meter_val.update(step_time)
                 iter_time=time_meter_val.avg
                 time_meter_val.reset()
                 remain_time = iter_time * (train_iter - i)
@@ -294,11 +458,16 @@ def train(cfg, writer, logger,run_id):
                 #                                  cfg['data']['dataset']))
                 #     torch.save(state, save_path)
 
-            if (i + 1) == train_iter:
+            if (i + 1) == train_iter or not flag:
                 flag = False
                 break
+            data_ts = time.perf_counter()
     my_pt.csv_out(run_id,data_path,cfg['model']['arch'],epoch,val_rlt_f1,cfg['training']['val_interval'])
     my_pt.csv_out(run_id,data_path,cfg['model']['arch'],epoch,val_rlt_OA,cfg['training']['val_interval'])
+    telemetry.result(step=i + 1, arch=cfg['model']['arch'], data_path=data_path,
+                     epoch=epoch, best_f1=best_f1_till_now, best_OA=best_OA_till_now,
+                     val_f1=val_rlt_f1, val_OA=val_rlt_OA,
+                     val_interval=cfg['training']['val_interval'])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="config")
@@ -315,7 +484,7 @@ if __name__ == "__main__":
     with open(args.config) as fp:
         cfg = yaml.load(fp)
 
-    run_id = random.randint(1,100000)
+    run_id = get_run_id()
     logdir = os.path.join('runs', os.path.basename(args.config)[:-4] , str(run_id))
     writer = SummaryWriter(log_dir=logdir)
 
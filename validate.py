@@ -3,8 +3,6 @@ import sys
 import yaml
 import torch
 import argparse
-import timeit
-import numpy as np
 import scipy.misc as misc
 import torch.nn as nn
 import torch.nn.functional as F
@@ -15,12 +13,9 @@ from torch.utils import data
 
 from tqdm import tqdm
 
-from ptsemseg.models import get_model
 from ptsemseg.loader import get_loader, get_data_path
-from ptsemseg.metrics import runningScore
-from ptsemseg.utils import convert_state_dict
-
-torch.backends.cudnn.benchmark = True
+from ptsemseg.memory_format import get_channels_last
+from ptsemseg.inference import Evaluator, SlidingWindow, TTA, load_model
 
 
 def validate(cfg, args):
@@ -36,58 +31,35 @@ def validate(cfg, args):
         split=cfg['data']['val_split'],
         is_transform=True,
         img_size=(cfg['data']['img_rows'], 
-                  cfg['data']['img_rows']),
+                  cfg['data']['img_cols']),
     )
 
     n_classes = loader.n_classes
 
+    batch_size = args.batch_size or cfg['training']['batch_size']
     valloader = data.DataLoader(loader, 
-                                batch_size=cfg['training']['batch_size'], 
-                                num_workers=8)
-    running_metrics = runningScore(n_classes)
+                                batch_size=batch_size, 
+                                num_workers=cfg['training']['n_workers'],
+                                pin_memory=device.type == "cuda")
 
     # Setup Model
-
-    model = get_model(cfg['model'], n_classes).to(device)
-    state = convert_state_dict(torch.load(args.model_path)["model_state"])
-    model.load_state_dict(state)
-    model.eval()
-    model.to(device)
-
-    for i, (images, labels) in enumerate(valloader):
-        start_time = timeit.default_timer()
-
-        images = images.to(device)
-
-        if args.eval_flip:
-            outputs = model(images)
-
-            # Flip images in numpy (not support in tensor)
-            outputs = outputs.data.cpu().numpy()
-            flipped_images = np.copy(images.data.cpu().numpy()[:, :, :, ::-1])
-            flipped_images = torch.from_numpy(flipped_images).float().to(device)
-            outputs_flipped = model(flipped_images)
-            outputs_flipped = outputs_flipped.data.cpu().numpy()
-            outputs = (outputs + outputs_flipped[:, :, :, ::-1]) / 2.0
-
-            pred = np.argmax(outputs, axis=1)
-        else:
-            outputs = model(images)
-            pred = outputs.data.max(1)[1].cpu().numpy()
-
-        gt = labels.numpy()
-
-        if args.measure_time:
-            elapsed_time = timeit.default_timer() - start_time
-            print(
-                "Inference time \
-                  (iter {0:5d}): {1:3.5f} fps".format(
-                    i + 1, pred.shape[0] / elapsed_time
-                )
-            )
-        running_metrics.update(gt, pred)
-
-    score, class_iou = running_metrics.get_scores()
+    model = load_model(cfg, args.model_path, n_classes, device, cudnn_benchmark=True)
+    channels_last = get_channels_last(cfg)
+
+    # Flip TTA and tiling run batched on the device
+    fn = model
+    variants = args.tta
+    if variants is None and args.eval_flip:
+        variants = ['identity', 'hflip']
+    if variants is not None:
+        fn = TTA(fn, variants)
+    if args.tile_size is not None:
+        fn = SlidingWindow(fn, tile_size=args.tile_size, overlap=args.overlap,
+                           batch_tiles=args.batch_tiles)
+
+    evaluator = Evaluator(model, n_classes, device, fn=fn, channels_last=channels_last)
+    with tqdm(total=len(loader)) as pbar:
+        score, class_iou, timings = evaluator.run(valloader, progress=pbar.update)
 
     for k, v in score.items():
         print(k, v)
@@ -95,6 +67,14 @@ def validate(cfg, args):
     for i in range(n_classes):
         print(i, class_iou[i])
 
+    if args.measure_time:
+        total = timings['total']
+        for phase in Evaluator.phases:
+            print("{:<8} {:8.3f} s  {:5.1f} %".format(
+                phase, timings[phase], 100.0 * timings[phase] / max(total, 1e-12)))
+        print("{:<8} {:8.3f} s  {:.1f} images/s".format(
+            "total", total, timings['images'] / max(total, 1e-12)))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Hyperparams")
@@ -128,18 +108,30 @@ if __name__ == "__main__":
     )
     parser.set_defaults(eval_flip=True)
 
+    parser.add_argument("--tta", nargs="+", type=str, default=None,
+                        help="TTA variants, e.g. identity hflip vflip | \
+                              identity hflip with --eval_flip")
+    parser.add_argument("--tile_size", nargs=2, type=int, default=None,
+                        help="Predict tile by tile (rows cols)")
+    parser.add_argument("--overlap", type=float, default=0.25,
+                        help="Tile overlap fraction")
+    parser.add_argument("--batch_tiles", type=int, default=8,
+                        help="Tiles per forward pass")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Images per batch | training batch_size by default")
+
     parser.add_argument(
         "--measure_time",
         dest="measure_time",
         action="store_true",
-        help="Enable evaluation with time (fps) measurement |\
+        help="Report time spent per phase (data, h2d, forward, metric) |\
                               True by default",
     )
     parser.add_argument(
         "--no-measure_time",
         dest="measure_time",
         action="store_false",
-        help="Disable evaluation with time (fps) measurement |\
+        help="Do not report time spent per phase |\
                               True by default",
     )
     parser.set_defaults(measure_time=True)